@@ -1 +1,6 @@
-from .components import cameras,sensors,tools,mirrors,loops,ui,simulator
+from .components import cameras,sensors,tools,mirrors,simulator,engine
+try:
+    from .components import loops,ui
+except ImportError as ie:
+    # without PyQt5, only the headless engine is available
+    pass
@@ -0,0 +1,171 @@
+import numpy as np
+import time
+import threading
+
+class FrameRing:
+
+    def __init__(self,n_buffers,shape,dtype):
+        """A FrameRing is a preallocated ring of frame buffers, written by a
+        single acquisition thread and read by any number of consumers.
+
+        Frames are numbered from 0 in the order they are written; frame n
+        lives in slot n%n_buffers until frame n+n_buffers replaces it.
+        The writer never waits for the readers: before overwriting a slot,
+        it marks the slot's frame number -1, and it sets the new number
+        only once the frame and its timestamp have been copied in. A reader
+        copies a frame out and then checks that its slot still holds the
+        same frame number, so a frame overwritten mid-copy is detected and
+        the read is retried, instead of returning a torn frame. The only
+        lock is the condition used to wait for new frames."""
+
+        self.n_buffers = n_buffers
+        self.buffers = np.zeros((n_buffers,)+tuple(shape),dtype=dtype)
+        self.frame_numbers = -np.ones(n_buffers,dtype=np.int64)
+        self.timestamps = np.zeros(n_buffers)
+        self.write_count = 0
+        self.condition = threading.Condition()
+
+    def put(self,frame,timestamp):
+        frame_number = self.write_count
+        slot = frame_number%self.n_buffers
+        self.frame_numbers[slot] = -1
+        self.buffers[slot,...] = frame
+        self.timestamps[slot] = timestamp
+        self.frame_numbers[slot] = frame_number
+        with self.condition:
+            self.write_count = frame_number+1
+            self.condition.notify_all()
+
+    def oldest(self):
+        # the oldest frame that can still be read; the slot after the
+        # newest frame may be in the middle of being overwritten
+        return max(0,self.write_count-self.n_buffers+1)
+
+    def wait_for(self,frame_number,timeout):
+        # wait until frame_number has been written; False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: self.write_count>frame_number,timeout)
+
+    def read(self,frame_number,out):
+        # copy frame_number into out and return its timestamp, or None if
+        # it isn't (or is no longer) in the ring
+        slot = frame_number%self.n_buffers
+        if not self.frame_numbers[slot]==frame_number:
+            return None
+        out[...] = self.buffers[slot]
+        timestamp = self.timestamps[slot]
+        if not self.frame_numbers[slot]==frame_number:
+            return None
+        return timestamp
+
+
+class AcquisitionThread(threading.Thread):
+
+    def __init__(self,camera,ring):
+        super(AcquisitionThread,self).__init__()
+        self.daemon = True
+        self.camera = camera
+        self.ring = ring
+        self.camera_lock = threading.Lock()
+        self.running = True
+        self.errors = 0
+
+    def run(self):
+        while self.running:
+            try:
+                with self.camera_lock:
+                    frame = self.camera.get_image()
+                self.ring.put(frame,time.perf_counter())
+            except Exception as e:
+                print('AcquisitionThread: %s'%e)
+                self.errors = self.errors + 1
+                time.sleep(0.1)
+
+    def stop(self):
+        self.running = False
+
+
+class ThreadedCamera:
+
+    def __init__(self,camera,n_buffers=4,mode='newest',timeout=1.0):
+        """A ThreadedCamera wraps any of the camera classes in cameras.py
+        with the same interface, but runs the camera's get_image in its own
+        AcquisitionThread, which fills a FrameRing. get_image then returns
+        a frame from the ring instead of waiting for the exposure and
+        readout of a new one, so that readout overlaps with processing.
+
+        In 'newest' mode, get_image returns the newest frame not yet
+        returned, skipping any older ones; in 'next' mode it returns
+        frames in order, skipping only those that have already been
+        overwritten. Either way, if no new frame is ready, it waits up to
+        timeout seconds for one. get_fresh_image instead waits for a frame
+        whose exposure began after the call, e.g. after the mirror has
+        been moved during calibration.
+
+        Frames are copied out of the ring into two buffers that are used
+        alternately, so a returned frame remains valid until the second
+        following call; copy it to keep it longer. The number and
+        timestamp of the last frame returned, and the number of frames
+        skipped, are in frame_number, frame_timestamp, and frames_dropped."""
+
+        self.camera = camera
+        self.mode = mode
+        self.timeout = timeout
+        first = camera.get_image()
+        self.ring = FrameRing(n_buffers,first.shape,first.dtype)
+        self.ring.put(first,time.perf_counter())
+        self.out = [np.zeros_like(first),np.zeros_like(first)]
+        self.out_index = 0
+        self.frame_number = -1
+        self.frame_timestamp = 0.0
+        self.frames_dropped = 0
+        self.thread = AcquisitionThread(camera,self.ring)
+        self.thread.start()
+
+    def read(self,frame_number,count_dropped=True):
+        # wait for frame_number, or the oldest frame still in the ring if
+        # it has been overwritten, and copy it out
+        while True:
+            if not self.ring.wait_for(frame_number,self.timeout):
+                print('ThreadedCamera: no frame within %0.1f s; returning frame %d again.'%(self.timeout,self.frame_number))
+                return self.out[self.out_index]
+            frame_number = max(frame_number,self.ring.oldest())
+            out = self.out[1-self.out_index]
+            timestamp = self.ring.read(frame_number,out)
+            if timestamp is not None:
+                break
+        if count_dropped and self.frame_number>=0:
+            self.frames_dropped = self.frames_dropped+frame_number-self.frame_number-1
+        self.out_index = 1-self.out_index
+        self.frame_number = frame_number
+        self.frame_timestamp = timestamp
+        return out
+
+    def get_image(self):
+        if self.mode=='next':
+            return self.read(self.frame_number+1)
+        else:
+            return self.read(max(self.frame_number+1,self.ring.write_count-1))
+
+    def wait_for_frame(self):
+        # wait for a frame that get_image hasn't yet returned, for loops
+        # triggered by the camera
+        return self.ring.wait_for(self.frame_number+1,self.timeout)
+
+    def get_fresh_image(self):
+        # frame write_count is already being exposed; the one after it
+        # starts after this call
+        return self.read(self.ring.write_count+1,count_dropped=False)
+
+    def set_exposure(self,exposure_us):
+        with self.thread.camera_lock:
+            return self.camera.set_exposure(exposure_us)
+
+    def get_exposure(self):
+        with self.thread.camera_lock:
+            return self.camera.get_exposure()
+
+    def close(self):
+        self.thread.stop()
+        self.thread.join(self.timeout+1.0)
+        self.camera.close()
@@ -4,8 +4,6 @@ try:
 except ImportError as ie:
     use_audio = False
     
-from PyQt5.QtCore import QUrl,pyqtSlot
-from PyQt5.Qt import QApplication
 import ciao_config as ccfg
 import sys
 import numpy as np
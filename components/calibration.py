@@ -0,0 +1,298 @@
+import numpy as np
+import time
+import threading
+from scipy.linalg import hadamard
+import ciao_config as ccfg
+from .poke import Poke
+
+def multiplex_patterns(n_actuators,mode='hadamard',n_repeats=1,seed=0):
+    """Return the patterns used to measure the poke matrix with every
+    actuator moving at once, an n_frames x n_actuators array of +/-1,
+    one row per frame.
+
+    In 'hadamard' mode, the columns are those of the smallest Sylvester
+    Hadamard matrix with more than n_actuators columns, skipping the
+    first, whose elements are all +1 and which would be confounded with
+    the sensor's offset; the columns are then orthogonal to each other
+    and to the offset. They are taken in a random order and with random
+    signs, since the Sylvester matrix's rows are smooth--its first is all
+    +1--and would move the spots much further than the others. In
+    'random' mode, they are random +/-1, as many as the Hadamard
+    patterns, and only nearly orthogonal. seed makes the patterns
+    repeatable.
+
+    The patterns are followed by their negatives, so that the response
+    to pairs of actuators, which in a Sylvester matrix is the pattern of
+    a third actuator, cancels, and the set is repeated n_repeats times."""
+    rng = np.random.RandomState(seed)
+    n = 1
+    while n<n_actuators+1:
+        n = n*2
+    if mode=='hadamard':
+        columns = rng.permutation(n-1)[:n_actuators]+1
+        signs = rng.randint(0,2,n_actuators)*2.0-1.0
+        patterns = hadamard(n)[:,columns]*signs[None,:]
+    elif mode=='random':
+        patterns = rng.randint(0,2,(n,n_actuators))*2.0-1.0
+    else:
+        raise ValueError('unknown multiplexing mode %s'%mode)
+    patterns = np.vstack((patterns,-patterns))
+    return np.tile(patterns,(n_repeats,1))
+
+def demultiplex(slopes,patterns,amplitude):
+    """Solve for the poke matrix, n_slopes x n_actuators, from the
+    n_frames x n_slopes slopes measured with the mirror at its flat plus
+    amplitude times each of the patterns. The slopes are modeled as an
+    offset plus the poke matrix times the command, and both are found in
+    one least squares solve; with Hadamard patterns this is the same as
+    correlating the slopes with each actuator's pattern."""
+    n_frames,n_actuators = patterns.shape
+    design = np.hstack((np.ones((n_frames,1)),amplitude*patterns))
+    coefs,residuals,rank,sv = np.linalg.lstsq(design,slopes,rcond=None)
+    if rank<design.shape[1]:
+        print('demultiplex: patterns have rank %d, fewer than the %d unknowns'%(rank,design.shape[1]))
+    return coefs[1:,:].T
+
+class Modulator:
+
+    def __init__(self,n_slopes,basis,amplitude,n_frames=1024,delay=1,n_settle=64):
+        """A Modulator measures the poke matrix while the loop runs,
+        by adding to each command amplitude times a sinusoid for each
+        column of basis, an n_actuators x n_actuators matrix--e.g. the
+        identity, to modulate actuators, or the mirror's modes--each at
+        its own frequency. The frequencies are whole numbers of cycles in n_frames,
+        between n_frames/8 and n_frames/2 cycles, above the loop's
+        bandwidth, so that the loop corrects little of the modulation.
+
+        Call apply with each iteration's slopes and command, which it
+        modulates in place. After n_settle frames, it logs n_frames
+        commands, and the slopes measured delay frames after each, the
+        loop's latency; apply returns True once the logs are full. Then
+        demodulate finds each frequency's component of the commands and
+        slopes with one FFT, and solves for the poke matrix. Because it
+        uses the commands actually sent, which include the loop's
+        correction of the modulation and of everything else, the loop may
+        stay closed."""
+        n_actuators,n_vectors = basis.shape
+        first = n_frames//8
+        step = (n_frames//2-first)//n_vectors
+        if step<1:
+            raise ValueError('%d frames are too few to modulate %d vectors at distinct frequencies'%(n_frames,n_vectors))
+        self.bins = first+step*np.arange(n_vectors)
+        self.n_frames = n_frames
+        self.delay = delay
+        self.n_settle = n_settle
+        t = np.arange(n_frames)
+        self.dither = amplitude*np.dot(np.sin(2*np.pi*t[:,None]*self.bins[None,:]/float(n_frames)),basis.T)
+        self.commands = np.zeros((n_frames,n_actuators))
+        self.slopes = np.zeros((n_frames,n_slopes))
+        self.count = 0
+
+    def apply(self,slopes,command):
+        k = self.count
+        self.count = k+1
+        # the dither is periodic in n_frames
+        np.add(command,self.dither[k%self.n_frames],out=command)
+        i = k-self.n_settle
+        if 0<=i<self.n_frames:
+            self.commands[i] = command
+        i = i-self.delay
+        if 0<=i<self.n_frames:
+            self.slopes[i] = slopes
+        return i>=self.n_frames-1
+
+    def demodulate(self):
+        # at each modulation frequency, the slopes' component is the poke
+        # matrix times the commands' component: Y = U P.T
+        U = np.fft.rfft(self.commands,axis=0)[self.bins,:]
+        Y = np.fft.rfft(self.slopes,axis=0)[self.bins,:]
+        return np.real(np.linalg.solve(U,Y)).T
+
+
+class Refiner(threading.Thread):
+
+    def __init__(self,loop,forgetting=0.999,regularization=0.1,interval_s=10.0,delay=1,
+                 amplitude=0.005,block_size=64,n_dither=4096,seed=0):
+        """A Refiner keeps refining the loop's poke matrix, in the
+        background, while the loop runs: the change in the slopes from one
+        iteration to the next, ds, is the poke matrix times the change in
+        the command sent delay iterations earlier, du, plus the change in
+        the aberration and noise.
+
+        In closed loop, du is computed from the previous slopes, so it is
+        correlated with their noise, which is also in ds, and a least
+        squares fit of ds to du would be biased--by about 1/gain times the
+        poke matrix. So the Refiner adds to each command a small random
+        dither, +/-amplitude on each actuator, and uses its change, z, as
+        an instrument: with the normal equations R = sum(du z.T) and
+        C = sum(ds z.T), the fit P = C R^-1 is unbiased, since z is
+        independent of the noise and the aberration.
+
+        The loop passes each iteration's slopes and commands to observe,
+        which dithers the new command and copies the rest into one of two
+        blocks of block_size frames; the thread takes full blocks and adds
+        them to R and C, weighting each frame forgetting times the next, so
+        that the fit follows drift with a memory of about 1/(1-forgetting)
+        frames. The fit is regularized toward the loop's poke matrix by
+        regularization times the mean of R's diagonal. Frames with inactive
+        lenslets, whose slopes mean nothing, are left out.
+
+        Before each block is added, the fit's and the loop's poke
+        matrices' errors, ds-P du, are correlated with z and summed with
+        the same weights; for the true poke matrix, the sum tends to zero.
+        Every interval_s, if the fit has seen enough frames and its sum is
+        smaller, it's inverted and, if its condition number is within
+        loop_condition_llim/ulim, handed to the loop, which switches to it
+        at its next iteration."""
+        super(Refiner,self).__init__()
+        self.daemon = True
+        self.loop = loop
+        self.forgetting = forgetting
+        self.regularization = regularization
+        self.interval_s = interval_s
+        self.delay = delay
+        self.block_size = block_size
+        n_slopes = 2*loop.sensor.n_lenslets
+        n_actuators = loop.mirror.n_actuators
+        rng = np.random.RandomState(seed)
+        self.dither = amplitude*(rng.randint(0,2,(n_dither,n_actuators))*2.0-1.0)
+        # the commands of the last delay iterations, oldest next
+        self.history = np.zeros((delay,n_actuators))
+        self.blocks = [(np.zeros((block_size,n_slopes)),np.zeros((block_size,n_actuators)),
+                        np.zeros(block_size,dtype=int),np.zeros(block_size,dtype=bool)) for k in range(2)]
+        self.block = 0
+        self.row = 0
+        self.full = None
+        self.count = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.R = np.zeros((n_actuators,n_actuators))
+        self.C = np.zeros((n_slopes,n_actuators))
+        self.weight = 0.0
+        self.fit_moments = np.zeros((n_slopes,n_actuators))
+        self.loop_moments = np.zeros((n_slopes,n_actuators))
+        self.last = None
+        self.fit = None
+        self.n_blocks = 0
+        self.n_dropped = 0
+        self.n_pushed = 0
+
+    def observe(self,slopes,current_command,command,valid=True):
+        # called by the loop once per iteration, with the slopes, the
+        # command they were measured with, and the command about to be
+        # sent, which is dithered in place; doesn't allocate
+        k = self.count
+        self.count = k+1
+        self.history[k%self.delay] = current_command
+        slopes_block,commands_block,dither_block,valid_block = self.blocks[self.block]
+        row = self.row
+        slopes_block[row] = slopes
+        commands_block[row] = self.history[(k+1)%self.delay]
+        dither_block[row] = (k-self.delay)%len(self.dither)
+        valid_block[row] = valid and k>=self.delay
+        np.add(command,self.dither[k%len(self.dither)],out=command)
+        row = row+1
+        if row==self.block_size:
+            with self.condition:
+                if self.full is None:
+                    self.full = self.block
+                    self.block = 1-self.block
+                    self.condition.notify()
+                else:
+                    # the thread hasn't taken the last block; overwrite
+                    # this one
+                    self.n_dropped+=1
+            row = 0
+        self.row = row
+
+    def run(self):
+        t_push = time.time()
+        while self.running:
+            with self.condition:
+                if self.full is None:
+                    self.condition.wait(0.5)
+                full = self.full
+            if full is not None:
+                try:
+                    self.add(*self.blocks[full])
+                except Exception as e:
+                    print('Refiner: %s'%e)
+                with self.condition:
+                    self.full = None
+            if time.time()-t_push>self.interval_s:
+                t_push = time.time()
+                try:
+                    self.push()
+                except Exception as e:
+                    print('Refiner: %s'%e)
+
+    def add(self,slopes,commands,dither_index,valid):
+        # the changes between consecutive valid frames, including the
+        # last frame of the previous block
+        dither = self.dither[dither_index]
+        if self.last is not None:
+            slopes = np.vstack((self.last[0][None,:],slopes))
+            commands = np.vstack((self.last[1][None,:],commands))
+            dither = np.vstack((self.last[2][None,:],dither))
+            valid = np.hstack((self.last[3],valid))
+        self.last = (slopes[-1].copy(),commands[-1].copy(),dither[-1].copy(),valid[-1])
+        pairs = valid[1:]&valid[:-1]
+        ds = np.diff(slopes,axis=0)[pairs]
+        du = np.diff(commands,axis=0)[pairs]
+        z = np.diff(dither,axis=0)[pairs]
+        n = len(ds)
+        self.n_blocks+=1
+        if n==0:
+            return
+
+        # weight the frames, newest 1, and discount the sums so far
+        weights = self.forgetting**np.arange(n-1,-1,-1)
+        discount = self.forgetting**n
+        zw = z*weights[:,None]
+        loop_poke = self.loop.poke.poke
+        if self.fit is None:
+            self.fit = loop_poke.copy()
+        self.fit_moments = discount*self.fit_moments+np.dot((ds-np.dot(du,self.fit.T)).T,zw)
+        self.loop_moments = discount*self.loop_moments+np.dot((ds-np.dot(du,loop_poke.T)).T,zw)
+        self.R = discount*self.R+np.dot(du.T,zw)
+        self.C = discount*self.C+np.dot(ds.T,zw)
+        self.weight = discount*self.weight+np.sum(weights)
+
+        rho = self.regularization*np.mean(np.diag(self.R))
+        if rho<=0:
+            return
+        # P (R + rho I) = C + rho P_loop
+        self.fit = np.linalg.solve((self.R+rho*np.eye(len(self.R))).T,(self.C+rho*loop_poke).T).T
+
+    def push(self):
+        # hand the fit to the loop, if it has seen about a memory's worth
+        # of frames and fits the recent frames better than the loop's poke
+        # matrix
+        loop = self.loop
+        if self.fit is None or self.weight<0.5/(1-self.forgetting):
+            return
+        fit_error = np.linalg.norm(self.fit_moments)
+        loop_error = np.linalg.norm(self.loop_moments)
+        if not fit_error<loop_error:
+            return
+        poke = Poke(self.fit.copy())
+        n_modes = loop.get_n_modes()
+        if n_modes>0 and n_modes!=poke.n_modes:
+            poke.set_n_modes(n_modes)
+        mask = loop.active_mask.copy()
+        if not mask.all() and ccfg.poke_invert_on_demand:
+            poke.precompute(mask)
+        cond = poke.cutoff_cond
+        if not ccfg.loop_condition_llim<cond<ccfg.loop_condition_ulim:
+            print('Refiner: condition number %0.1f out of range'%cond)
+            return
+        print('Refiner: instrument error %0.3e, was %0.3e; switching poke matrix'%(fit_error,loop_error))
+        loop.pending_poke = poke
+        # the loop's poke matrix is now the fit
+        self.loop_moments[:] = self.fit_moments
+        self.n_pushed+=1
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -163,8 +163,15 @@ class TLCamera:
     def get_image(self):
         self.camera.issue_software_trigger()
         frame = self.camera.get_pending_frame_or_null()
-        #self.image = frame.image_buffer
-        self.image = frame.image_buffer.astype(np.int16)
+        if frame is None:
+            raise IOError('TLCamera: no frame within %d ms'%self.camera.image_poll_timeout_ms)
+        # the SDK reuses image_buffer for the next frame, so it's copied,
+        # into a buffer of our own; the centroiding kernels accept uint16,
+        # so there's no int16 conversion
+        buf = frame.image_buffer
+        if self.image is None or not self.image.shape==buf.shape:
+            self.image = np.empty(buf.shape,dtype=np.uint16)
+        np.copyto(self.image,buf)
         return self.image
         
 
@@ -200,7 +207,7 @@ class PylonCamera:
         self.image = None
 
     def get_image(self):
-        self.image = self.camera.GrabOne(self.timeout).Array.astype(np.int16)
+        self.image = self.camera.GrabOne(self.timeout).Array
         return self.image
     
     def close(self):
@@ -230,8 +237,10 @@ class XimeaCamera:
 
     def get_image(self):
         self.camera.get_image(self.img)
-        self.image = np.reshape(np.frombuffer(self.img.get_image_data_raw(),dtype=np.uint8),
-                          (self.img.height,self.img.width)).astype(np.int16)
+        # the centroiding kernels need a writable array; a bytearray gives
+        # one without the int16 conversion
+        self.image = np.reshape(np.frombuffer(bytearray(self.img.get_image_data_raw()),dtype=np.uint8),
+                                (self.img.height,self.img.width))
         return self.image
     
     def close(self):
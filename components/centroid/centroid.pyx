@@ -1,33 +1,85 @@
 import numpy as np
 cimport numpy as np
-from matplotlib import pyplot as plt
 import cython
 from cython.parallel import prange
 from libc.stdio cimport printf
+from libc.math cimport floor
 import sys,os
 from sys import exit
 
 # Importing round is failing in windows for some reason; it may have
-# something to do with the MSVS c compiler and a 32-bit 64-bit clash.
-# If we want to implement parallelism at some point, we need to figure
-# this out, because the python round function cannot be used in a
-# 'with nogil:' context (since it's a python object), but we need some
-# way to round values and it's risky to write our own c round function
-# because it might be inefficient compared to clang's version.
-# from libc.math cimport round as c_round
-
-# Changes required to compile parallel version (Linux only):
-# 1. uncomment the "from libc.math cimport round as c_round" line above
-# 2. change all calls to round below to c_round
-# 3. add back the 'with nogil:' context, just above the prange
-# 4. change range to prange in the outermost loop (the one that iterates
-#    over the spots
+# something to do with the MSVS c compiler and a 32-bit 64-bit clash
+# (the MSVC runtime used for older Pythons has no C99 round). The python
+# round function cannot be used in a 'with nogil:' context, since it's a
+# python object, so we round with our own inline helper, built on C89
+# floor, which is available everywhere. It reproduces python 3's round,
+# i.e. halves are rounded to the nearest even integer, so the parallel
+# kernels give exactly the same search boxes as the old serial ones.
 
 ctypedef np.uint16_t uint16_t
 
+# The kernels accept spots images of any of these types, so that frames
+# can be passed straight from the camera driver without an astype copy.
+# Dark images are always int16.
+ctypedef fused pixel_t:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+
+# placeholder for the dark image view when no dark image is given; it is
+# never read
+cdef np.ndarray no_dark_image = np.zeros((1,1),dtype=np.int16)
+
+# Function raster_order:
+# returns the indices of the search boxes sorted by (rounded) row and then
+# by column, so that the threads in compute_centroids step through the
+# image the way it is laid out in memory, one row of lenslets at a time;
+# search boxes are usually already in this order, in which case the
+# sort is skipped. The kernels are called every frame with the same
+# search boxes, so the last order is kept, with copies of the coordinates
+# it was computed from, and returned again, without allocating, while the
+# coordinates are unchanged.
+raster_order_cache = None
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef bint same_coordinates(double [:] a, double [:] b):
+    cdef Py_ssize_t k
+    if a.shape[0]!=b.shape[0]:
+        return False
+    for k in range(a.shape[0]):
+        if a[k]!=b[k]:
+            return False
+    return True
+
+def raster_order(sb_x_vec,sb_y_vec):
+    global raster_order_cache
+    cache = raster_order_cache
+    if cache is not None and same_coordinates(cache[0],sb_x_vec) and same_coordinates(cache[1],sb_y_vec):
+        return cache[2]
+    rows = np.round(sb_y_vec)
+    drows = np.diff(rows)
+    if np.all((drows>0) | ((drows==0) & (np.diff(sb_x_vec)>=0))):
+        order = np.arange(len(sb_x_vec),dtype=np.intp)
+    else:
+        order = np.lexsort((sb_x_vec,rows)).astype(np.intp)
+    raster_order_cache = (np.array(sb_x_vec,dtype=np.float64),np.array(sb_y_vec,dtype=np.float64),order)
+    return order
+
+@cython.cdivision(True)
+cdef inline long iround(double value) nogil:
+    cdef double lower = floor(value)
+    cdef double remainder = value-lower
+    cdef long out = <long>lower
+    if remainder>0.5:
+        out = out+1
+    elif remainder==0.5 and out%2!=0:
+        out = out+1
+    return out
+
 # Function compute_centroids:
 # this function takes the following arguments:
-# 1. spots_image (int array): the spots image
+# 1. spots_image (uint8, uint16, or int16 array): the spots image
 # 2. sb_x_vec (float array): the x coordinates of search box centers
 # 3. sb_y_vec (float array): the y coordinates of search box centers
 # 4. sb_bg_vec (float array): the background values for each search box
@@ -46,13 +98,12 @@ ctypedef np.uint16_t uint16_t
 #    search box's mean intensity
 # 11. maximum_intensity (float array): (ditto)
 # 12. minimum_intensity (float array): (ditto)
-# 13. num_threads (integer): number of threads to use; currently not
-#     implemented because it doesn't improve speed. Use of prange may
-#     not be optimal way to thread this.
+# 13. num_threads (integer): number of OpenMP threads over which the
+#     spots are divided (see ciao_config.centroiding_num_threads)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
+cpdef compute_centroids(pixel_t [:,:] spots_image,
                         np.ndarray[np.float_t,ndim=1] sb_x_vec,
                         np.ndarray[np.float_t,ndim=1] sb_y_vec,
                         np.ndarray[np.float_t,ndim=1] sb_bg_vec,
@@ -66,35 +117,25 @@ cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
                         np.ndarray[np.float_t,ndim=1] minimum_intensity,
                         num_threads_p = 1):
 
+    # typed memoryviews, so that the spots can be processed in a
+    # 'with nogil:' context
+    cdef pixel_t [:,:] spots_image_view = spots_image
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef double [:] sb_bg_vec_view = sb_bg_vec
+    cdef double [:] x_out_view = x_out
+    cdef double [:] y_out_view = y_out
+    cdef double [:] mean_intensity_view = mean_intensity
+    cdef double [:] maximum_intensity_view = maximum_intensity
+    cdef double [:] minimum_intensity_view = minimum_intensity
 
-    cdef np.int_t n_spots = len(sb_x_vec)
-    cdef np.int_t num_threads = int(num_threads_p)
-    cdef np.int_t iterations = int(iterations_p)
-    cdef np.int_t iteration_step_px = int(iteration_step_px_p)
-    cdef np.int_t sb_half_width = int(sb_half_width_p)
-
-    cdef np.float_t intensity
-    cdef np.float_t background
-    cdef np.float_t xprod
-    cdef np.float_t yprod
-    cdef np.int_t x
-    cdef np.int_t x1
-    cdef np.int_t x2
-    cdef np.int_t y
-    cdef np.int_t y1
-    cdef np.int_t y2
-    cdef np.int_t sy
-    cdef np.int_t sx
-    cdef np.int_t half_width
-    cdef np.float_t imax
-    cdef np.float_t imin
-    cdef np.float_t pixel
-    cdef np.float_t counter
-    cdef np.int_t k_iteration
-    cdef np.int_t k_spot
-
-    sy = spots_image.shape[0]
-    sx = spots_image.shape[1]
+    cdef int n_spots = len(sb_x_vec)
+    cdef int num_threads = max(1,int(num_threads_p))
+    cdef long iterations = int(iterations_p)
+    cdef long iteration_step_px = int(iteration_step_px_p)
+    cdef long sb_half_width = int(sb_half_width_p)
+    cdef int k_spot
+    cdef int k_order
+    cdef np.intp_t [:] spot_order = raster_order(sb_x_vec,sb_y_vec)
 
     # Populate x_out,y_out with the sb centers, for starters; this allows
     # us to use the out arrays as places to both read the current sb center
@@ -106,66 +147,116 @@ cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
     x_out[:] = sb_x_vec[:]
     y_out[:] = sb_y_vec[:]
 
-    # first, we iterate through the number of iterations
-    for k_iteration in range(0,iterations):
+    # Each spot's iterations only depend on that spot's previous center of
+    # mass, so the spots are independent and can be divided among threads;
+    # the iterations are done inside centroid_spot.
+    for k_order in prange(n_spots,nogil=True,schedule='static',num_threads=num_threads):
+        k_spot = spot_order[k_order]
+        centroid_spot(spots_image_view,dark_image_view,0,k_spot,
+                      sb_bg_vec_view[k_spot],sb_half_width,iterations,
+                      iteration_step_px,x_out_view,y_out_view,
+                      mean_intensity_view,maximum_intensity_view,
+                      minimum_intensity_view)
 
-        for k_spot in range(n_spots):
 
-            imin = 2**15
-            imax = -2**15
-            xprod = 0.0
-            yprod = 0.0
-            intensity = 0.0
-            counter = 0.0
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void centroid_spot(pixel_t [:,:] spots_image,
+                        short [:,:] dark_image,
+                        int use_dark,
+                        int k_spot,
+                        double background,
+                        long sb_half_width,
+                        long iterations,
+                        long iteration_step_px,
+                        double [:] x_out,
+                        double [:] y_out,
+                        double [:] mean_intensity,
+                        double [:] maximum_intensity,
+                        double [:] minimum_intensity) nogil:
 
-            x1 = int(round(x_out[k_spot]))-sb_half_width+k_iteration*iteration_step_px
-            x2 = int(round(x_out[k_spot]))+sb_half_width-k_iteration*iteration_step_px
-            y1 = int(round(y_out[k_spot]))-sb_half_width+k_iteration*iteration_step_px
-            y2 = int(round(y_out[k_spot]))+sb_half_width-k_iteration*iteration_step_px
+    cdef double intensity
+    cdef double xprod
+    cdef double yprod
+    cdef double row_intensity
+    cdef double row_xprod
+    cdef long x
+    cdef long x1
+    cdef long x2
+    cdef long y
+    cdef long y1
+    cdef long y2
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef double imax
+    cdef double imin
+    cdef double pixel
+    cdef double counter
+    cdef long k_iteration
 
-            if x1<0 or x2>sx-1 or y1<0 or y2>sy-1:
-                printf("Search box x=(%ld,%ld),y=(%ld,%ld) extends beyond image edge. Possibly search box width too large.\n",x1,x2,y1,y2)
-                #exit(0)
+    for k_iteration in range(0,iterations):
 
-            if x1>=x2 or y1>=y2:
-                printf("Search box x=(%ld,%ld),y=(%ld,%ld) too small. Possibly search box width too large, number of iterations too high, or iteration step size too high.\n",x1,x2,y1,y2)
-                #exit(0)
+        imin = 2**16
+        imax = -2**15
+        xprod = 0.0
+        yprod = 0.0
+        intensity = 0.0
+        counter = 0.0
 
-            background = sb_bg_vec[k_spot]
-            #printf("background=%0.1f\n",background)
-                    
+        x1 = iround(x_out[k_spot])-sb_half_width+k_iteration*iteration_step_px
+        x2 = iround(x_out[k_spot])+sb_half_width-k_iteration*iteration_step_px
+        y1 = iround(y_out[k_spot])-sb_half_width+k_iteration*iteration_step_px
+        y2 = iround(y_out[k_spot])+sb_half_width-k_iteration*iteration_step_px
+
+        if x1<0 or x2>sx-1 or y1<0 or y2>sy-1:
+            printf("Search box x=(%ld,%ld),y=(%ld,%ld) extends beyond image edge. Possibly search box width too large.\n",x1,x2,y1,y2)
+
+        if x1>=x2 or y1>=y2:
+            printf("Search box x=(%ld,%ld),y=(%ld,%ld) too small. Possibly search box width too large, number of iterations too high, or iteration step size too high.\n",x1,x2,y1,y2)
+
+        # rows outermost, so that the C-ordered image is read along its
+        # rows rather than down its columns; this also lets the y moment
+        # be accumulated once per row instead of once per pixel
+        for y in range(y1,y2+1):
+            row_intensity = 0.0
+            row_xprod = 0.0
             for x in range(x1,x2+1):
-                for y in range(y1,y2+1):
-
-                    # not sure if it's better to cast with python's float()
-                    # or c's <float>:
-                    pixel = float(spots_image[y,x])-background
-                    
-                    if pixel<0.0:
-                        pixel = 0.0
-                    xprod = xprod + pixel*x
-                    yprod = yprod + pixel*y
-                    intensity = intensity + pixel
-                    if pixel<imin:
-                        imin = pixel
-                    elif pixel>imax:
-                        imax = pixel
-                    counter = counter + 1.0
-
-            if intensity==0 or xprod==0 or yprod==0:
-                printf("Warning: search box intensity low; skipping.\n")
-                continue
 
-            mean_intensity[k_spot] = intensity/counter
-            maximum_intensity[k_spot] = imax
-            minimum_intensity[k_spot] = imin
-            x_out[k_spot] = xprod/intensity
-            y_out[k_spot] = yprod/intensity
+                # the dark image, if any, is subtracted in int, as
+                # numpy would do it on the whole image
+                if use_dark:
+                    pixel = <double>(spots_image[y,x]-dark_image[y,x])-background
+                else:
+                    pixel = <double>spots_image[y,x]-background
+
+                if pixel<0.0:
+                    pixel = 0.0
+                row_xprod = row_xprod + pixel*x
+                row_intensity = row_intensity + pixel
+                if pixel<imin:
+                    imin = pixel
+                elif pixel>imax:
+                    imax = pixel
+            xprod = xprod + row_xprod
+            yprod = yprod + row_intensity*y
+            intensity = intensity + row_intensity
+        counter = <double>((x2-x1+1)*(y2-y1+1))
+
+        if intensity==0 or xprod==0 or yprod==0:
+            printf("Warning: search box intensity low; skipping.\n")
+            continue
+
+        mean_intensity[k_spot] = intensity/counter
+        maximum_intensity[k_spot] = imax
+        minimum_intensity[k_spot] = imin
+        x_out[k_spot] = xprod/intensity
+        y_out[k_spot] = yprod/intensity
 
             
 # Function estimate_backgrounds:
 # this function takes the following arguments:
-# 1. spots_image (int array): the spots image
+# 1. spots_image (uint8, uint16, or int16 array): the spots image
 # 2. sb_x_vec (float array): the x coordinates of search box centers
 # 3. sb_y_vec (float array): the y coordinates of search box centers
 # 4. sb_bg_vec (float array): array for writing output
@@ -174,7 +265,7 @@ cpdef compute_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef estimate_backgrounds(np.ndarray[np.int16_t,ndim=2] spots_image,
+cpdef estimate_backgrounds(pixel_t [:,:] spots_image,
                            np.ndarray[np.float_t,ndim=1] sb_x_vec,
                            np.ndarray[np.float_t,ndim=1] sb_y_vec,
                            np.ndarray[np.float_t,ndim=1] sb_bg_vec,
@@ -227,10 +318,539 @@ cpdef estimate_backgrounds(np.ndarray[np.int16_t,ndim=2] spots_image,
         sb_bg_vec[k_spot] = intensity/counter
 
 
+# Function compute_centroids_with_backgrounds:
+# this function combines estimate_backgrounds and compute_centroids, so
+# that each search box is brought into cache once per frame instead of
+# once per function; its arguments are the same as those of
+# compute_centroids, with the following changes:
+# 4. sb_bg_vec (float array): array for writing the estimated
+#    backgrounds (including background_correction); if
+#    estimate_background is 0, it is read instead, as in
+#    compute_centroids
+# 6. background_correction (float): added to each edge estimate, as
+#    described in ciao_config.py
+# 15. estimate_background (integer): 1 to estimate each box's background
+#     from its edge pixels, as estimate_backgrounds does, 0 to use the
+#     values already in sb_bg_vec
+# 17. dark_image (int array or None): if given, it is subtracted from
+#     spots_image on the fly, only for pixels inside the search boxes,
+#     which avoids allocating a dark-subtracted copy of the whole frame
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef fast_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
+cpdef compute_centroids_with_backgrounds(pixel_t [:,:] spots_image,
+                                         np.ndarray[np.float_t,ndim=1] sb_x_vec,
+                                         np.ndarray[np.float_t,ndim=1] sb_y_vec,
+                                         np.ndarray[np.float_t,ndim=1] sb_bg_vec,
+                                         sb_half_width_p,
+                                         background_correction_p,
+                                         iterations_p,
+                                         iteration_step_px_p,
+                                         np.ndarray[np.float_t,ndim=1] x_out,
+                                         np.ndarray[np.float_t,ndim=1] y_out,
+                                         np.ndarray[np.float_t,ndim=1] mean_intensity,
+                                         np.ndarray[np.float_t,ndim=1] maximum_intensity,
+                                         np.ndarray[np.float_t,ndim=1] minimum_intensity,
+                                         estimate_background_p = 1,
+                                         num_threads_p = 1,
+                                         dark_image = None):
+
+    cdef pixel_t [:,:] spots_image_view = spots_image
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef int use_dark = 0
+    cdef double [:] sb_bg_vec_view = sb_bg_vec
+    cdef double [:] x_out_view = x_out
+    cdef double [:] y_out_view = y_out
+    cdef double [:] mean_intensity_view = mean_intensity
+    cdef double [:] maximum_intensity_view = maximum_intensity
+    cdef double [:] minimum_intensity_view = minimum_intensity
+
+    cdef int n_spots = len(sb_x_vec)
+    cdef int num_threads = max(1,int(num_threads_p))
+    cdef long iterations = int(iterations_p)
+    cdef long iteration_step_px = int(iteration_step_px_p)
+    cdef long sb_half_width = int(sb_half_width_p)
+    cdef double background_correction = float(background_correction_p)
+    cdef int estimate_background = int(estimate_background_p)
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef long x1
+    cdef long x2
+    cdef long y1
+    cdef long y2
+    cdef int k_spot
+    cdef int k_order
+    cdef np.intp_t [:] spot_order = raster_order(sb_x_vec,sb_y_vec)
+
+    if dark_image is not None:
+        assert dark_image.shape[0]==sy and dark_image.shape[1]==sx
+        dark_image_view = dark_image
+        use_dark = 1
+
+    x_out[:] = sb_x_vec[:]
+    y_out[:] = sb_y_vec[:]
+
+    for k_order in prange(n_spots,nogil=True,schedule='static',num_threads=num_threads):
+        k_spot = spot_order[k_order]
+        if estimate_background:
+            x1 = iround(x_out_view[k_spot])-sb_half_width
+            x2 = iround(x_out_view[k_spot])+sb_half_width
+            y1 = iround(y_out_view[k_spot])-sb_half_width
+            y2 = iround(y_out_view[k_spot])+sb_half_width
+            if x1<0 or x2>sx-1 or y1<0 or y2>sy-1 or x1>=x2 or y1>=y2:
+                printf("Search box x=(%ld,%ld),y=(%ld,%ld) not valid for background estimation; skipping.\n",x1,x2,y1,y2)
+                continue
+            sb_bg_vec_view[k_spot] = edge_background(spots_image_view,dark_image_view,use_dark,
+                                                     x1,x2,y1,y2)+background_correction
+
+        # the search box of the first iteration is the one whose edges
+        # were just read, so it is still in cache
+        centroid_spot(spots_image_view,dark_image_view,use_dark,k_spot,
+                      sb_bg_vec_view[k_spot],sb_half_width,iterations,
+                      iteration_step_px,x_out_view,y_out_view,
+                      mean_intensity_view,maximum_intensity_view,
+                      minimum_intensity_view)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double edge_background(pixel_t [:,:] spots_image,
+                            short [:,:] dark_image,
+                            int use_dark,
+                            long x1,
+                            long x2,
+                            long y1,
+                            long y2) nogil:
+
+    # average of the pixels on the search box's edges, summed in the
+    # same order as estimate_backgrounds (corners are counted twice)
+    cdef double intensity = 0.0
+    cdef double counter = 0.0
+    cdef long x
+    cdef long y
+
+    if use_dark:
+        for x in range(x1,x2+1):
+            intensity = (intensity + <double>(spots_image[y1,x]-dark_image[y1,x])
+                         + <double>(spots_image[y2,x]-dark_image[y2,x]))
+            counter = counter + 2.0
+        for y in range(y1,y2+1):
+            intensity = (intensity + <double>(spots_image[y,x1]-dark_image[y,x1])
+                         + <double>(spots_image[y,x2]-dark_image[y,x2]))
+            counter = counter + 2.0
+    else:
+        for x in range(x1,x2+1):
+            intensity = intensity + <double>spots_image[y1,x] + <double>spots_image[y2,x]
+            counter = counter + 2.0
+        for y in range(y1,y2+1):
+            intensity = intensity + <double>spots_image[y,x1] + <double>spots_image[y,x2]
+            counter = counter + 2.0
+
+    return intensity/counter
+
+
+# Function compute_centroids_stack:
+# this function runs compute_centroids_with_backgrounds on every frame
+# of a stack of frames sharing the same search boxes, e.g. the frames
+# recorded for a reference or a poke, or a logged sequence being
+# reprocessed offline; the threads divide the frames among themselves,
+# and each frame's spots are visited in raster order; its arguments are
+# the same as those of compute_centroids_with_backgrounds, with the
+# following changes:
+# 1. spots_stack (uint8, uint16, or int16 array): n_frames x height x
+#    width stack of spots images
+# 4. sb_bg_out (float array): n_frames x n_spots array for writing the
+#    estimated backgrounds, or, if estimate_background is 0, for reading
+#    them
+# 9-13. x_out, y_out, mean_intensity, maximum_intensity,
+#    minimum_intensity (float arrays): n_frames x n_spots arrays for
+#    writing the results of each frame
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef compute_centroids_stack(pixel_t [:,:,:] spots_stack,
+                              np.ndarray[np.float_t,ndim=1] sb_x_vec,
+                              np.ndarray[np.float_t,ndim=1] sb_y_vec,
+                              np.ndarray[np.float_t,ndim=2] sb_bg_out,
+                              sb_half_width_p,
+                              background_correction_p,
+                              iterations_p,
+                              iteration_step_px_p,
+                              np.ndarray[np.float_t,ndim=2] x_out,
+                              np.ndarray[np.float_t,ndim=2] y_out,
+                              np.ndarray[np.float_t,ndim=2] mean_intensity,
+                              np.ndarray[np.float_t,ndim=2] maximum_intensity,
+                              np.ndarray[np.float_t,ndim=2] minimum_intensity,
+                              estimate_background_p = 1,
+                              num_threads_p = 1,
+                              dark_image = None):
+
+    cdef pixel_t [:,:,:] spots_stack_view = spots_stack
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef int use_dark = 0
+    cdef double [:,:] sb_bg_out_view = sb_bg_out
+    cdef double [:,:] x_out_view = x_out
+    cdef double [:,:] y_out_view = y_out
+    cdef double [:,:] mean_intensity_view = mean_intensity
+    cdef double [:,:] maximum_intensity_view = maximum_intensity
+    cdef double [:,:] minimum_intensity_view = minimum_intensity
+
+    cdef int n_frames = spots_stack.shape[0]
+    cdef int n_spots = len(sb_x_vec)
+    cdef int num_threads = max(1,int(num_threads_p))
+    cdef long iterations = int(iterations_p)
+    cdef long iteration_step_px = int(iteration_step_px_p)
+    cdef long sb_half_width = int(sb_half_width_p)
+    cdef double background_correction = float(background_correction_p)
+    cdef int estimate_background = int(estimate_background_p)
+    cdef long sy = spots_stack.shape[1]
+    cdef long sx = spots_stack.shape[2]
+    cdef long x1
+    cdef long x2
+    cdef long y1
+    cdef long y2
+    cdef int k_frame
+    cdef int k_spot
+    cdef int k_order
+    cdef np.intp_t [:] spot_order = raster_order(sb_x_vec,sb_y_vec)
+
+    assert x_out.shape[0]==n_frames and x_out.shape[1]==n_spots
+    assert sb_bg_out.shape[0]==n_frames and sb_bg_out.shape[1]==n_spots
+
+    if dark_image is not None:
+        assert dark_image.shape[0]==sy and dark_image.shape[1]==sx
+        dark_image_view = dark_image
+        use_dark = 1
+
+    x_out[:,:] = sb_x_vec[None,:]
+    y_out[:,:] = sb_y_vec[None,:]
+
+    for k_frame in prange(n_frames,nogil=True,schedule='static',num_threads=num_threads):
+        for k_order in range(n_spots):
+            k_spot = spot_order[k_order]
+            if estimate_background:
+                x1 = iround(sb_x_vec[k_spot])-sb_half_width
+                x2 = iround(sb_x_vec[k_spot])+sb_half_width
+                y1 = iround(sb_y_vec[k_spot])-sb_half_width
+                y2 = iround(sb_y_vec[k_spot])+sb_half_width
+                if x1<0 or x2>sx-1 or y1<0 or y2>sy-1 or x1>=x2 or y1>=y2:
+                    printf("Search box x=(%ld,%ld),y=(%ld,%ld) not valid for background estimation; skipping.\n",x1,x2,y1,y2)
+                    continue
+                sb_bg_out_view[k_frame,k_spot] = edge_background(spots_stack_view[k_frame],dark_image_view,use_dark,
+                                                                 x1,x2,y1,y2)+background_correction
+
+            centroid_spot(spots_stack_view[k_frame],dark_image_view,use_dark,k_spot,
+                          sb_bg_out_view[k_frame,k_spot],sb_half_width,iterations,
+                          iteration_step_px,x_out_view[k_frame],y_out_view[k_frame],
+                          mean_intensity_view[k_frame],maximum_intensity_view[k_frame],
+                          minimum_intensity_view[k_frame])
+
+
+# Function compute_centroids_sat:
+# this function computes the same quantities as
+# compute_centroids_with_backgrounds, from summed-area tables (integral
+# images) of the intensity and of its x and y moments, built in a single
+# pass over the frame; after that, each box's edge background and each
+# iteration's intensity and moments are O(1) lookups, instead of
+# O(box area) sums, so it pays off with large search boxes and several
+# iterations; because the tables hold sums of the raw pixels, the
+# background is subtracted from each box sum as background x area, i.e.
+# pixels below the background are not clamped at zero as in
+# centroid_spot, so the results differ slightly from those of the other
+# kernels; its arguments are the same as those of
+# compute_centroids_with_backgrounds, with the following additions:
+# 17. box_extrema (integer): 1 to scan each spot's last box for its
+#     maximum and minimum (background subtracted and clamped at zero, as
+#     in centroid_spot), which the tables can't provide, 0 to leave
+#     maximum_intensity and minimum_intensity untouched
+# 18. sat_buffer (float array or None): 3 x (height+1) x (width+1)
+#     array in which to build the tables; if None, one is allocated on
+#     every call
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef compute_centroids_sat(pixel_t [:,:] spots_image,
+                            np.ndarray[np.float_t,ndim=1] sb_x_vec,
+                            np.ndarray[np.float_t,ndim=1] sb_y_vec,
+                            np.ndarray[np.float_t,ndim=1] sb_bg_vec,
+                            sb_half_width_p,
+                            background_correction_p,
+                            iterations_p,
+                            iteration_step_px_p,
+                            np.ndarray[np.float_t,ndim=1] x_out,
+                            np.ndarray[np.float_t,ndim=1] y_out,
+                            np.ndarray[np.float_t,ndim=1] mean_intensity,
+                            np.ndarray[np.float_t,ndim=1] maximum_intensity,
+                            np.ndarray[np.float_t,ndim=1] minimum_intensity,
+                            estimate_background_p = 1,
+                            num_threads_p = 1,
+                            dark_image = None,
+                            box_extrema_p = 1,
+                            sat_buffer = None):
+
+    cdef pixel_t [:,:] spots_image_view = spots_image
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef int use_dark = 0
+    cdef double [:,:,:] sat
+    cdef double [:] sb_bg_vec_view = sb_bg_vec
+    cdef double [:] x_out_view = x_out
+    cdef double [:] y_out_view = y_out
+    cdef double [:] mean_intensity_view = mean_intensity
+    cdef double [:] maximum_intensity_view = maximum_intensity
+    cdef double [:] minimum_intensity_view = minimum_intensity
+
+    cdef int n_spots = len(sb_x_vec)
+    cdef int num_threads = max(1,int(num_threads_p))
+    cdef long iterations = int(iterations_p)
+    cdef long iteration_step_px = int(iteration_step_px_p)
+    cdef long sb_half_width = int(sb_half_width_p)
+    cdef double background_correction = float(background_correction_p)
+    cdef int estimate_background = int(estimate_background_p)
+    cdef int box_extrema = int(box_extrema_p)
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef int k_spot
+    cdef int k_order
+    cdef np.intp_t [:] spot_order = raster_order(sb_x_vec,sb_y_vec)
+
+    if dark_image is not None:
+        assert dark_image.shape[0]==sy and dark_image.shape[1]==sx
+        dark_image_view = dark_image
+        use_dark = 1
+
+    if sat_buffer is None:
+        sat_buffer = np.empty((3,sy+1,sx+1),dtype=np.float64)
+    assert sat_buffer.shape[0]==3 and sat_buffer.shape[1]==sy+1 and sat_buffer.shape[2]==sx+1
+    sat = sat_buffer
+
+    x_out[:] = sb_x_vec[:]
+    y_out[:] = sb_y_vec[:]
+
+    build_summed_area_tables(spots_image_view,dark_image_view,use_dark,sat,num_threads)
+
+    for k_order in prange(n_spots,nogil=True,schedule='static',num_threads=num_threads):
+        k_spot = spot_order[k_order]
+        sat_centroid_spot(spots_image_view,dark_image_view,use_dark,sat,k_spot,
+                          estimate_background,background_correction,
+                          sb_half_width,iterations,iteration_step_px,box_extrema,
+                          sb_bg_vec_view,x_out_view,y_out_view,
+                          mean_intensity_view,maximum_intensity_view,
+                          minimum_intensity_view)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void build_summed_area_tables(pixel_t [:,:] spots_image,
+                                   short [:,:] dark_image,
+                                   int use_dark,
+                                   double [:,:,:] sat,
+                                   int num_threads) nogil:
+
+    # sat[0,y,x] is the sum of the pixels above and to the left of (y,x),
+    # exclusive, and sat[1] and sat[2] the same sums weighted by x and by
+    # y; the first row and column are zero; the sums are of integers, so
+    # they are exact in double precision
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef long x
+    cdef long y
+    cdef long x1
+    cdef long x2
+    cdef long k_chunk
+    cdef long chunk_width = (sx+1+num_threads-1)//num_threads
+    cdef double pixel
+    cdef double row_intensity
+    cdef double row_xprod
+    cdef double row_yprod
+
+    for x in range(sx+1):
+        sat[0,0,x] = 0.0
+        sat[1,0,x] = 0.0
+        sat[2,0,x] = 0.0
+
+    # with one thread, each row is built from its running sums and the
+    # row above it, which is still in cache, in a single pass
+    if num_threads==1:
+        for y in range(sy):
+            row_intensity = 0.0
+            row_xprod = 0.0
+            row_yprod = 0.0
+            sat[0,y+1,0] = 0.0
+            sat[1,y+1,0] = 0.0
+            sat[2,y+1,0] = 0.0
+            for x in range(sx):
+                if use_dark:
+                    pixel = <double>(spots_image[y,x]-dark_image[y,x])
+                else:
+                    pixel = <double>spots_image[y,x]
+                row_intensity = row_intensity + pixel
+                row_xprod = row_xprod + pixel*x
+                row_yprod = row_yprod + pixel*y
+                sat[0,y+1,x+1] = sat[0,y,x+1]+row_intensity
+                sat[1,y+1,x+1] = sat[1,y,x+1]+row_xprod
+                sat[2,y+1,x+1] = sat[2,y,x+1]+row_yprod
+        return
+
+    # otherwise, first the cumulative sums along each row, which are
+    # independent
+    for y in prange(sy,schedule='static',num_threads=num_threads):
+        row_intensity = 0.0
+        row_xprod = 0.0
+        row_yprod = 0.0
+        sat[0,y+1,0] = 0.0
+        sat[1,y+1,0] = 0.0
+        sat[2,y+1,0] = 0.0
+        for x in range(sx):
+            if use_dark:
+                pixel = <double>(spots_image[y,x]-dark_image[y,x])
+            else:
+                pixel = <double>spots_image[y,x]
+            row_intensity = row_intensity + pixel
+            row_xprod = row_xprod + pixel*x
+            row_yprod = row_yprod + pixel*y
+            sat[0,y+1,x+1] = row_intensity
+            sat[1,y+1,x+1] = row_xprod
+            sat[2,y+1,x+1] = row_yprod
+
+    # then down the columns; each thread takes a band of columns, and
+    # walks it row by row, so that it reads the tables along their rows
+    for k_chunk in prange(num_threads,schedule='static',num_threads=num_threads):
+        x1 = k_chunk*chunk_width
+        x2 = x1+chunk_width
+        if x2>sx+1:
+            x2 = sx+1
+        for y in range(1,sy):
+            for x in range(x1,x2):
+                sat[0,y+1,x] = sat[0,y+1,x]+sat[0,y,x]
+                sat[1,y+1,x] = sat[1,y+1,x]+sat[1,y,x]
+                sat[2,y+1,x] = sat[2,y+1,x]+sat[2,y,x]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double box_sum(double [:,:,:] sat,
+                           int k_table,
+                           long x1,
+                           long x2,
+                           long y1,
+                           long y2) nogil:
+    # sum over the inclusive box [x1,x2] x [y1,y2]
+    return (sat[k_table,y2+1,x2+1]-sat[k_table,y1,x2+1]
+            -sat[k_table,y2+1,x1]+sat[k_table,y1,x1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void sat_centroid_spot(pixel_t [:,:] spots_image,
+                            short [:,:] dark_image,
+                            int use_dark,
+                            double [:,:,:] sat,
+                            int k_spot,
+                            int estimate_background,
+                            double background_correction,
+                            long sb_half_width,
+                            long iterations,
+                            long iteration_step_px,
+                            int box_extrema,
+                            double [:] sb_bg_vec,
+                            double [:] x_out,
+                            double [:] y_out,
+                            double [:] mean_intensity,
+                            double [:] maximum_intensity,
+                            double [:] minimum_intensity) nogil:
+
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef long x1
+    cdef long x2
+    cdef long y1
+    cdef long y2
+    cdef long last_x1 = -1
+    cdef long last_x2 = -1
+    cdef long last_y1 = -1
+    cdef long last_y2 = -1
+    cdef long x
+    cdef long y
+    cdef long k_iteration
+    cdef double counter
+    cdef double background
+    cdef double intensity
+    cdef double xprod
+    cdef double yprod
+    cdef double pixel
+    cdef double imax
+    cdef double imin
+
+    x1 = iround(x_out[k_spot])-sb_half_width
+    x2 = iround(x_out[k_spot])+sb_half_width
+    y1 = iround(y_out[k_spot])-sb_half_width
+    y2 = iround(y_out[k_spot])+sb_half_width
+    if x1<0 or x2>sx-1 or y1<0 or y2>sy-1 or x1>=x2 or y1>=y2:
+        printf("Search box x=(%ld,%ld),y=(%ld,%ld) not valid; skipping.\n",x1,x2,y1,y2)
+        return
+
+    if estimate_background:
+        # the box's edges, with the corners counted twice, as in
+        # edge_background
+        intensity = (box_sum(sat,0,x1,x2,y1,y1)+box_sum(sat,0,x1,x2,y2,y2)+
+                     box_sum(sat,0,x1,x1,y1,y2)+box_sum(sat,0,x2,x2,y1,y2))
+        counter = <double>(2*(x2-x1+1)+2*(y2-y1+1))
+        sb_bg_vec[k_spot] = intensity/counter+background_correction
+    background = sb_bg_vec[k_spot]
+
+    for k_iteration in range(0,iterations):
+        x1 = iround(x_out[k_spot])-sb_half_width+k_iteration*iteration_step_px
+        x2 = iround(x_out[k_spot])+sb_half_width-k_iteration*iteration_step_px
+        y1 = iround(y_out[k_spot])-sb_half_width+k_iteration*iteration_step_px
+        y2 = iround(y_out[k_spot])+sb_half_width-k_iteration*iteration_step_px
+
+        # unlike centroid_spot, a box outside the image can't be read
+        # past its edge, since the tables would be indexed out of bounds
+        if x1<0 or x2>sx-1 or y1<0 or y2>sy-1 or x1>=x2 or y1>=y2:
+            printf("Search box x=(%ld,%ld),y=(%ld,%ld) extends beyond image edge or is too small; stopping iterations.\n",x1,x2,y1,y2)
+            break
+
+        counter = <double>((x2-x1+1)*(y2-y1+1))
+        intensity = box_sum(sat,0,x1,x2,y1,y2)-background*counter
+        xprod = box_sum(sat,1,x1,x2,y1,y2)-background*counter*0.5*(x1+x2)
+        yprod = box_sum(sat,2,x1,x2,y1,y2)-background*counter*0.5*(y1+y2)
+
+        if intensity<=0 or xprod==0 or yprod==0:
+            printf("Warning: search box intensity low; skipping.\n")
+            continue
+
+        mean_intensity[k_spot] = intensity/counter
+        x_out[k_spot] = xprod/intensity
+        y_out[k_spot] = yprod/intensity
+        last_x1 = x1
+        last_x2 = x2
+        last_y1 = y1
+        last_y2 = y2
+
+    if box_extrema and last_x1>=0:
+        imin = 2**16
+        imax = -2**15
+        for y in range(last_y1,last_y2+1):
+            for x in range(last_x1,last_x2+1):
+                if use_dark:
+                    pixel = <double>(spots_image[y,x]-dark_image[y,x])-background
+                else:
+                    pixel = <double>spots_image[y,x]-background
+                if pixel<0.0:
+                    pixel = 0.0
+                if pixel<imin:
+                    imin = pixel
+                if pixel>imax:
+                    imax = pixel
+        maximum_intensity[k_spot] = imax
+        minimum_intensity[k_spot] = imin
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef fast_centroids(pixel_t [:,:] spots_image,
                      np.ndarray[np.float_t,ndim=1] sb_x_vec,
                      np.ndarray[np.float_t,ndim=1] sb_y_vec,
                      sb_half_width_p,
@@ -240,11 +860,14 @@ cpdef fast_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
                      np.ndarray[np.float_t,ndim=1] sb_max_vec,
                      np.ndarray[np.int16_t,ndim=1] valid_vec,
                      verbose_p = 0,
-                     num_threads_p = 1):
+                     num_threads_p = 1,
+                     dark_image = None,
+                     tracking_half_width_p = 0,
+                     tracking_max_fraction_p = 0.5):
 
     """Function fast_centroids:
     this function takes the following arguments:
-    1. spots_image (int array): the spots image
+    1. spots_image (uint8, uint16, or int16 array): the spots image
     2. sb_x_vec (float array): the x coordinates of search box centers
     3. sb_y_vec (float array): the y coordinates of search box centers
     4. sb_half_width_p (integer): if the width of the search box (inclusive)
@@ -262,41 +885,86 @@ cpdef fast_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
        the validity of a centroid is recorded; on output 0 means the
        measurement was invalid, and 1 means valid
     10. verbose (integer): determines verbosity of debugging messages
-    11. num_threads (integer): number of threads to use; currently not
-        implemented."""
+    11. num_threads (integer): number of OpenMP threads over which the
+        spots are divided.
+    12. dark_image (int array or None): if given, it is subtracted from
+        spots_image on the fly, inside the search boxes only.
+    13. tracking_half_width (integer): if greater than 0, spots that were
+        valid on the previous call are tracked: the maximum is searched
+        for only within this half width of the previous centroid (still
+        in x_out and y_out), instead of in the whole search box
+    14. tracking_max_fraction (float): a tracked spot is considered lost,
+        and its whole search box is searched, if its maximum falls below
+        this fraction of the previous call's maximum (still in
+        sb_max_vec), or if the maximum lies on the edge of the tracking
+        window, where the true peak may be just outside it."""
 
-    cdef int sy
-    cdef int sx
-    
-    sy = spots_image.shape[0]
-    sx = spots_image.shape[1]
-    
     # expose memory location of all numpy arrays using typed memoryviews
     # this improves speed because it removes numpy overhead, and more
     # importantly it's required for parallelism because we need to put
     # prange in a 'with nogil:' context
-    cdef short [:,:] spots_image_view = spots_image
+    cdef pixel_t [:,:] spots_image_view = spots_image
     cdef double [:] sb_x_vec_view = sb_x_vec
     cdef double [:] sb_y_vec_view = sb_y_vec
     cdef double [:] x_out_view = x_out
     cdef double [:] y_out_view = y_out
     cdef double [:] sb_max_vec_view = sb_max_vec
     cdef short [:] valid_vec_view = valid_vec
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef int use_dark = 0
     
     cdef int n_spots = len(sb_x_vec)
     cdef int spot_index
     cdef int sb_half_width_c = sb_half_width_p
     cdef int centroiding_half_width_c = centroiding_half_width_p
     cdef int verbose_c = verbose_p
-    
-    # declare some variables for the inner loops; don't forget to initialize
-    # on every iteration
+    cdef int num_threads = max(1,int(num_threads_p))
+    cdef int tracking_half_width_c = max(0,int(tracking_half_width_p))
+    cdef double tracking_max_fraction_c = float(tracking_max_fraction_p)
+
+    if dark_image is not None:
+        assert dark_image.shape[0]==spots_image.shape[0] and dark_image.shape[1]==spots_image.shape[1]
+        dark_image_view = dark_image
+        use_dark = 1
+
+    for spot_index in prange(n_spots,nogil=True,schedule='static',num_threads=num_threads):
+        fast_centroid_spot(spots_image_view,dark_image_view,use_dark,spot_index,
+                           sb_x_vec_view[spot_index],sb_y_vec_view[spot_index],
+                           sb_half_width_c,centroiding_half_width_c,
+                           tracking_half_width_c,tracking_max_fraction_c,
+                           x_out_view,y_out_view,sb_max_vec_view,
+                           valid_vec_view,verbose_c)
+            
+    return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void fast_centroid_spot(pixel_t [:,:] spots_image,
+                             short [:,:] dark_image,
+                             int use_dark,
+                             int spot_index,
+                             double sb_x,
+                             double sb_y,
+                             int sb_half_width_c,
+                             int centroiding_half_width_c,
+                             int tracking_half_width_c,
+                             double tracking_max_fraction_c,
+                             double [:] x_out,
+                             double [:] y_out,
+                             double [:] sb_max_vec,
+                             short [:] valid_vec,
+                             int verbose_c) nogil:
+
+    cdef int sy = spots_image.shape[0]
+    cdef int sx = spots_image.shape[1]
+
     cdef int y
     cdef int x
-    cdef int max_y
-    cdef int max_x
-    cdef int current_max
-    cdef short pixel
+    cdef int max_y = 0
+    cdef int max_x = 0
+    cdef int current_max = -2**16+1
+    cdef int pixel
 
     cdef int x1
     cdef int x2
@@ -307,100 +975,171 @@ cpdef fast_centroids(np.ndarray[np.int16_t,ndim=2] spots_image,
     cdef double ynum
     cdef double denom
 
-    # first we have to iterate through the spots; do this without the gil, for
-    # future parallelization
-    #with nogil:
-    # changed this for the time being to prevent linking errors in windows due
-    # to 32-bit libc.math.round being incompatile with 64 bit python. Replacing
-    # 'with nogil:' with 'if True:' to avoid having to unindent everything after.
-    if True:
-        # For parallel version change range to prange
-        for spot_index in range(n_spots):
-            current_max = -2**16+1
-
-            # This is how we have to do it if we want nogil and parallelism:
-            #x1 = <int>c_round(sb_x_vec_view[spot_index]-sb_half_width_c)
-            #x2 = <int>c_round(sb_x_vec_view[spot_index]+sb_half_width_c)
-            #y1 = <int>c_round(sb_y_vec_view[spot_index]-sb_half_width_c)
-            #y2 = <int>c_round(sb_y_vec_view[spot_index]+sb_half_width_c)
-
-            # This is how we do it (with Python round) to avoid the Windows
-            # problem but this prevents parallelizing:
-            x1 = <int>round(sb_x_vec_view[spot_index]-sb_half_width_c)
-            x2 = <int>round(sb_x_vec_view[spot_index]+sb_half_width_c)
-            y1 = <int>round(sb_y_vec_view[spot_index]-sb_half_width_c)
-            y2 = <int>round(sb_y_vec_view[spot_index]+sb_half_width_c)
-
-            if verbose_c>0:
-                printf('cython A %d,%d,%d,%d,%d\n',spot_index,x1,x2,y1,y2)
-            
-            if (x1<0 or x2<0 or x1>sx-1 or x2>sx-1 or
-                y1<0 or y2<0 or y1>sy-1 or y2>sy-1):
-                printf('centroid.fast_centroids: search box coordinates x=[%d,%d], y=[%d,%d] not valid for spots image with size %dx%d. Check search_box_half_width.\n',x1,x2,y1,y2,sx,sy)
-                valid_vec_view[spot_index] = 0
-                x_out[spot_index] = -1
-                y_out[spot_index] = -1
-                break
-                
-            for y in range(y1,y2+1):
-                for x in range(x1,x2+1):
-                    pixel = spots_image_view[y,x]
+    cdef int tx1
+    cdef int tx2
+    cdef int ty1
+    cdef int ty2
+    cdef int tracked = 0
+
+    x1 = <int>iround(sb_x-sb_half_width_c)
+    x2 = <int>iround(sb_x+sb_half_width_c)
+    y1 = <int>iround(sb_y-sb_half_width_c)
+    y2 = <int>iround(sb_y+sb_half_width_c)
+
+    if verbose_c>0:
+        printf('cython A %d,%d,%d,%d,%d\n',spot_index,x1,x2,y1,y2)
+
+    # an invalid search box only invalidates its own spot; the serial
+    # version used to stop processing the remaining spots here
+    if (x1<0 or x2<0 or x1>sx-1 or x2>sx-1 or
+        y1<0 or y2<0 or y1>sy-1 or y2>sy-1):
+        printf('centroid.fast_centroids: search box coordinates x=[%d,%d], y=[%d,%d] not valid for spots image with size %dx%d. Check search_box_half_width.\n',x1,x2,y1,y2,sx,sy)
+        valid_vec[spot_index] = 0
+        x_out[spot_index] = -1
+        y_out[spot_index] = -1
+        return
+
+    # in tracking mode, look for the maximum near the previous centroid
+    # first, within the search box
+    if tracking_half_width_c>0 and valid_vec[spot_index]==1:
+        tx1 = iround(x_out[spot_index])-tracking_half_width_c
+        tx2 = iround(x_out[spot_index])+tracking_half_width_c
+        ty1 = iround(y_out[spot_index])-tracking_half_width_c
+        ty2 = iround(y_out[spot_index])+tracking_half_width_c
+        if tx1<x1:
+            tx1 = x1
+        if tx2>x2:
+            tx2 = x2
+        if ty1<y1:
+            ty1 = y1
+        if ty2>y2:
+            ty2 = y2
+        if tx1<tx2 and ty1<ty2:
+            for y in range(ty1,ty2+1):
+                for x in range(tx1,tx2+1):
+                    if use_dark:
+                        pixel = spots_image[y,x]-dark_image[y,x]
+                    else:
+                        pixel = spots_image[y,x]
                     if pixel>current_max:
                         current_max = pixel
                         max_y = y
                         max_x = x
+            tracked = (current_max>=tracking_max_fraction_c*sb_max_vec[spot_index] and
+                       (max_x>tx1 or tx1==x1) and (max_x<tx2 or tx2==x2) and
+                       (max_y>ty1 or ty1==y1) and (max_y<ty2 or ty2==y2))
+
+    # otherwise, or if the spot was lost, search the whole box
+    if not tracked:
+        current_max = -2**16+1
+        for y in range(y1,y2+1):
+            for x in range(x1,x2+1):
+                if use_dark:
+                    pixel = spots_image[y,x]-dark_image[y,x]
+                else:
+                    pixel = spots_image[y,x]
+                if pixel>current_max:
+                    current_max = pixel
+                    max_y = y
+                    max_x = x
 
-            sb_max_vec[spot_index] = current_max
+    sb_max_vec[spot_index] = current_max
 
-            # See note abouve about c_round vs round
-            # x1 = <int>c_round(max_x-centroiding_half_width_c)
-            # x2 = <int>c_round(max_x+centroiding_half_width_c)
-            # y1 = <int>c_round(max_y-centroiding_half_width_c)
-            # y2 = <int>c_round(max_y+centroiding_half_width_c)
+    x1 = max_x-centroiding_half_width_c
+    x2 = max_x+centroiding_half_width_c
+    y1 = max_y-centroiding_half_width_c
+    y2 = max_y+centroiding_half_width_c
 
-            # Using Python round instead of libc.math.round for
-            # windows compatibility
-            x1 = <int>round(max_x-centroiding_half_width_c)
-            x2 = <int>round(max_x+centroiding_half_width_c)
-            y1 = <int>round(max_y-centroiding_half_width_c)
-            y2 = <int>round(max_y+centroiding_half_width_c)
+    if verbose_c>0:
+        printf('cython B %d,%d,%d,%d,%d\n',spot_index,x1,x2,y1,y2)
 
-            if verbose_c>0:
-                printf('cython B %d,%d,%d,%d,%d\n',spot_index,x1,x2,y1,y2)
-            
-            if (x1<0 or x2<0 or x1>sx-1 or x2>sx-1 or
-                y1<0 or y2<0 or y1>sy-1 or y2>sy-1):
-                printf('centroid.fast_centroids: centroiding coordinates x=[%d,%d], y=[%d,%d] not valid for spots image with size %dx%d. Check centroiding_half_width.\n',x1,x2,y1,y2,sx,sy)
-                valid_vec_view[spot_index] = 0
-                x_out[spot_index] = -1
-                y_out[spot_index] = -1
+    if (x1<0 or x2<0 or x1>sx-1 or x2>sx-1 or
+        y1<0 or y2<0 or y1>sy-1 or y2>sy-1):
+        printf('centroid.fast_centroids: centroiding coordinates x=[%d,%d], y=[%d,%d] not valid for spots image with size %dx%d. Check centroiding_half_width.\n',x1,x2,y1,y2,sx,sy)
+        valid_vec[spot_index] = 0
+        x_out[spot_index] = -1
+        y_out[spot_index] = -1
+        return
+
+    xnum = 0.0
+    ynum = 0.0
+    denom = 0.0
+
+    for y in range(y1,y2+1):
+        for x in range(x1,x2+1):
+            if use_dark:
+                pixel = spots_image[y,x]-dark_image[y,x]
             else:
-                
-                xnum = 0.0
-                ynum = 0.0
-                denom = 0.0
-
-                #printf('box %d x=[%d,%d] y=[%d,%d]\n',spot_index,x1,x2,y1,y2)
-                for y in range(y1,y2+1):
-                    for x in range(x1,x2+1):
-                        pixel = spots_image_view[y,x]
-                        xnum = xnum + <double>(pixel*x)
-                        ynum = ynum + <double>(pixel*y)
-                        denom = denom + <double>pixel
-                        #printf('\t%d,%d,%0.2f,%0.2f,%0.2f\n',x,y,xnum,ynum,denom)
-
-                if denom>0:
-                    #printf('%f,%f,%f,\n',xnum,ynum,denom)
-                    x_out[spot_index] = xnum/denom
-                    y_out[spot_index] = ynum/denom
-                    #printf('%f,%f\n',x_out[spot_index],y_out[spot_index])
-                    #printf('\n')
-                    valid_vec[spot_index] = 1
+                pixel = spots_image[y,x]
+            xnum = xnum + <double>(pixel*x)
+            ynum = ynum + <double>(pixel*y)
+            denom = denom + <double>pixel
+
+    if denom>0:
+        x_out[spot_index] = xnum/denom
+        y_out[spot_index] = ynum/denom
+        valid_vec[spot_index] = 1
+    else:
+        printf('centroid.fast_centroids: centroiding coordinates x=[%d,%d], y=[%d,%d] produce search box with zero intensity. Check image.\n',x1,x2,y1,y2)
+        valid_vec[spot_index] = 0
+        x_out[spot_index] = -1
+        y_out[spot_index] = -1
+
+
+# Function image_statistics:
+# this function returns the minimum, mean, and maximum of the spots
+# image in a single pass, optionally with a dark image subtracted on
+# the fly; it takes the following arguments:
+# 1. spots_image (uint8, uint16, or int16 array): the spots image
+# 2. dark_image (int array or None): the dark image, or None
+# 3. stride (integer): only every stride-th pixel, in each dimension,
+#    is visited; the statistics are only used for display, so a stride
+#    of 2-4 is usually good enough and cuts the pixel reads by 4-16x
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef image_statistics(pixel_t [:,:] spots_image,
+                       dark_image = None,
+                       stride_p = 1):
+
+    cdef pixel_t [:,:] spots_image_view = spots_image
+    cdef short [:,:] dark_image_view = no_dark_image
+    cdef int use_dark = 0
+    cdef long stride = max(1,int(stride_p))
+    cdef long sy = spots_image.shape[0]
+    cdef long sx = spots_image.shape[1]
+    cdef long x
+    cdef long y
+    cdef long nx = (sx+stride-1)//stride
+    cdef long ny = (sy+stride-1)//stride
+    cdef long kx
+    cdef long ky
+    cdef int pixel
+    cdef int imin = 2**31-1
+    cdef int imax = -2**31
+    cdef double total = 0.0
+    cdef double counter = 0.0
+
+    if dark_image is not None:
+        assert dark_image.shape[0]==sy and dark_image.shape[1]==sx
+        dark_image_view = dark_image
+        use_dark = 1
+
+    with nogil:
+        for ky in range(ny):
+            y = ky*stride
+            for kx in range(nx):
+                x = kx*stride
+                if use_dark:
+                    pixel = spots_image_view[y,x]-dark_image_view[y,x]
                 else:
-                    printf('centroid.fast_centroids: centroiding coordinates x=[%d,%d], y=[%d,%d] produce search box with zero intensity. Check image.\n',x1,x2,y1,y2,sx,sy)
-                    valid_vec[spot_index] = 0
-                    x_out[spot_index] = -1
-                    y_out[spot_index] = -1
-        
-            
-    return 1
+                    pixel = spots_image_view[y,x]
+                if pixel<imin:
+                    imin = pixel
+                if pixel>imax:
+                    imax = pixel
+                total = total + pixel
+                counter = counter + 1.0
+
+    return imin,total/counter,imax
@@ -7,15 +7,23 @@ except ImportError:
     
 from Cython.Build import cythonize
 import numpy
+import sys
+
+# OpenMP is required for the prange loops in centroid.pyx; without it they
+# compile, but run serially.
+if sys.platform=='win32':
+    openmp_compile_args = ['/openmp']
+    openmp_link_args = []
+else:
+    openmp_compile_args = ['-fopenmp','-march=native']
+    openmp_link_args = ['-fopenmp','-march=native']
 
 ext_modules = [
     Extension(
         "centroid",
         ["centroid.pyx"],
-        extra_compile_args=['-fopenmp','-march=native'],
-        extra_link_args=['-fopenmp','-march=native'],
-        #extra_compile_args=['-fopenmp'],
-        #extra_link_args=['-fopenmp'],
+        extra_compile_args=openmp_compile_args,
+        extra_link_args=openmp_link_args,
     )
 ]
 
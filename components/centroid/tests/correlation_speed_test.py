@@ -0,0 +1,77 @@
+import centroid
+import sys,os
+sys.path.append(os.path.join(os.path.split(os.path.abspath(__file__))[0],'..','..'))
+from correlation_centroids import CorrelationCentroider
+import numpy as np
+from time import time
+
+# Compares the accuracy and speed of CorrelationCentroider with those of
+# fast_centroids and compute_centroids_with_backgrounds, on synthetic
+# 1920x1200 frames with spots of decreasing brightness and a range of
+# lenslet counts, to tell whether correlation centroiding fits the loop
+# rate. Accuracies are RMS errors from the true spot positions.
+
+image_width = 1920
+image_height = 1200
+centroiding_half_width = 4
+spot_sigma = 1.5
+noise = 5.0
+N = 10
+
+def make_frame(sb_x_vec,sb_y_vec,true_x,true_y,amplitude):
+    yy,xx = np.mgrid[-8:9,-8:9]
+    spots_image = np.random.randn(image_height,image_width)*noise+100.0
+    for x,y in zip(true_x,true_y):
+        ix,iy = int(round(x)),int(round(y))
+        spots_image[iy-8:iy+9,ix-8:ix+9] += amplitude*np.exp(-((xx-(x-ix))**2+(yy-(y-iy))**2)/(2*spot_sigma**2))
+    return np.clip(np.round(spots_image),0,4095).astype(np.uint16)
+
+def rms_error(x,y,true_x,true_y):
+    return np.sqrt(np.mean((x-true_x)**2+(y-true_y)**2))
+
+np.random.seed(0)
+for sb_half_width in [8,12,20]:
+    pitch = 2*sb_half_width+2
+    spot_x = np.arange(pitch,image_width-pitch,pitch,dtype=np.float64)
+    spot_y = np.arange(pitch,image_height-pitch,pitch,dtype=np.float64)
+    XX,YY = np.meshgrid(spot_x,spot_y)
+    sb_x_vec = XX.ravel()
+    sb_y_vec = YY.ravel()
+    n_spots = len(sb_x_vec)
+    shift = sb_half_width/3.0
+    true_x = sb_x_vec+np.random.uniform(-shift,shift,n_spots)
+    true_y = sb_y_vec+np.random.uniform(-shift,shift,n_spots)
+    correlator = CorrelationCentroider(spot_sigma)
+
+    def run_correlation(spots_image):
+        out = [np.zeros(n_spots) for k in range(3)]+[np.zeros(n_spots,dtype=np.int16)]
+        correlator.correlation_centroids(spots_image,sb_x_vec,sb_y_vec,sb_half_width,*out)
+        return out[0],out[1]
+
+    def run_fast(spots_image):
+        out = [np.zeros(n_spots) for k in range(3)]+[np.zeros(n_spots,dtype=np.int16)]
+        centroid.fast_centroids(spots_image,sb_x_vec,sb_y_vec,sb_half_width,
+                                centroiding_half_width,*out)
+        return out[0],out[1]
+
+    def run_com(spots_image):
+        out = [np.zeros(n_spots) for k in range(6)]
+        centroid.compute_centroids_with_backgrounds(spots_image,sb_x_vec,sb_y_vec,out[0],
+                                                    sb_half_width,5.0,2,2,*out[1:])
+        return out[1],out[2]
+
+    print('%d spots, search box half width %d:'%(n_spots,sb_half_width))
+    for label,func in [('correlation',run_correlation),
+                       ('fast_centroids',run_fast),
+                       ('compute_centroids',run_com)]:
+        errors = []
+        for amplitude in [2000,100,30]:
+            x,y = func(make_frame(sb_x_vec,sb_y_vec,true_x,true_y,amplitude))
+            errors.append(rms_error(x,y,true_x,true_y))
+        spots_image = make_frame(sb_x_vec,sb_y_vec,true_x,true_y,2000)
+        t0 = time()
+        for k in range(N):
+            func(spots_image)
+        t_iteration = (time()-t0)/float(N)
+        print('  %s: %0.2f ms (%0.0f Hz), RMS error %0.3f/%0.3f/%0.3f px at amplitude 2000/100/30'%(
+            label,t_iteration*1000.0,1.0/t_iteration,errors[0],errors[1],errors[2]))
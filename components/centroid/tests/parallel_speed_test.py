@@ -0,0 +1,100 @@
+import centroid
+import sys,os
+import multiprocessing
+import numpy as np
+from time import time
+
+# Checks that the prange versions of compute_centroids, fast_centroids,
+# and compute_centroids_stack give the same answers regardless of the
+# number of threads, and shows how the kernels scale with core count. The
+# default geometry approximates a 1920x1200 sensor with 12 pixel search
+# box half widths.
+
+image_width = 1920
+image_height = 1200
+sb_half_width = 12
+pitch = 2*sb_half_width+2
+centroiding_half_width = 4
+iterations = 2
+iteration_step_px = 2
+N = 100
+
+spot_x = np.arange(pitch,image_width-pitch,pitch,dtype=np.float64)
+spot_y = np.arange(pitch,image_height-pitch,pitch,dtype=np.float64)
+XX,YY = np.meshgrid(spot_x,spot_y)
+sb_x_vec = XX.ravel()
+sb_y_vec = YY.ravel()
+n_spots = len(sb_x_vec)
+
+# gaussian spots, randomly displaced from the search box centers,
+# on a noisy background
+np.random.seed(0)
+yy,xx = np.mgrid[-sb_half_width:sb_half_width+1,-sb_half_width:sb_half_width+1]
+spots_image = np.random.randn(image_height,image_width)*5.0+100.0
+for x,y in zip(sb_x_vec,sb_y_vec):
+    dx,dy = np.random.randn(2)
+    spot = 2000.0*np.exp(-((xx-dx)**2+(yy-dy)**2)/(2*1.5**2))
+    spots_image[int(y)-sb_half_width:int(y)+sb_half_width+1,
+                int(x)-sb_half_width:int(x)+sb_half_width+1] += spot
+spots_image = np.clip(np.round(spots_image),0,4095).astype(np.int16)
+
+sb_bg_vec = np.zeros(n_spots)
+centroid.estimate_backgrounds(spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,sb_half_width)
+
+def run_compute_centroids(num_threads):
+    out = [np.zeros(n_spots) for k in range(5)]
+    centroid.compute_centroids(spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,
+                               sb_half_width,iterations,iteration_step_px,
+                               *out,num_threads_p=num_threads)
+    return out
+
+def run_fast_centroids(num_threads):
+    out = [np.zeros(n_spots) for k in range(3)]+[np.zeros(n_spots,dtype=np.int16)]
+    centroid.fast_centroids(spots_image,sb_x_vec,sb_y_vec,sb_half_width,
+                            centroiding_half_width,*out,verbose_p=0,
+                            num_threads_p=num_threads)
+    return out
+
+# a short stack of frames, as recorded for a reference or a poke; the
+# stack kernel divides the frames, rather than the spots, among threads
+n_frames = 8
+spots_stack = np.array([np.roll(spots_image,k,axis=1) for k in range(n_frames)])
+
+def run_compute_centroids_stack(num_threads):
+    out = [np.zeros((n_frames,n_spots)) for k in range(6)]
+    centroid.compute_centroids_stack(spots_stack,sb_x_vec,sb_y_vec,out[0],
+                                     sb_half_width,0.0,iterations,iteration_step_px,
+                                     *out[1:],num_threads_p=num_threads)
+    return out
+
+stack = run_compute_centroids_stack(1)
+for k in range(n_frames):
+    out = [np.zeros(n_spots) for k in range(6)]
+    centroid.compute_centroids_with_backgrounds(spots_stack[k],sb_x_vec,sb_y_vec,out[0],
+                                                sb_half_width,0.0,iterations,iteration_step_px,
+                                                *out[1:])
+    if not all([np.array_equal(a[k],b) for a,b in zip(stack,out)]):
+        sys.exit('compute_centroids_stack disagrees with compute_centroids_with_backgrounds on frame %d. Please fix.'%k)
+
+max_threads = multiprocessing.cpu_count()
+thread_counts = sorted(set([1,2,4,8,16,max_threads]))
+thread_counts = [t for t in thread_counts if t<=max_threads]
+
+print('%d spots in a %dx%d image, %d cores'%(n_spots,image_width,image_height,max_threads))
+
+for label,func in [('compute_centroids',run_compute_centroids),
+                   ('fast_centroids',run_fast_centroids),
+                   ('compute_centroids_stack',run_compute_centroids_stack)]:
+    serial = func(1)
+    t_serial = None
+    for num_threads in thread_counts:
+        parallel = func(num_threads)
+        if not all([np.array_equal(a,b) for a,b in zip(serial,parallel)]):
+            sys.exit('%s with %d threads disagrees with serial result. Please fix.'%(label,num_threads))
+        t0 = time()
+        for k in range(N):
+            func(num_threads)
+        t_iteration = (time()-t0)/float(N)
+        if t_serial is None:
+            t_serial = t_iteration
+        print('%s: %2d threads, iteration time %0.2f ms, speedup %0.2f'%(label,num_threads,t_iteration*1000.0,t_serial/t_iteration))
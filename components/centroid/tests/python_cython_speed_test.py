@@ -66,7 +66,7 @@ def fast_centroids(spots_image,sb_x_vec,sb_y_vec,sb_half_width,centroiding_half_
         y2 = int(round(sb_y_vec[spot_index]+sb_half_width))
 
         if verbose:
-            print 'python A',spot_index,x1,x2,y1,y2
+            print('python A',spot_index,x1,x2,y1,y2)
         
         for y in range(y1,y2+1):
             for x in range(x1,x2+1):
@@ -82,7 +82,7 @@ def fast_centroids(spots_image,sb_x_vec,sb_y_vec,sb_half_width,centroiding_half_
         y2 = int(round(max_y+centroiding_half_width))
 
         if verbose:
-            print 'python B',spot_index,x1,x2,y1,y2
+            print('python B',spot_index,x1,x2,y1,y2)
         
         xnum = 0.0
         ynum = 0.0
@@ -107,13 +107,13 @@ python_cython_err = (xout-pxout).tolist()+(yout-pyout).tolist()
 if any(python_cython_err):
     sys.exit('Error between Cython centroiding and Python centroiding. Please fix.')
 else:
-    print 'Cython centroid centers of mass match pure Python calculations.'
+    print('Cython centroid centers of mass match pure Python calculations.')
     
 cython_ground_truth_err = (xout-x_spot_location).tolist()+(yout-y_spot_location).tolist()
 if any(cython_ground_truth_err):
     sys.exit('Error between Cython centroiding and ground truth. Please fix.')
 else:
-    print 'Cython centroid centers of mass match ground truth.'
+    print('Cython centroid centers of mass match ground truth.')
 
 N = 1000
 t0 = time()
@@ -124,4 +124,26 @@ t_total = time()-t0
 t_iteration = t_total/float(N)
 fps = 1.0/t_iteration
 
-print '%d spots, %d iterations, total time %0.1f, iteration time %0.1e, fps %0.1f'%(n_spots,N,t_total,t_iteration,fps)
+print('fast_centroids: %d spots, %d iterations, total time %0.1f, iteration time %0.1e, fps %0.1f'%(n_spots,N,t_total,t_iteration,fps))
+
+# compute_centroids walks every pixel of every (shrinking) search box,
+# so it is the kernel most sensitive to the order in which the image is
+# traversed; use boxes nearly as large as the spot spacing (~61 px)
+compute_half_width = 25
+sb_bg_vec = np.zeros(sb_x_vec.shape)
+mean_intensity = np.zeros(sb_x_vec.shape)
+min_intensity = np.zeros(sb_x_vec.shape)
+iterations = 3
+iteration_step_px = 2
+
+t0 = time()
+for k in range(N):
+    centroid.compute_centroids(spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,compute_half_width,
+                               iterations,iteration_step_px,xout,yout,
+                               mean_intensity,max_intensity,min_intensity,1)
+
+t_total = time()-t0
+t_iteration = t_total/float(N)
+fps = 1.0/t_iteration
+
+print('compute_centroids: %d spots, %d iterations, total time %0.1f, iteration time %0.1e, fps %0.1f'%(n_spots,N,t_total,t_iteration,fps))
@@ -0,0 +1,52 @@
+import centroid
+import sys,os
+import numpy as np
+from time import time
+
+# Compares compute_centroids_sat, which takes its box sums from summed-area
+# tables, with compute_centroids_with_backgrounds, which sums each box on
+# each iteration, over a range of search box sizes and iteration counts.
+# The tables cost one pass over the frame, so they only pay off once the
+# boxes are large and the iterations many. The two kernels differ in how
+# they subtract backgrounds (see centroid.pyx), so only timing is compared
+# here; background_correction is 0, as it should be for the table path.
+
+image_width = 1920
+image_height = 1200
+N = 10
+
+def make_image(sb_half_width):
+    pitch = 2*sb_half_width+2
+    spot_x = np.arange(pitch,image_width-pitch,pitch,dtype=np.float64)
+    spot_y = np.arange(pitch,image_height-pitch,pitch,dtype=np.float64)
+    XX,YY = np.meshgrid(spot_x,spot_y)
+    sb_x_vec = XX.ravel()
+    sb_y_vec = YY.ravel()
+    np.random.seed(0)
+    yy,xx = np.mgrid[-8:9,-8:9]
+    spots_image = np.random.randn(image_height,image_width)*5.0+100.0
+    for x,y in zip(sb_x_vec,sb_y_vec):
+        dx,dy = np.random.randn(2)
+        spots_image[int(y)-8:int(y)+9,int(x)-8:int(x)+9] += 2000.0*np.exp(-((xx-dx)**2+(yy-dy)**2)/(2*1.5**2))
+    spots_image = np.clip(np.round(spots_image),0,4095).astype(np.uint16)
+    return sb_x_vec,sb_y_vec,spots_image
+
+sat_buffer = np.empty((3,image_height+1,image_width+1))
+
+for sb_half_width in [12,20,30,40]:
+    sb_x_vec,sb_y_vec,spots_image = make_image(sb_half_width)
+    n_spots = len(sb_x_vec)
+    for iterations in [1,3,6]:
+        out = [np.zeros(n_spots) for k in range(6)]
+        t0 = time()
+        for k in range(N):
+            centroid.compute_centroids_with_backgrounds(spots_image,sb_x_vec,sb_y_vec,out[0],
+                                                        sb_half_width,0.0,iterations,2,*out[1:])
+        t_direct = (time()-t0)/float(N)
+        t0 = time()
+        for k in range(N):
+            centroid.compute_centroids_sat(spots_image,sb_x_vec,sb_y_vec,out[0],
+                                           sb_half_width,0.0,iterations,2,*out[1:],
+                                           sat_buffer=sat_buffer)
+        t_sat = (time()-t0)/float(N)
+        print('half width %d, %d spots, %d iterations: direct %0.2f ms, tables %0.2f ms'%(sb_half_width,n_spots,iterations,t_direct*1000.0,t_sat*1000.0))
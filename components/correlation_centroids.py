@@ -0,0 +1,117 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import scipy.fft as sfft
+
+class CorrelationCentroider:
+
+    def __init__(self,template_sigma_px=1.5):
+        """The CorrelationCentroider object locates each spot by
+        cross-correlating its search box with a template spot, which is
+        more robust to noise than a center of mass when the spots are dim.
+
+        On each frame, all of the search boxes are gathered from a strided
+        (sliding window) view of the image into one n_lenslets x width x
+        width cube. The cube is correlated with the template through one
+        batched rfft2/irfft2 pair, in single precision (scipy.fft, unlike
+        numpy.fft, transforms float32 as float32, which is about three times
+        faster here, and can divide the stack among threads). The boxes are
+        zero-padded to the next size that the FFT handles efficiently. Each correlation peak is then refined to
+        sub-pixel precision with a three point parabolic fit along x and
+        along y. The correlation is circular, so a spot that straddles the
+        edge of its search box is partly wrapped around; such spots are
+        poorly measured by any estimator.
+
+        The template defaults to a gaussian with standard deviation
+        template_sigma_px; set_template replaces it, e.g. with the mean of
+        the search boxes of a reference frame."""
+
+        self.template_sigma_px = template_sigma_px
+        self.template = None
+        self.template_ft = None
+        self.width = None
+
+    def gaussian_template(self,width):
+        d = np.arange(width)-(width-1)//2
+        XX,YY = np.meshgrid(d,d)
+        return np.exp(-(XX**2+YY**2)/(2.0*self.template_sigma_px**2))
+
+    def set_template(self,template):
+        self.template = np.array(template,dtype=np.float64)
+        self.width = None
+
+    def update_template(self,width):
+        if self.template is None or not self.template.shape==(width,width):
+            template = self.gaussian_template(width)
+        else:
+            template = self.template
+        # zero mean, so that a constant background doesn't correlate with
+        # it; since the template's peak is at the center of the box, the
+        # correlation peaks at the spot's shift from the box center
+        template = template-template.mean()
+        self.fft_width = sfft.next_fast_len(width,real=True)
+        self.template_ft = np.conj(sfft.rfft2(template,s=(self.fft_width,self.fft_width))).astype(np.complex64)
+        self.width = width
+
+    def correlation_centroids(self,spots_image,sb_x_vec,sb_y_vec,sb_half_width_p,
+                              x_out,y_out,sb_max_vec,valid_vec,dark_image=None,
+                              num_threads_p=1):
+
+        half_width = int(sb_half_width_p)
+        width = 2*half_width+1
+        n_spots = len(sb_x_vec)
+        sy,sx = spots_image.shape
+
+        if not self.width==width:
+            self.update_template(width)
+
+        x0 = np.round(sb_x_vec).astype(int)
+        y0 = np.round(sb_y_vec).astype(int)
+        box_valid = ((x0-half_width>=0)&(x0+half_width<=sx-1)&
+                     (y0-half_width>=0)&(y0+half_width<=sy-1))
+        x1 = np.clip(x0-half_width,0,sx-width)
+        y1 = np.clip(y0-half_width,0,sy-width)
+
+        # one gather from the strided view copies all of the search boxes
+        # into a contiguous n_spots x width x width cube
+        cube = sliding_window_view(spots_image,(width,width))[y1,x1].astype(np.float32)
+        if dark_image is not None:
+            cube -= sliding_window_view(dark_image,(width,width))[y1,x1]
+
+        sb_max_vec[:] = cube.max(axis=(1,2))
+
+        # without its mean, a box's background doesn't form an edge against
+        # the zero padding, which would correlate with the template
+        cube -= cube.mean(axis=(1,2))[:,None,None]
+
+        workers = max(1,int(num_threads_p))
+        fft_width = self.fft_width
+        correlation = sfft.irfft2(sfft.rfft2(cube,s=(fft_width,fft_width),workers=workers)*self.template_ft[None,:,:],
+                                  s=(fft_width,fft_width),workers=workers)
+
+        flat_peak = np.argmax(correlation.reshape(n_spots,-1),axis=1)
+        py,px = np.unravel_index(flat_peak,(fft_width,fft_width))
+        k = np.arange(n_spots)
+        c0 = correlation[k,py,px]
+
+        # parabolic refinement, with the neighbors wrapped around as the
+        # correlation is
+        cxm = correlation[k,py,(px-1)%fft_width]
+        cxp = correlation[k,py,(px+1)%fft_width]
+        cym = correlation[k,(py-1)%fft_width,px]
+        cyp = correlation[k,(py+1)%fft_width,px]
+        x_denom = cxm-2*c0+cxp
+        y_denom = cym-2*c0+cyp
+        valid = box_valid&(c0>0)&(x_denom<0)&(y_denom<0)
+        x_denom[~valid] = -1.0
+        y_denom[~valid] = -1.0
+        dx = 0.5*(cxm-cxp).astype(np.float64)/x_denom
+        dy = 0.5*(cym-cyp).astype(np.float64)/y_denom
+
+        # peaks past the middle of the transform are negative shifts
+        px = np.where(px>fft_width//2,px-fft_width,px)
+        py = np.where(py>fft_width//2,py-fft_width,py)
+
+        x_out[:] = np.where(valid,x0+px+dx,-1)
+        y_out[:] = np.where(valid,y0+py+dy,-1)
+        valid_vec[:] = valid
+        return 1
@@ -0,0 +1,615 @@
+import numpy as np
+import time
+import os
+import threading
+import ciao_config as ccfg
+from .poke import Poke,Precomputer,likely_masks
+from .calibration import Modulator,Refiner
+from .poke_analysis import Archiver
+from .pipeline import Pipeline
+from .scheduler import LoopScheduler
+from .frame_timer import BlockTimer
+from .tools import now_string,load_array,save_array,binary_filename
+
+class LoopThread(threading.Thread):
+
+    def __init__(self,loop):
+        # runs loop.update repeatedly, paced by loop.scheduler, so that
+        # the loop doesn't wait for the UI to paint
+        super(LoopThread,self).__init__()
+        self.daemon = True
+        self.loop = loop
+        self.running = True
+
+    def run(self):
+        while self.running:
+            if self.loop.paused:
+                # the scheduler doesn't wait in 'free' mode, and update
+                # does nothing while paused, so sleep rather than spin
+                time.sleep(0.01)
+                continue
+            self.loop.scheduler.wait()
+            try:
+                self.loop.update()
+            except Exception as e:
+                print('LoopThread: %s'%e)
+
+    def stop(self):
+        self.running = False
+
+
+class LoopEngine:
+
+    def __init__(self,sensor,mirror,verbose=0):
+        """The LoopEngine holds the state of the AO loop--the poke
+        matrix, gain, loss, and active lenslets--and runs the control law,
+        without Qt. loops.Loop adds the Qt signals, timers, and dialogs
+        used by the UI; the engine by itself runs the loop headless, e.g.
+        for benchmarks or automated measurements (see run)."""
+
+        self.verbose = verbose
+
+        self.sensor = sensor
+        self.active_lenslets = np.ones(self.sensor.n_lenslets).astype(int)
+        self.mirror = mirror
+
+        self.update_rate = ccfg.loop_update_rate
+
+        n_lenslets = self.sensor.n_lenslets
+        n_actuators = self.mirror.n_actuators
+
+        # the control law's buffers, so that each iteration works in place
+        # rather than allocating (see control)
+        self.active_mask = np.ones(n_lenslets,dtype=bool)
+        self.current_active_lenslets = np.ones(n_lenslets,dtype=bool)
+        self.lenslets_changed = np.zeros(n_lenslets,dtype=bool)
+        self.set_active_index(self.active_mask)
+        self.slope_vec = np.zeros(2*n_lenslets)
+        self.correction = np.zeros(n_actuators)
+        self.command = np.zeros(n_actuators)
+
+        self.poke = None
+        # a calibration by modulation, while one runs, and the Poke it
+        # produced, until control switches to it (see start_modulation)
+        self.modulator = None
+        self.pending_poke = None
+        # saves poke matrices in the background (see save_poke)
+        self.archiver = None
+        self.closed = False
+        self.safe = True
+
+        # try to load the poke file specified in
+        # ciao_config.py; if it doesn't exist, create
+        # a dummy poke with all 1's; this will result
+        # in an inverse control matrix with very low
+        # gains, i.e. the mirror won't be driven
+        if not (os.path.exists(ccfg.poke_filename) or os.path.exists(binary_filename(ccfg.poke_filename))):
+            dummy = np.ones((2*n_lenslets,n_actuators))
+            save_array(ccfg.poke_filename,dummy)
+
+        self.load_poke(ccfg.poke_filename)
+
+        # with poke_invert_on_demand, control matrices for the masks the
+        # loop is likely to need may be computed in the background (see
+        # poke.Precomputer)
+        try:
+            precompute = ccfg.poke_precompute
+        except Exception as e:
+            precompute = False
+        self.precomputer = None
+        if precompute and ccfg.poke_invert_on_demand:
+            try:
+                n_rings = ccfg.poke_precompute_rings
+            except Exception as e:
+                n_rings = 2
+            try:
+                n_sectors = ccfg.poke_precompute_sectors
+            except Exception as e:
+                n_sectors = 8
+            try:
+                n_recent = ccfg.poke_precompute_recent
+            except Exception as e:
+                n_recent = 10
+            masks = likely_masks(self.sensor.search_boxes.x,self.sensor.search_boxes.y,
+                                 ccfg.lenslet_pitch_m/ccfg.pixel_size_m,n_rings,n_sectors)
+            self.precomputer = Precomputer(self,masks,n_recent)
+            self.precomputer.start()
+
+        # optionally, the poke matrix is refined from the loop's own
+        # motion in the background (see calibration.Refiner)
+        try:
+            refine = ccfg.poke_refine
+        except Exception as e:
+            refine = False
+        self.refiner = None
+        if refine:
+            try:
+                forgetting = ccfg.poke_refine_forgetting
+            except Exception as e:
+                forgetting = 0.999
+            try:
+                regularization = ccfg.poke_refine_regularization
+            except Exception as e:
+                regularization = 0.1
+            try:
+                interval_s = ccfg.poke_refine_interval_s
+            except Exception as e:
+                interval_s = 10.0
+            try:
+                amplitude = ccfg.poke_refine_amplitude
+            except Exception as e:
+                amplitude = 0.005
+            self.refiner = Refiner(self,forgetting,regularization,interval_s,
+                                   self.get_latency_frames(),amplitude)
+            self.refiner.start()
+        self.gain = ccfg.loop_gain
+        self.loss = ccfg.loop_loss
+        self.paused = False
+        self.n = 0
+        self.update_timer = BlockTimer('Loop update method')
+        try:
+            self.profile_update_method = ccfg.profile_loop_update_method
+        except:
+            self.profile_update_method = False
+
+        # in pipelined mode, acquisition, centroiding, control, and the
+        # mirror each run in their own thread (see pipeline.py); otherwise,
+        # with loop_thread set, update runs in a LoopThread rather than on
+        # a QTimer in the UI's thread
+        try:
+            self.pipelined = ccfg.loop_pipelined
+        except Exception as e:
+            self.pipelined = False
+        try:
+            self.pipeline_buffers = ccfg.loop_pipeline_buffers
+        except Exception as e:
+            self.pipeline_buffers = 3
+        self.pipeline = None
+        try:
+            self.threaded = ccfg.loop_thread
+        except Exception as e:
+            self.threaded = False
+        self.thread = None
+
+        # the scheduler paces the loop in its own thread or pipeline, and
+        # times it in any mode; see scheduler.py
+        try:
+            schedule = ccfg.loop_schedule
+        except Exception as e:
+            schedule = 'fixed'
+        cam = self.sensor.cam
+        try:
+            trigger = cam.wait_for_frame
+            frames_dropped = lambda: cam.frames_dropped
+        except AttributeError:
+            trigger = None
+            frames_dropped = None
+        self.scheduler = LoopScheduler(schedule,self.update_rate,trigger,frames_dropped)
+
+        # update holds this lock, so that pausing from another thread
+        # waits for the current iteration to finish
+        self.update_lock = threading.RLock()
+
+        # with no UI to draw them, snapshots are never wanted
+        self.snapshot_pending = True
+
+    def has_poke(self):
+        return self.poke is not None
+
+    def pause(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        with self.update_lock:
+            self.mirror.pause()
+            self.sensor.pause()
+            self.paused = True
+
+    def unpause(self):
+        self.mirror.unpause()
+        self.sensor.unpause()
+        self.scheduler.resume()
+        self.paused = False
+        if self.pipeline is not None:
+            self.pipeline.start()
+        print('loop unpaused')
+
+    def set_safe(self,val):
+        self.safe = val
+
+    def set_paused(self,val):
+        if val:
+            if self.pipeline is not None:
+                self.pipeline.stop()
+            with self.update_lock:
+                self.mirror.pause()
+                self.sensor.pause()
+                self.paused = True
+        else:
+            self.mirror.unpause()
+            self.sensor.unpause()
+            self.scheduler.resume()
+            self.paused = False
+            if self.pipeline is not None:
+                self.pipeline.start()
+
+    def sensor_operation(self,operation,*args):
+        # run operation, a sensor method that uses the camera or changes the
+        # dark image or search boxes the loop reads, between iterations; the
+        # pipeline's stages don't take the lock, so it's stopped, dropping
+        # the frames in flight, and restarted afterward
+        restart = self.pipeline is not None and self.pipeline.running
+        if restart:
+            self.pipeline.stop()
+        try:
+            with self.update_lock:
+                return operation(*args)
+        finally:
+            if restart:
+                self.pipeline.start()
+
+    def record_reference(self):
+        self.sensor_operation(self.sensor.record_reference)
+
+    def set_dark(self):
+        self.sensor_operation(self.sensor.set_dark)
+
+    def set_dark_subtraction(self,val):
+        self.sensor_operation(self.sensor.set_dark_subtraction,val)
+
+    def set_defocus(self,val):
+        self.sensor_operation(self.sensor.set_defocus,val)
+
+    def set_astig0(self,val):
+        self.sensor_operation(self.sensor.set_astig0,val)
+
+    def set_astig1(self,val):
+        self.sensor_operation(self.sensor.set_astig1,val)
+
+    def aberration_reset(self):
+        self.sensor_operation(self.sensor.aberration_reset)
+
+    def move_search_boxes(self,direction):
+        # direction is 'up', 'down', 'left', or 'right'
+        self.sensor_operation(getattr(self.sensor.search_boxes,direction))
+
+    def set_logging(self,val):
+        # the scheduler's histograms are logged for each logging session
+        if val:
+            self.scheduler.reset()
+        else:
+            self.scheduler.log(ccfg.logging_directory,now_string(True))
+
+    def post_snapshot(self,frame=None):
+        pass
+
+    def update(self):
+        with self.update_lock:
+            self.step()
+
+    def step(self):
+        # one iteration of the loop: sense, compute the command, and send
+        # it to the mirror
+        if not self.paused:
+            self.scheduler.tick()
+            if self.verbose>=5:
+                print('Updating loop.')
+
+
+            self.sensor.update()
+
+            if self.profile_update_method:
+                self.update_timer.tick('sensor.update')
+
+            command = self.control(self.sensor.slopes,self.sensor.box_maxes,
+                                   self.mirror.get_command())
+
+            if command is not None:
+                self.mirror.set_command(command)
+                self.mirror.update()
+
+                if self.profile_update_method:
+                    self.update_timer.tick('mirror.update')
+
+
+        self.n = self.n + 1
+
+    def control(self,slopes,box_maxes,current_command):
+        # the control law: return the next mirror command, given the
+        # slopes (x then y, one vector), the box maxima (for safe mode),
+        # and the command currently applied, or None if the loop is open or
+        # not ready to correct; the command returned is a buffer that the
+        # next call overwrites
+        command = None
+        current_active_lenslets = self.current_active_lenslets
+
+        if self.pending_poke is not None:
+            # switch to the Poke from a modulation; forgetting the mask
+            # makes the code below pick its control matrix for the current
+            # one
+            self.poke = self.pending_poke
+            self.pending_poke = None
+            self.active_mask.fill(False)
+            self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
+
+        # if we're in safe mode, check the boxes:
+        if self.safe:
+            np.greater_equal(box_maxes,ccfg.spots_threshold,out=current_active_lenslets)
+        else:
+            current_active_lenslets.fill(True)
+
+        if self.closed and self.has_poke():
+
+            np.not_equal(self.active_mask,current_active_lenslets,out=self.lenslets_changed)
+            lenslets_changed = self.lenslets_changed.any()
+            all_lenslets_active = current_active_lenslets.all()
+            if lenslets_changed:
+                self.set_active_index(current_active_lenslets)
+            # if the lenslets have changed, we have two options:
+            # 1. if they're not all active, and ccfg.poke_invert_on_demand
+            #    is set to True, then we do one of two things:
+            #    a. if the active lenslets have changed, then we need to
+            #       re-invert and set ready_to_correct True
+            #    b. if the active lenslets haven't changed, then we just
+            #       set ready_to_correct true
+            # 2. if they're not all active, and ccfg.poke_invert_on_demand
+            #    is set to False, then we need to set ready_to_correct to False
+            # 3. if they're all active, set ready_to_correct True, first
+            #    restoring the unmasked control matrix if a masked one was
+            #    in use
+
+            if not all_lenslets_active:
+                if ccfg.poke_invert_on_demand:
+                    if lenslets_changed:
+                        if self.precomputer is not None:
+                            self.precomputer.observe(current_active_lenslets)
+                        self.poke.invert(mask=current_active_lenslets)
+                    self.ready_to_correct = True
+                else:
+                    self.ready_to_correct = False
+            else:
+                if not self.poke.ctrl.shape[1]==len(slopes):
+                    self.poke.invert()
+                self.ready_to_correct = True
+
+            if self.verbose>=1:
+                error = self.sensor.error
+                pcount = int(round(error*1e8))
+                print('rms'+'.'*pcount)
+
+            if self.ready_to_correct:
+                # gather the active lenslets' slopes with the packed index
+                if all_lenslets_active:
+                    slope_vec = slopes
+                else:
+                    slope_vec = np.take(slopes,self.active_index,out=self.slope_vec[:len(self.active_index)],mode='clip')
+                assert len(slope_vec)==self.poke.ctrl.shape[1]
+
+                correction = np.dot(self.poke.ctrl,slope_vec,out=self.correction)
+                np.multiply(correction,self.gain,out=correction)
+                command = np.multiply(current_command,1-self.loss,out=self.command)
+                np.subtract(command,correction,out=command)
+
+                if self.modulator is not None:
+                    self.modulate(slopes,command)
+                if self.refiner is not None:
+                    self.refiner.observe(slopes,current_command,command,all_lenslets_active)
+
+                if self.verbose>=1:
+                    if command.max()>ccfg.mirror_command_max*.99:
+                        print('actuator saturated')
+                    if command.min()<ccfg.mirror_command_min*.99:
+                        print('actuator saturated')
+            else:
+                print('not ready to correct')
+
+        self.active_mask[:] = current_active_lenslets
+        self.active_lenslets[:] = current_active_lenslets
+        return command
+
+    def start_modulation(self,basis=None):
+        """Measure a new poke matrix without opening the loop, by
+        modulating the commands with small sinusoids and demodulating the
+        slopes (see calibration.Modulator). basis is 'actuators' or
+        'modes', the current poke matrix's singular vectors, and defaults
+        to ccfg.poke_modulation_basis. The modulation runs while the loop
+        is closed, for poke_modulation_n_frames frames; then the poke
+        matrix is solved for and inverted in a thread, saved as run_poke
+        saves it, and, if its condition number is within the loop's
+        limits, used from the next iteration on."""
+        if self.modulator is not None:
+            print('modulation already running')
+            return
+        try:
+            amplitude = ccfg.poke_modulation_amplitude
+        except Exception as e:
+            amplitude = 0.02
+        try:
+            n_frames = ccfg.poke_modulation_n_frames
+        except Exception as e:
+            n_frames = 1024
+        if basis is None:
+            try:
+                basis = ccfg.poke_modulation_basis
+            except Exception as e:
+                basis = 'actuators'
+        if basis=='modes':
+            U,s,Vt = self.poke.get_factors()
+            vectors = Vt.T
+        else:
+            vectors = np.eye(self.mirror.n_actuators)
+        self.modulator = Modulator(2*self.sensor.n_lenslets,vectors,amplitude,n_frames,
+                                   self.get_latency_frames())
+        print('modulating %s at %d frequencies for %d frames'%(basis,len(self.modulator.bins),n_frames))
+
+    def get_latency_frames(self):
+        # iterations between sending a command and sensing its slopes
+        try:
+            return ccfg.loop_latency_frames
+        except Exception as e:
+            return 1
+
+    def modulate(self,slopes,command):
+        # add the modulation to command, and once enough frames have been
+        # logged, finish in a thread
+        modulator = self.modulator
+        if modulator.apply(slopes,command):
+            self.modulator = None
+            thread = threading.Thread(target=self.finish_modulation,args=(modulator,))
+            thread.daemon = True
+            thread.start()
+
+    def finish_modulation(self,modulator):
+        try:
+            poke_matrix = modulator.demodulate()
+            poke = Poke(poke_matrix)
+            n_modes = self.get_n_modes()
+            if n_modes>0 and n_modes!=poke.n_modes:
+                poke.set_n_modes(n_modes)
+            # the control matrix for the current mask, so that switching
+            # to the new Poke costs a lookup
+            mask = self.active_mask.copy()
+            if not mask.all() and ccfg.poke_invert_on_demand:
+                poke.precompute(mask)
+        except Exception as e:
+            print('modulation: %s'%e)
+            return
+        cond = poke.cutoff_cond
+        if not ccfg.loop_condition_llim<cond<ccfg.loop_condition_ulim:
+            print('modulation: condition number %0.1f out of range; keeping the current poke matrix'%cond)
+            return
+        self.save_poke(poke_matrix,modulator.dither)
+        self.pending_poke = poke
+
+    def save_poke(self,poke,commands):
+        """Save a new poke matrix in ccfg.poke_filename, e.g. poke.txt,
+        and in archive files that keep track of old poke matrices, named
+        with the date and time, along with the commands used to measure it
+        and a chart of its modes. The files are written in the background,
+        by an Archiver's process, so the loop needn't wait for them; this
+        only stores the data for it."""
+        ns = now_string()
+        filenames = [ccfg.poke_filename,
+                     os.path.join(ccfg.poke_directory,'%s_poke.txt'%ns),
+                     os.path.join(ccfg.poke_directory,'%s_currents.txt'%ns),
+                     os.path.join(ccfg.poke_directory,'%s_modes.pdf'%ns)]
+        try:
+            text_copies = ccfg.save_text_copies
+        except Exception as e:
+            text_copies = True
+        if self.archiver is None:
+            self.archiver = Archiver()
+        self.archiver.save_poke(poke,commands,self.mirror.mirror_mask,filenames,text_copies,ns)
+
+    def set_active_index(self,mask):
+        # the packed index of the active lenslets' slopes, x then y, used
+        # by control to gather them; recomputed only when the mask changes
+        index = np.flatnonzero(mask)
+        self.active_index = np.concatenate((index,index+len(mask)))
+
+    def report_error(self,message):
+        print(message)
+
+    def select_poke_filename(self,poke_filename):
+        # called when poke_filename can't be read; Loop asks the user
+        raise IOError('Could not find %s.'%poke_filename)
+
+    def load_poke(self,poke_filename=None):
+        try:
+            poke = load_array(poke_filename)
+        except Exception as e:
+            poke_filename = self.select_poke_filename(poke_filename)
+            poke = load_array(poke_filename)
+
+        py,px = poke.shape
+        expected_py = self.sensor.n_lenslets*2
+        expected_px = self.mirror.n_actuators
+        dummy = np.ones((expected_py,expected_px))
+
+        try:
+            assert (py==expected_py and px==expected_px)
+        except AssertionError as ae:
+            self.report_error('Poke matrix has shape (%d,%d), but (%d,%d) was expected. Using dummy matrix.'%(py,px,expected_py,expected_px))
+            poke = dummy
+
+        self.poke = Poke(poke)
+        self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
+
+    def set_n_modes(self,n):
+        # takes effect at once, from the poke's cached SVD; called from the
+        # UI's thread, so it holds update_lock, lest control switch masks or
+        # read ctrl while the poke is truncated again
+        try:
+            with self.update_lock:
+                self.poke.set_n_modes(n)
+                self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
+        except Exception as e:
+            print(e)
+
+    def get_n_modes(self):
+        out = -1
+        try:
+            out = self.poke.n_modes
+        except Exception as e:
+            print(e)
+        return out
+
+    def get_condition_number(self):
+        out = -1
+        try:
+            out = self.poke.cutoff_cond
+        except Exception as e:
+            print(e)
+        if out>2**32:
+            out = np.inf
+        return out
+
+    def run(self,n_iterations=None,duration_s=None,pipelined=False):
+        """Run the loop headless, in the calling thread or as a pipeline,
+        for n_iterations iterations or duration_s seconds, whichever comes
+        first, paced by the scheduler. Return the latency of each
+        iteration in seconds--from the start of sensing to the mirror
+        update, or, pipelined, from frame acquisition to the mirror
+        update--and the elapsed time."""
+        if n_iterations is None and duration_s is None:
+            raise ValueError('Please specify n_iterations, duration_s, or both.')
+        if n_iterations is None:
+            n_iterations = np.inf
+        if duration_s is None:
+            duration_s = np.inf
+        self.scheduler.reset()
+        if pipelined:
+            self.pipeline = Pipeline(self,self.pipeline_buffers)
+            n_max = n_iterations if n_iterations<np.inf else int(duration_s*self.update_rate*2)+1000
+            self.pipeline.record_latencies(n_max)
+            t_start = time.perf_counter()
+            self.pipeline.start()
+            while self.pipeline.latency_count<n_iterations and time.perf_counter()-t_start<duration_s:
+                time.sleep(0.001)
+            self.pipeline.stop()
+            elapsed = time.perf_counter()-t_start
+            n = min(self.pipeline.latency_count,len(self.pipeline.latency_ns))
+            latencies = self.pipeline.latency_ns[:n]*1e-9
+            self.pipeline = None
+        else:
+            latencies = []
+            t_start = time.perf_counter()
+            while len(latencies)<n_iterations and time.perf_counter()-t_start<duration_s:
+                self.scheduler.wait()
+                t0 = time.perf_counter_ns()
+                self.update()
+                latencies.append(time.perf_counter_ns()-t0)
+            elapsed = time.perf_counter()-t_start
+            latencies = np.array(latencies)*1e-9
+        return latencies,elapsed
+
+
+def summarize(latencies,elapsed):
+    # throughput and latency percentiles, as returned by LoopEngine.run
+    out = {'iterations':len(latencies),
+           'elapsed_s':elapsed,
+           'throughput_hz':len(latencies)/elapsed}
+    if len(latencies):
+        for p in [50,90,99,99.9]:
+            out['latency_p%g_s'%p] = np.percentile(latencies,p)
+        out['latency_max_s'] = np.max(latencies)
+    return out
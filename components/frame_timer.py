@@ -9,6 +9,7 @@ class FrameTimer:
         self.frame_time = 0.0
         self.frame_rms = 0.0
         self.buff = np.zeros(buffer_size)
+        self.dt = np.zeros(buffer_size-1)
         self.buffer_size = buffer_size
         self.label = label
         self.verbose = verbose
@@ -17,10 +18,10 @@ class FrameTimer:
         self.buff[self.index] = time.time()
         self.index = self.index + 1
         if self.index==self.buffer_size:
-            # buffer full--compute
-            dt = np.diff(self.buff)
+            # buffer full--compute, in place, since tick is in the loop
+            dt = np.subtract(self.buff[1:],self.buff[:-1],out=self.dt)
             self.frame_time = dt.mean()
-            self.frame_rms = dt.std()
+            self.frame_rms = np.sqrt(max(0.0,np.dot(dt,dt)/len(dt)-self.frame_time**2))
             self.fps = 1.0/self.frame_time
             self.index=0
             if self.verbose:
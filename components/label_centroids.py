@@ -0,0 +1,309 @@
+import numpy as np
+
+class LabelCentroider:
+
+    def __init__(self):
+        """The LabelCentroider object is a pure NumPy centroiding backend, for
+        machines without a working compiled centroid module (e.g. simulator-only
+        installs). Its methods have the same signatures as the functions in
+        centroid.pyx, so the Sensor can use either one.
+
+        When the search boxes change, it builds a list of every valid box's
+        pixels, labelled with the index of the box, box by box. On each frame
+        the intensity, x moment, and y moment of every box are then computed
+        at once, with np.bincount weighted sums over that list. As in the
+        compiled kernels, a pixel shared by overlapping boxes counts in each
+        of them."""
+
+        self.sb_x = None
+        self.sb_y = None
+        self.half_width = None
+        self.image_shape = None
+        self.pixel_index = None
+
+    def boxes_changed(self,image_shape,sb_x_vec,sb_y_vec,half_width):
+        return (self.pixel_index is None or
+                not self.half_width==half_width or
+                not self.image_shape==image_shape or
+                not np.array_equal(self.sb_x,sb_x_vec) or
+                not np.array_equal(self.sb_y,sb_y_vec))
+
+    def build_labels(self,image_shape,sb_x_vec,sb_y_vec,half_width):
+        sy,sx = image_shape
+        n_spots = len(sb_x_vec)
+
+        # np.round rounds halves to even, like the kernels in centroid.pyx
+        x1 = np.round(sb_x_vec).astype(int)-half_width
+        x2 = np.round(sb_x_vec).astype(int)+half_width
+        y1 = np.round(sb_y_vec).astype(int)-half_width
+        y2 = np.round(sb_y_vec).astype(int)+half_width
+
+        # boxes that leave the image are not listed, and are skipped
+        # on every frame, as centroid.pyx skips them
+        self.box_valid = (x1>=0)&(x2<=sx-1)&(y1>=0)&(y2<=sy-1)
+        for k in np.where(~self.box_valid)[0]:
+            print('LabelCentroider: search box x=[%d,%d], y=[%d,%d] not valid for spots image with size %dx%d.'%(x1[k],x2[k],y1[k],y2[k],sx,sy))
+        x1,x2,y1,y2 = [np.clip(v,0,lim-1) for v,lim in zip((x1,x2,y1,y2),(sx,sx,sy,sy))]
+
+        # every box's own pixels, in raster order, as flat indices into the
+        # image, for the per-box maxima used by fast_centroids
+        width = 2*half_width+1
+        d = np.arange(width)
+        self.box_index = (np.clip(y1[:,None,None]+d[None,:,None],0,sy-1)*sx+
+                          np.clip(x1[:,None,None]+d[None,None,:],0,sx-1)).reshape(n_spots,-1)
+
+        # the valid boxes' pixels, one box after another, so that each box
+        # is a contiguous segment, for reduceat; invalid boxes have no
+        # pixels, and so no segment
+        self.valid_index = np.where(self.box_valid)[0]
+        self.pixel_index = self.box_index[self.valid_index].ravel().astype(np.int32)
+        self.pixel_label = np.repeat(self.valid_index,width*width)
+        self.pixel_x = (self.pixel_index%sx).astype(np.float64)
+        self.pixel_y = (self.pixel_index//sx).astype(np.float64)
+        self.segment_starts = np.arange(len(self.valid_index))*width*width
+        self.box_counts = float(width*width)
+
+        # the edge pixels of each box, in the same order as
+        # estimate_backgrounds visits them (corners are counted twice)
+        top = (y1[:,None]*sx+x1[:,None]+d[None,:])
+        bottom = (y2[:,None]*sx+x1[:,None]+d[None,:])
+        left = ((y1[:,None]+d[None,:])*sx+x1[:,None])
+        right = ((y1[:,None]+d[None,:])*sx+x2[:,None])
+        self.edge_index = np.clip(np.hstack((top,bottom,left,right)),0,sx*sy-1).astype(np.int32)
+
+        self.sb_x = sb_x_vec.copy()
+        self.sb_y = sb_y_vec.copy()
+        self.half_width = half_width
+        self.image_shape = image_shape
+
+    def get_pixels(self,spots_image,index,dark_image=None):
+        pixels = spots_image.ravel()[index].astype(np.float64)
+        if dark_image is not None:
+            pixels -= dark_image.ravel()[index]
+        return pixels
+
+    def compute_centroids_with_backgrounds(self,spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,
+                                           sb_half_width_p,background_correction_p,
+                                           iterations_p,iteration_step_px_p,
+                                           x_out,y_out,mean_intensity,
+                                           maximum_intensity,minimum_intensity,
+                                           estimate_background_p=1,num_threads_p=1,
+                                           dark_image=None):
+
+        half_width = int(sb_half_width_p)
+        iterations = int(iterations_p)
+        step = int(iteration_step_px_p)
+        n_spots = len(sb_x_vec)
+
+        if self.boxes_changed(spots_image.shape,sb_x_vec,sb_y_vec,half_width):
+            self.build_labels(spots_image.shape,sb_x_vec,sb_y_vec,half_width)
+
+        if estimate_background_p:
+            edges = self.get_pixels(spots_image,self.edge_index,dark_image)
+            sb_bg_vec[self.box_valid] = edges.mean(axis=1)[self.box_valid]+float(background_correction_p)
+
+        x_out[:] = sb_x_vec[:]
+        y_out[:] = sb_y_vec[:]
+
+        for k_iteration in range(iterations):
+            if k_iteration==0:
+                # the first iteration's boxes are the listed ones
+                pixels = self.get_pixels(spots_image,self.pixel_index,dark_image)
+                pixels -= sb_bg_vec[self.pixel_label]
+                np.maximum(pixels,0.0,out=pixels)
+                intensity = np.bincount(self.pixel_label,weights=pixels,minlength=n_spots)
+                xprod = np.bincount(self.pixel_label,weights=pixels*self.pixel_x,minlength=n_spots)
+                yprod = np.bincount(self.pixel_label,weights=pixels*self.pixel_y,minlength=n_spots)
+                # the extrema of the valid boxes' segments only
+                imax = np.zeros(n_spots)
+                imin = np.zeros(n_spots)
+                if len(self.valid_index):
+                    imax[self.valid_index] = np.maximum.reduceat(pixels,self.segment_starts)
+                    imin[self.valid_index] = np.minimum.reduceat(pixels,self.segment_starts)
+                counter = self.box_counts
+            else:
+                # later iterations recenter and shrink each box, so their
+                # pixels depend on the previous iteration; gather them as
+                # one (n_spots,box pixels) array instead
+                hw = half_width-k_iteration*step
+                d = np.arange(-hw,hw+1)
+                cx = np.round(x_out).astype(int)
+                cy = np.round(y_out).astype(int)
+                xx = np.broadcast_to(cx[:,None,None]+d[None,None,:],(n_spots,len(d),len(d))).reshape(n_spots,-1)
+                yy = np.broadcast_to(cy[:,None,None]+d[None,:,None],(n_spots,len(d),len(d))).reshape(n_spots,-1)
+                index = np.clip(yy,0,spots_image.shape[0]-1)*spots_image.shape[1]+np.clip(xx,0,spots_image.shape[1]-1)
+                pixels = self.get_pixels(spots_image,index,dark_image)
+                pixels -= sb_bg_vec[:,None]
+                np.maximum(pixels,0.0,out=pixels)
+                intensity = pixels.sum(axis=1)
+                xprod = (pixels*xx).sum(axis=1)
+                yprod = (pixels*yy).sum(axis=1)
+                imax = pixels.max(axis=1)
+                imin = pixels.min(axis=1)
+                counter = float(len(d)**2)
+
+            # as in centroid.pyx, boxes with no signal keep their previous
+            # centers and statistics
+            valid = (intensity!=0)&(xprod!=0)&(yprod!=0)
+            if not valid[self.box_valid].all():
+                print('Warning: %d search boxes with low intensity; skipping.'%(self.box_valid&~valid).sum())
+            valid = np.where(valid&self.box_valid)[0]
+            mean_intensity[valid] = (intensity/counter)[valid]
+            maximum_intensity[valid] = imax[valid]
+            minimum_intensity[valid] = imin[valid]
+            x_out[valid] = xprod[valid]/intensity[valid]
+            y_out[valid] = yprod[valid]/intensity[valid]
+
+    def compute_centroids_sat(self,spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,
+                              sb_half_width_p,background_correction_p,
+                              iterations_p,iteration_step_px_p,
+                              x_out,y_out,mean_intensity,maximum_intensity,
+                              minimum_intensity,estimate_background_p=1,
+                              num_threads_p=1,dark_image=None,box_extrema_p=1,
+                              sat_buffer=None):
+        # as centroid.compute_centroids_sat: box sums from summed-area
+        # tables, with the background subtracted as background x area
+        # (not clamped at zero)
+        half_width = int(sb_half_width_p)
+        step = int(iteration_step_px_p)
+        sy,sx = spots_image.shape
+        n_spots = len(sb_x_vec)
+        if self.boxes_changed(spots_image.shape,sb_x_vec,sb_y_vec,half_width):
+            self.build_labels(spots_image.shape,sb_x_vec,sb_y_vec,half_width)
+
+        im = spots_image.astype(np.float64)
+        if dark_image is not None:
+            im -= dark_image
+        if sat_buffer is None:
+            sat_buffer = np.empty((3,sy+1,sx+1))
+        sat_buffer[:,0,:] = 0.0
+        sat_buffer[:,:,0] = 0.0
+        np.cumsum(np.cumsum(im,axis=0),axis=1,out=sat_buffer[0,1:,1:])
+        np.cumsum(np.cumsum(im*np.arange(sx)[None,:],axis=0),axis=1,out=sat_buffer[1,1:,1:])
+        np.cumsum(np.cumsum(im*np.arange(sy)[:,None],axis=0),axis=1,out=sat_buffer[2,1:,1:])
+
+        def box_sum(k,x1,x2,y1,y2):
+            return (sat_buffer[k,y2+1,x2+1]-sat_buffer[k,y1,x2+1]
+                    -sat_buffer[k,y2+1,x1]+sat_buffer[k,y1,x1])
+
+        valid = self.box_valid.copy()
+        x1 = np.round(sb_x_vec).astype(int)-half_width
+        x2 = np.round(sb_x_vec).astype(int)+half_width
+        y1 = np.round(sb_y_vec).astype(int)-half_width
+        y2 = np.round(sb_y_vec).astype(int)+half_width
+        x1,x2 = np.clip(x1,0,sx-1),np.clip(x2,0,sx-1)
+        y1,y2 = np.clip(y1,0,sy-1),np.clip(y2,0,sy-1)
+        if estimate_background_p:
+            edges = (box_sum(0,x1,x2,y1,y1)+box_sum(0,x1,x2,y2,y2)+
+                     box_sum(0,x1,x1,y1,y2)+box_sum(0,x2,x2,y1,y2))
+            counts = 2*(x2-x1+1)+2*(y2-y1+1)
+            sb_bg_vec[valid] = (edges/counts)[valid]+float(background_correction_p)
+        background = sb_bg_vec.copy()
+
+        x_out[:] = sb_x_vec[:]
+        y_out[:] = sb_y_vec[:]
+        last = [None]*n_spots
+        for k_iteration in range(int(iterations_p)):
+            hw = half_width-k_iteration*step
+            x1 = np.round(x_out).astype(int)-hw
+            x2 = np.round(x_out).astype(int)+hw
+            y1 = np.round(y_out).astype(int)-hw
+            y2 = np.round(y_out).astype(int)+hw
+            valid = valid&(x1>=0)&(x2<=sx-1)&(y1>=0)&(y2<=sy-1)&(x1<x2)
+            cx1,cx2,cy1,cy2 = [np.clip(v,0,lim-1) for v,lim in zip((x1,x2,y1,y2),(sx,sx,sy,sy))]
+            counter = (cx2-cx1+1.0)*(cy2-cy1+1.0)
+            intensity = box_sum(0,cx1,cx2,cy1,cy2)-background*counter
+            xprod = box_sum(1,cx1,cx2,cy1,cy2)-background*counter*0.5*(cx1+cx2)
+            yprod = box_sum(2,cx1,cx2,cy1,cy2)-background*counter*0.5*(cy1+cy2)
+            ok = np.where(valid&(intensity>0)&(xprod!=0)&(yprod!=0))[0]
+            mean_intensity[ok] = (intensity/counter)[ok]
+            x_out[ok] = xprod[ok]/intensity[ok]
+            y_out[ok] = yprod[ok]/intensity[ok]
+            for k in ok:
+                last[k] = (cx1[k],cx2[k],cy1[k],cy2[k])
+
+        if box_extrema_p:
+            for k in range(n_spots):
+                if last[k] is not None:
+                    bx1,bx2,by1,by2 = last[k]
+                    box = np.maximum(im[by1:by2+1,bx1:bx2+1]-background[k],0.0)
+                    maximum_intensity[k] = box.max()
+                    minimum_intensity[k] = box.min()
+
+    def compute_centroids(self,spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,
+                          sb_half_width_p,iterations_p,iteration_step_px_p,
+                          x_out,y_out,mean_intensity,maximum_intensity,
+                          minimum_intensity,num_threads_p=1):
+        self.compute_centroids_with_backgrounds(spots_image,sb_x_vec,sb_y_vec,sb_bg_vec,
+                                                sb_half_width_p,0.0,iterations_p,
+                                                iteration_step_px_p,x_out,y_out,
+                                                mean_intensity,maximum_intensity,
+                                                minimum_intensity,estimate_background_p=0)
+
+    def compute_centroids_stack(self,spots_stack,sb_x_vec,sb_y_vec,sb_bg_out,
+                                sb_half_width_p,background_correction_p,
+                                iterations_p,iteration_step_px_p,
+                                x_out,y_out,mean_intensity,maximum_intensity,
+                                minimum_intensity,estimate_background_p=1,
+                                num_threads_p=1,dark_image=None):
+        # the pixel list is built once, for the first frame, and reused
+        for k_frame in range(spots_stack.shape[0]):
+            self.compute_centroids_with_backgrounds(spots_stack[k_frame],sb_x_vec,sb_y_vec,
+                                                    sb_bg_out[k_frame],sb_half_width_p,
+                                                    background_correction_p,iterations_p,
+                                                    iteration_step_px_p,x_out[k_frame],
+                                                    y_out[k_frame],mean_intensity[k_frame],
+                                                    maximum_intensity[k_frame],
+                                                    minimum_intensity[k_frame],
+                                                    estimate_background_p=estimate_background_p,
+                                                    dark_image=dark_image)
+
+    def fast_centroids(self,spots_image,sb_x_vec,sb_y_vec,sb_half_width_p,
+                       centroiding_half_width_p,x_out,y_out,sb_max_vec,valid_vec,
+                       verbose_p=0,num_threads_p=1,dark_image=None,
+                       tracking_half_width_p=0,tracking_max_fraction_p=0.5):
+        # tracking is accepted for compatibility with centroid.fast_centroids,
+        # but every box is searched in full; the vectorized search of all
+        # boxes at once costs about the same either way
+
+        half_width = int(sb_half_width_p)
+        n_spots = len(sb_x_vec)
+        sy,sx = spots_image.shape
+
+        if self.boxes_changed(spots_image.shape,sb_x_vec,sb_y_vec,half_width):
+            self.build_labels(spots_image.shape,sb_x_vec,sb_y_vec,half_width)
+
+        # the brightest pixel in each box; argmax returns the first one in
+        # raster order, as the kernel does
+        box_pixels = self.get_pixels(spots_image,self.box_index,dark_image)
+        argmax = np.argmax(box_pixels,axis=1)
+        sb_max_vec[:] = box_pixels[np.arange(n_spots),argmax]
+        max_index = self.box_index[np.arange(n_spots),argmax]
+        max_x = max_index%sx
+        max_y = max_index//sx
+
+        hw = int(centroiding_half_width_p)
+        valid = self.box_valid&((max_x-hw>=0)&(max_x+hw<=sx-1)&(max_y-hw>=0)&(max_y+hw<=sy-1))
+        d = np.arange(-hw,hw+1)
+        xx = np.clip(max_x[:,None,None]+d[None,None,:],0,sx-1)
+        yy = np.clip(max_y[:,None,None]+d[None,:,None],0,sy-1)
+        xx = np.broadcast_to(xx,(n_spots,len(d),len(d))).reshape(n_spots,-1)
+        yy = np.broadcast_to(yy,(n_spots,len(d),len(d))).reshape(n_spots,-1)
+        pixels = self.get_pixels(spots_image,yy*sx+xx,dark_image)
+        denom = pixels.sum(axis=1)
+        if verbose_p and not valid.all():
+            print('LabelCentroider.fast_centroids: %d invalid spots.'%(~valid).sum())
+        valid = valid&(denom>0)
+        denom[~valid] = 1.0
+
+        x_out[:] = np.where(valid,(pixels*xx).sum(axis=1)/denom,-1)
+        y_out[:] = np.where(valid,(pixels*yy).sum(axis=1)/denom,-1)
+        valid_vec[:] = valid
+        return 1
+
+    def image_statistics(self,spots_image,dark_image=None,stride_p=1):
+        stride = max(1,int(stride_p))
+        im = spots_image[::stride,::stride]
+        if dark_image is not None:
+            im = np.subtract(im,dark_image[::stride,::stride],dtype=np.int32)
+        return im.min(),im.mean(),im.max()
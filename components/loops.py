@@ -1,6 +1,5 @@
 import numpy as np
 import time
-import centroid
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -14,220 +13,145 @@ from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, qRgb, QPen, QBitmap,
 import os
 from matplotlib import pyplot as plt
 import datetime
-from .tools import error_message, now_string, prepend, colortable, get_ram, get_process
+from .tools import error_message, now_string, prepend, colortable, get_ram, get_process, load_array, save_array, binary_filename
 import copy
 from .zernike import Reconstructor
 import cProfile
 import scipy.io as sio
-from .poke_analysis import save_modes_chart
+from .poke_analysis import Archiver
 from ctypes import CDLL,c_void_p
 from .search_boxes import SearchBoxes
 from .reference_generator import ReferenceGenerator
 import ciao_config as ccfg
 from .frame_timer import FrameTimer,BlockTimer
 from .poke import Poke
-
-class Loop(QObject):
+from .calibration import multiplex_patterns,demultiplex
+from .pipeline import Pipeline
+from .engine import LoopEngine,LoopThread
+
+class Snapshot:
+
+    def __init__(self,loop,frame=None):
+        # a copy of everything the UI draws, taken in the loop's thread so
+        # that the UI never reads arrays the loop is writing; in pipelined
+        # mode, the centroids and active lenslets are the frame's, since
+        # the sensor's and loop's already belong to later frames
+        sensor = loop.sensor
+        mirror = loop.mirror
+        self.n = loop.n
+        self.image = sensor.image.copy()
+        self.search_box_x = sensor.search_boxes.x.copy()
+        self.search_box_y = sensor.search_boxes.y.copy()
+        if frame is None:
+            self.x_centroids = sensor.x_centroids.copy()
+            self.y_centroids = sensor.y_centroids.copy()
+            self.active_lenslets = loop.active_lenslets.copy()
+        else:
+            self.x_centroids = frame.x_centroids.copy()
+            self.y_centroids = frame.y_centroids.copy()
+            self.active_lenslets = frame.active_lenslets.copy()
+        self.mirror_command = mirror.get_command().copy()
+        self.wavefront = np.array(sensor.wavefront)
+        self.zernikes = np.array(sensor.zernikes)
+        self.error = sensor.error
+        self.tip = sensor.tip
+        self.tilt = sensor.tilt
+        self.image_max = sensor.image_max
+        self.image_mean = sensor.image_mean
+        self.image_min = sensor.image_min
+        self.mean_box_background = sensor.get_average_background()
+        self.centroiding_time = sensor.centroiding_time
+        self.sensor_fps = sensor.frame_timer.fps
+        self.mirror_fps = mirror.frame_timer.fps
+        self.condition_number = loop.get_condition_number()
+        self.schedule = loop.scheduler.statistics()
+
+
+class Loop(LoopEngine,QObject):
 
     finished = pyqtSignal()
     started = pyqtSignal()
+    snapshot = pyqtSignal(object)
     
     def __init__(self,sensor,mirror,verbose=0):
-        super(Loop,self).__init__()
-
-        self.verbose = verbose
-        
-        self.sensor = sensor
-        self.active_lenslets = np.ones(self.sensor.n_lenslets).astype(int)
-        self.mirror = mirror
-
-        self.update_rate = ccfg.loop_update_rate
-
-        n_lenslets = self.sensor.n_lenslets
-        n_actuators = self.mirror.n_actuators
-        
-        self.poke = None
-        self.closed = False
-        self.safe = True
-
-        # try to load the poke file specified in
-        # ciao_config.py; if it doesn't exist, create
-        # a dummy poke with all 1's; this will result
-        # in an inverse control matrix with very low
-        # gains, i.e. the mirror won't be driven
-        if not os.path.exists(ccfg.poke_filename):
-            dummy = np.ones((2*n_lenslets,n_actuators))
-            np.savetxt(ccfg.poke_filename,dummy)
-            
-        self.load_poke(ccfg.poke_filename)
-        self.gain = ccfg.loop_gain
-        self.loss = ccfg.loop_loss
-        self.paused = False
-        self.n = 0
+        # the loop's state and control law are in LoopEngine (engine.py);
+        # Loop adds the timers, signals, and dialogs used by the UI
+        QObject.__init__(self)
+        LoopEngine.__init__(self,sensor,mirror,verbose)
+        self.snapshot_pending = False
         try:
             self.started.connect(self.sensor.beeper.cache_tones)
         except TypeError:
             pass
-        self.update_timer = BlockTimer('Loop update method')
-        try:
-            self.profile_update_method = ccfg.profile_loop_update_method
-        except:
-            self.profile_update_method = False
-
         
     def start(self):
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update)
-        self.timer.start(int(1.0/self.update_rate*1000.0)) # added int() --JDR
+        if self.pipelined:
+            self.pipeline = Pipeline(self,self.pipeline_buffers)
+            if not self.paused:
+                self.pipeline.start()
+        elif self.threaded:
+            self.thread = LoopThread(self)
+            self.thread.start()
+        else:
+            self.timer = QTimer()
+            self.timer.timeout.connect(self.update)
+            self.timer.start(int(1.0/self.update_rate*1000.0)) # added int() --JDR
         self.started.emit()
-        
-    def has_poke(self):
-        return self.poke is not None
-
-    def pause(self):
-        self.mirror.pause()
-        self.sensor.pause()
-        self.paused = True
-
-    def unpause(self):
-        self.mirror.unpause()
-        self.sensor.unpause()
-        self.paused = False
-        print('loop unpaused')
-
-    def set_safe(self,val):
-        self.safe = val
 
-    def set_paused(self,val):
-        if val:
-            self.mirror.pause()
-            self.sensor.pause()
-            self.paused = True
-        else:
-            self.mirror.unpause()
-            self.sensor.unpause()
-            self.paused = False
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread.join()
+            self.thread = None
+        if self.precomputer is not None:
+            self.precomputer.stop()
+        if self.refiner is not None:
+            self.refiner.stop()
+        if self.archiver is not None:
+            self.archiver.stop()
+        
+    def post_snapshot(self,frame=None):
+        # send the UI a Snapshot, unless it hasn't yet drawn the last one,
+        # in which case the UI would only fall behind; the signal is
+        # queued, so the UI draws it in its own thread
+        if not self.snapshot_pending:
+            self.snapshot_pending = True
+            self.snapshot.emit(Snapshot(self,frame))
+
+    def snapshot_done(self):
+        self.snapshot_pending = False
         
     @pyqtSlot()
     def update(self):
 
         if self.profile_update_method:
             self.update_timer.tick('start')
-        if not self.paused:
-            if self.verbose>=5:
-                print('Updating loop.')
-
-
-            self.sensor.update()
-
-            if self.profile_update_method:
-                self.update_timer.tick('sensor.update')
-            
-            current_active_lenslets = np.ones(self.active_lenslets.shape)
-            
-            # if we're in safe mode, check the boxes:
-            if self.safe:
-                current_active_lenslets[np.where(self.sensor.box_maxes<ccfg.spots_threshold)] = 0
-            
-            if self.closed and self.has_poke():
-
-
-                lenslets_changed = not all(self.active_lenslets==current_active_lenslets)
-                all_lenslets_active = np.sum(current_active_lenslets)==self.sensor.n_lenslets
-                # if the lenslets have changed, we have two options:
-                # 1. if they're not all active, and ccfg.poke_invert_on_demand
-                #    is set to True, then we do one of two things:
-                #    a. if the active lenslets have changed, then we need to
-                #       re-invert and set ready_to_correct True
-                #    b. if the active lenslets haven't changed, then we just
-                #       set ready_to_correct true
-                # 2. if they're not all active, and ccfg.poke_invert_on_demand
-                #    is set to False, then we need to set ready_to_correct to False
-                # 3. if they're all active, set ready_to_correct True
-
-                if not all_lenslets_active:
-                    if ccfg.poke_invert_on_demand:
-                        if lenslets_changed:
-                            self.poke.invert(mask=current_active_lenslets)
-                        self.ready_to_correct = True
-                    else:
-                        self.ready_to_correct = False
-                else:
-                    self.ready_to_correct = True
-
-
-                xs = self.sensor.x_slopes[np.where(current_active_lenslets)[0]]
-                ys = self.sensor.y_slopes[np.where(current_active_lenslets)[0]]
-
-                if self.ready_to_correct:
-                    assert 2*len(xs)==self.poke.ctrl.shape[1]
-                
-                if self.verbose>=1:
-                    error = self.sensor.error
-                    pcount = int(round(error*1e8))
-                    print('rms'+'.'*pcount)
-
-                if self.ready_to_correct:
-                    slope_vec = np.hstack((xs,ys))
-                    command = self.gain * np.dot(self.poke.ctrl,slope_vec)
-
-                    #command = self.mirror.get_command()*(1-self.loss) - command
-                    command = self.mirror.get_command()*(1-self.loss) - command
-                    self.mirror.set_command(command)
-                    self.mirror.update()
-                    #print(command)
-
-                    if self.profile_update_method:
-                        self.update_timer.tick('mirror.update')
-                    
-                    if self.verbose>=1:
-                        if command.max()>ccfg.mirror_command_max*.99:
-                            print('actuator saturated')
-                        if command.min()<ccfg.mirror_command_min*.99:
-                            print('actuator saturated')
-                else:
-                    print('not ready to correct')
-
-            self.active_lenslets[:] = current_active_lenslets[:]
-
-            
-        self.n = self.n + 1
+        with self.update_lock:
+            self.step()
         if self.profile_update_method:
             self.update_timer.tick('end update')
             self.update_timer.tock()
             
         self.finished.emit()
+        self.post_snapshot()
+
+    def report_error(self,message):
+        error_message(message)
+
+    def select_poke_filename(self,poke_filename):
+        error_message('Could not find %s.'%poke_filename)
+        options = QFileDialog.Options()
+        #options |= QFileDialog.DontUseNativeDialog
+        poke_filename, _ = QFileDialog.getOpenFileName(
+                        None,
+                        "Please select a poke file.",
+                        ccfg.poke_directory,
+                        "Poke files (*.txt *.npy)",
+                        options=options)
+        return poke_filename
         
-        
-    def load_poke(self,poke_filename=None):
-        try:
-            poke = np.loadtxt(poke_filename)
-        except Exception as e:
-            error_message('Could not find %s.'%poke_filename)
-            options = QFileDialog.Options()
-            #options |= QFileDialog.DontUseNativeDialog
-            poke_filename, _ = QFileDialog.getOpenFileName(
-                            None,
-                            "Please select a poke file.",
-                            ccfg.poke_directory,
-                            "Text Files (*.txt)",
-                            options=options)
-            poke = np.loadtxt(poke_filename)
-
-        py,px = poke.shape
-        expected_py = self.sensor.n_lenslets*2
-        expected_px = self.mirror.n_actuators
-        dummy = np.ones((expected_py,expected_px))
-        
-        try:
-            assert (py==expected_py and px==expected_px)
-        except AssertionError as ae:
-            error_message('Poke matrix has shape (%d,%d), but (%d,%d) was expected. Using dummy matrix.'%(py,px,expected_py,expected_px))
-            poke = dummy
-            
-        self.poke = Poke(poke)
-        self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
-
     def invert(self):
         if self.poke is not None:
             self.pause()
@@ -239,45 +163,44 @@ class Loop(QObject):
             time.sleep(.001)
             self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
 
-    def set_n_modes(self,n):
+    def run_poke(self):
+        # poke_mode 'sequential' steps one actuator at a time through
+        # poke_n_command_steps commands; 'hadamard' and 'random' move every
+        # actuator at once (see calibration.py)
         try:
-            self.poke.n_modes = n
+            mode = ccfg.poke_mode
         except Exception as e:
-            print(e)
+            mode = 'sequential'
 
-    def get_n_modes(self):
-        out = -1
-        try:
-            out = self.poke.n_modes
-        except Exception as e:
-            print(e)
-        return out
+        self.pause()
+        time.sleep(1)
 
-    def get_condition_number(self):
-        out = -1
-        try:
-            out = self.poke.cutoff_cond
-        except Exception as e:
-            print(e)
-        if out>2**32:
-            out = np.inf
-        return out
-            
-    def run_poke(self):
+        if mode in ['hadamard','random']:
+            poke,commands = self.measure_poke_multiplexed(mode)
+        else:
+            poke,commands = self.measure_poke_sequential()
+        self.mirror.flatten()
+        self.save_poke(poke,commands)
+        self.poke = Poke(poke)
+        self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
+        self.unpause()
+
+    def measure_poke_sequential(self):
         cmin = ccfg.poke_command_min
         cmax = ccfg.poke_command_max
         n_commands = ccfg.poke_n_command_steps
         commands = np.linspace(cmin,cmax,n_commands)
 
-        self.pause()
-        time.sleep(1)
-        
         n_lenslets = self.sensor.n_lenslets
         n_actuators = self.mirror.n_actuators
         
         x_mat = np.zeros((n_lenslets,n_actuators,n_commands))
         y_mat = np.zeros((n_lenslets,n_actuators,n_commands))
-        
+
+        # each actuator's frames are collected in one stack, which is
+        # centroided in a single call once the actuator has been stepped
+        # through all of the commands
+        stack = None
         for k_actuator in range(n_actuators):
             self.mirror.flatten()
             for k_command in range(n_commands):
@@ -287,12 +210,17 @@ class Loop(QObject):
                 #print k_actuator,k_command
                 QApplication.processEvents()
                 time.sleep(.01)
-                self.sensor.sense()
-                x_mat[:,k_actuator,k_command] = self.sensor.x_slopes
-                y_mat[:,k_actuator,k_command] = self.sensor.y_slopes
+                self.sensor.image = self.sensor.get_fresh_image()
+                if stack is None:
+                    stack = np.zeros((n_commands,)+self.sensor.image.shape,dtype=self.sensor.image.dtype)
+                stack[k_command,:,:] = self.sensor.image
                 self.finished.emit()
+                self.post_snapshot()
+            x_cent,y_cent = self.sensor.centroid_stack(stack)
+            x_slopes,y_slopes = self.sensor.stack_slopes(x_cent,y_cent)
+            x_mat[:,k_actuator,:] = x_slopes.T
+            y_mat[:,k_actuator,:] = y_slopes.T
         # print 'done'
-        self.mirror.flatten()
         
         d_commands = np.mean(np.diff(commands))
         d_x_mat = np.diff(x_mat,axis=2)
@@ -301,30 +229,54 @@ class Loop(QObject):
         x_response = np.mean(d_x_mat/d_commands,axis=2)
         y_response = np.mean(d_y_mat/d_commands,axis=2)
         poke = np.vstack((x_response,y_response))
-        ns = now_string()
+        return poke,commands
 
+    def measure_poke_multiplexed(self,mode):
+        # every frame moves every actuator by +/-poke_multiplex_amplitude
+        # from the flat, so each actuator's response is averaged over all
+        # of the frames rather than poke_n_command_steps of them
+        try:
+            amplitude = ccfg.poke_multiplex_amplitude
+        except Exception as e:
+            amplitude = (ccfg.poke_command_max-ccfg.poke_command_min)/8.0
+        try:
+            n_repeats = ccfg.poke_multiplex_repeats
+        except Exception as e:
+            n_repeats = 1
 
-        # After we make a new poke matrix, we will save it in
-        # two files: an archive file that can be used to keep
-        # track of old poke matrices, and the file specified
-        # in the config file, e.g., 'poke.txt'.
-        # The archive filename will use the time date string
-        # generated above. This filename will also be used to
-        # save the commands and the mirror mode chart PDF.
-        
-        poke_fn = ccfg.poke_filename
-        archive_poke_fn = os.path.join(ccfg.poke_directory,'%s_poke.txt'%ns)
-        archive_command_fn = os.path.join(ccfg.poke_directory,'%s_currents.txt'%ns)
-        archive_chart_fn = os.path.join(ccfg.poke_directory,'%s_modes.pdf'%ns)
-        
-        np.savetxt(poke_fn,poke)
-        np.savetxt(archive_poke_fn,poke)
-        np.savetxt(archive_command_fn,commands)
-        save_modes_chart(archive_chart_fn,poke,commands,self.mirror.mirror_mask)
-        self.poke = Poke(poke)
-        self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
-        time.sleep(1)
-        self.unpause()
+        n_lenslets = self.sensor.n_lenslets
+        n_actuators = self.mirror.n_actuators
+        patterns = multiplex_patterns(n_actuators,mode,n_repeats)
+        n_frames = patterns.shape[0]
+        commands = amplitude*patterns
+        flat = self.mirror.flat.copy()
+        print('poke: %d %s patterns'%(n_frames,mode))
+
+        slopes = np.zeros((n_frames,2*n_lenslets))
+        # frames are centroided in stacks of stack_size, rather than all
+        # at once, to bound the memory the stack takes
+        stack_size = 16
+        stack = None
+        for k0 in range(0,n_frames,stack_size):
+            k1 = min(k0+stack_size,n_frames)
+            for k_frame in range(k0,k1):
+                self.mirror.set_command(flat+commands[k_frame])
+                self.mirror.send()
+                QApplication.processEvents()
+                time.sleep(.01)
+                self.sensor.image = self.sensor.get_fresh_image()
+                if stack is None:
+                    stack = np.zeros((stack_size,)+self.sensor.image.shape,dtype=self.sensor.image.dtype)
+                stack[k_frame-k0,:,:] = self.sensor.image
+                self.finished.emit()
+                self.post_snapshot()
+            x_cent,y_cent = self.sensor.centroid_stack(stack[:k1-k0])
+            x_slopes,y_slopes = self.sensor.stack_slopes(x_cent,y_cent)
+            slopes[k0:k1,:n_lenslets] = x_slopes
+            slopes[k0:k1,n_lenslets:] = y_slopes
+
+        poke = demultiplex(slopes,patterns,amplitude)
+        return poke,commands
 
     def set_closed(self,val):
         self.closed = val
@@ -345,6 +297,8 @@ class SerialLoop(QObject):
         n_actuators = self.mirror.n_actuators
         
         self.poke = None
+        # saves poke matrices in the background (see run_poke)
+        self.archiver = None
         self.closed = False
 
         # try to load the poke file specified in
@@ -352,9 +306,9 @@ class SerialLoop(QObject):
         # a dummy poke with all 1's; this will result
         # in an inverse control matrix with very low
         # gains, i.e. the mirror won't be driven
-        if not os.path.exists(ccfg.poke_filename):
+        if not (os.path.exists(ccfg.poke_filename) or os.path.exists(binary_filename(ccfg.poke_filename))):
             dummy = np.ones((2*n_lenslets,n_actuators))
-            np.savetxt(ccfg.poke_filename,dummy)
+            save_array(ccfg.poke_filename,dummy)
             
         self.load_poke(ccfg.poke_filename)
         self.gain = ccfg.loop_gain
@@ -420,7 +374,7 @@ class SerialLoop(QObject):
                 
     def load_poke(self,poke_filename=None):
         try:
-            poke = np.loadtxt(poke_filename)
+            poke = load_array(poke_filename)
         except Exception as e:
             error_message('Could not find %s.'%poke_filename)
             options = QFileDialog.Options()
@@ -429,9 +383,9 @@ class SerialLoop(QObject):
                             None,
                             "Please select a poke file.",
                             ccfg.poke_directory,
-                            "Text Files (*.txt)",
+                            "Poke files (*.txt *.npy)",
                             options=options)
-            poke = np.loadtxt(poke_filename)
+            poke = load_array(poke_filename)
 
         py,px = poke.shape
         expected_py = self.sensor.n_lenslets*2
@@ -457,8 +411,10 @@ class SerialLoop(QObject):
             time.sleep(1)
 
     def set_n_modes(self,n):
+        # takes effect at once, from the poke's cached SVD
         try:
-            self.poke.n_modes = n
+            self.poke.set_n_modes(n)
+            self.close_ok = ccfg.loop_condition_llim<self.get_condition_number()<ccfg.loop_condition_ulim
         except Exception as e:
             print(e)
 
@@ -502,7 +458,6 @@ class SerialLoop(QObject):
                 QApplication.processEvents()
                 time.sleep(.01)
                 self.sensor.sense()
-                self.sensor_mutex.lock()
                 x_mat[:,k_actuator,k_command] = self.sensor.x_slopes
                 y_mat[:,k_actuator,k_command] = self.sensor.y_slopes
         # print 'done'
@@ -525,19 +480,25 @@ class SerialLoop(QObject):
         # The archive filename will use the time date string
         # generated above. This filename will also be used to
         # save the commands and the mirror mode chart PDF.
+        # The files are written in the background, by an
+        # Archiver's process (see poke_analysis.py).
         
         poke_fn = ccfg.poke_filename
         archive_poke_fn = os.path.join(ccfg.poke_directory,'%s_poke.txt'%ns)
         archive_command_fn = os.path.join(ccfg.poke_directory,'%s_currents.txt'%ns)
         archive_chart_fn = os.path.join(ccfg.poke_directory,'%s_modes.pdf'%ns)
+        try:
+            text_copies = ccfg.save_text_copies
+        except Exception as e:
+            text_copies = True
         
-        np.savetxt(poke_fn,poke)
-        np.savetxt(archive_poke_fn,poke)
-        np.savetxt(archive_command_fn,commands)
-        save_modes_chart(archive_chart_fn,poke,commands,self.mirror.mirror_mask)
+        if self.archiver is None:
+            self.archiver = Archiver()
+        self.archiver.save_poke(poke,commands,self.mirror.mirror_mask,
+                                [poke_fn,archive_poke_fn,archive_command_fn,archive_chart_fn],
+                                text_copies,ns)
         self.poke = Poke(poke)
         
-        time.sleep(1)
         self.unpause()
 
     def set_closed(self,val):
@@ -1,25 +1,13 @@
 import numpy as np
 import time
-import centroid
 import sys
-from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
-                          QMutex, QObject, pyqtSlot)
-
-from PyQt5.QtWidgets import (QApplication, QPushButton, QWidget,
-                             QHBoxLayout, QVBoxLayout, QGraphicsScene,
-                             QLabel,QGridLayout, QCheckBox, QFrame, QGroupBox,
-                             QSpinBox,QDoubleSpinBox,QSizePolicy,QFileDialog,
-                             QErrorMessage, QSlider)
-from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, qRgb, QPen, QBitmap, QPalette, QIcon
 import os
-from matplotlib import pyplot as plt
 import datetime
-from .tools import error_message, now_string, prepend, colortable, get_ram, get_process
+from .tools import error_message, now_string, prepend, colortable, get_ram, get_process, load_array
 import copy
 from .zernike import Reconstructor
 import cProfile
 import scipy.io as sio
-from .poke_analysis import save_modes_chart
 from ctypes import CDLL,c_void_p
 from .search_boxes import SearchBoxes
 from .reference_generator import ReferenceGenerator
@@ -36,7 +24,8 @@ class MirrorController(object):
     def clip(self):
         self.clipped = (self.command.max()>=self.cmax or self.command.min()<=self.cmin)
         if self.clipped:
-            self.command = np.clip(self.command,self.cmin,self.cmax)
+            # in place, so that command_ptr still points at command
+            np.clip(self.command,self.cmin,self.cmax,out=self.command)
                 
     def set(self,vec):
         self.command[:] = vec[:]
@@ -132,10 +121,10 @@ class Mirror:
                     print('No mirror driver found. Using virtual mirror.')
                     self.controller = MirrorController()
             
-        self.mirror_mask = np.loadtxt(ccfg.mirror_mask_filename)
+        self.mirror_mask = load_array(ccfg.mirror_mask_filename)
         self.n_actuators = ccfg.mirror_n_actuators
-        self.flat = np.loadtxt(ccfg.mirror_flat_filename)
-        self.flat0 = np.loadtxt(ccfg.mirror_flat_filename)
+        self.flat = load_array(ccfg.mirror_flat_filename)
+        self.flat0 = self.flat.copy()
         self.command_max = ccfg.mirror_command_max
         self.command_min = ccfg.mirror_command_min
         self.settling_time = ccfg.mirror_settling_time_s
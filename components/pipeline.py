@@ -0,0 +1,247 @@
+import numpy as np
+import time
+import threading
+import queue
+
+class PipelineFrame:
+
+    def __init__(self,image,n_lenslets,n_actuators,zernikes,wavefront):
+        # everything one frame needs on its way through the pipeline,
+        # allocated once and reused; the stages copy their results into it,
+        # since the sensor's and reconstructor's buffers are overwritten by
+        # the next frame while this one is published
+        self.raw_image = np.zeros_like(image)
+        self.dark_subtracted_image = np.zeros(image.shape,dtype=np.int16)
+        self.image = self.raw_image
+        self.dark_image = None
+        self.slopes = np.zeros(2*n_lenslets)
+        self.x_slopes = self.slopes[:n_lenslets]
+        self.y_slopes = self.slopes[n_lenslets:]
+        self.box_maxes = np.zeros(n_lenslets)
+        self.x_centroids = np.zeros(n_lenslets)
+        self.y_centroids = np.zeros(n_lenslets)
+        self.zernikes = np.zeros_like(zernikes)
+        self.wavefront = np.zeros_like(wavefront)
+        self.error = 0.0
+        self.active_lenslets = np.zeros(n_lenslets,dtype=int)
+        self.command = np.zeros(n_actuators)
+        self.has_command = False
+        self.frame_number = -1
+        self.timestamp = 0
+
+
+class PipelineStage(threading.Thread):
+
+    def __init__(self,label,function,input_queue,output_queue,timeout=0.1,wait=None):
+        # wait, if given, is called before each frame and isn't counted
+        # as busy time
+        super(PipelineStage,self).__init__()
+        self.daemon = True
+        self.label = label
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.timeout = timeout
+        self.wait = wait
+        self.running = True
+        self.count = 0
+        self.busy_time = 0.0
+        self.errors = 0
+
+    def run(self):
+        while self.running:
+            try:
+                frame = self.input_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            if self.wait is not None:
+                self.wait()
+            t0 = time.perf_counter()
+            try:
+                self.function(frame)
+            except Exception as e:
+                print('%s stage: %s'%(self.label,e))
+                self.errors = self.errors + 1
+            self.busy_time = self.busy_time + time.perf_counter()-t0
+            self.count = self.count + 1
+            # the next queue has room for every frame in the pipeline,
+            # so this never blocks
+            self.output_queue.put(frame)
+
+    def stop(self):
+        self.running = False
+
+
+class Pipeline:
+
+    def __init__(self,loop,n_buffers=3):
+        """A Pipeline runs the loop's four steps--acquisition,
+        centroiding, reconstruction plus the control law, and sending the
+        command to the mirror--each in its own thread, so that e.g. frame
+        k+1 is centroided while the command for frame k is computed and the
+        command for frame k-1 is sent. Throughput is then set by the
+        slowest stage rather than by the sum of all four, at the cost of up
+        to one frame of latency per stage.
+
+        The stages pass n_buffers preallocated PipelineFrames around a ring
+        of bounded queues: free -> camera -> centroid -> control -> mirror
+        -> free. A stage that runs ahead of the next one runs out of free
+        frames and waits, so nothing is allocated or dropped between
+        stages; with a ThreadedCamera in 'newest' mode, old frames are
+        dropped at the camera instead.
+
+        The centroid stage writes the sensor's centroid and box arrays, and
+        the control stage keeps its own copy of the last command, since the
+        mirror's lags by a frame; each stage copies what the UI draws into
+        the frame. Because sensor.sense is not called, the slopes,
+        wavefront, and image are copied back into the sensor for the UI
+        only when it is ready to draw another frame, and the Snapshot takes
+        the centroids from the frame (see publish).
+
+        statistics returns each stage's occupancy, the fraction of the time
+        since the last call that it spent working, and each queue's depth;
+        a stage with occupancy near 1 is the bottleneck."""
+
+        self.loop = loop
+        self.sensor = loop.sensor
+        self.mirror = loop.mirror
+        self.n_buffers = n_buffers
+        image = self.sensor.cam.get_image()
+        self.frames = [PipelineFrame(image,self.sensor.n_lenslets,self.mirror.n_actuators,
+                                     self.sensor.zernikes,self.sensor.wavefront) for k in range(n_buffers)]
+        self.command = np.zeros(self.mirror.n_actuators)
+        self.stages = []
+        self.frame_count = 0
+        self.record_latencies(0)
+        self.running = False
+
+    def record_latencies(self,n):
+        # keep the latencies, from acquisition to the mirror update, of
+        # the next n frames
+        self.latency_ns = np.zeros(n,dtype=np.int64)
+        self.latency_count = 0
+
+    def start(self):
+        if self.running:
+            return
+        # every queue can hold every frame, so only the free queue ever
+        # runs empty
+        labels = ['camera','centroid','control','mirror']
+        functions = [self.acquire,self.centroid,self.control,self.send]
+        self.queues = [queue.Queue(maxsize=self.n_buffers) for k in range(len(labels))]
+        for frame in self.frames:
+            self.queues[0].put(frame)
+        self.command[:] = self.mirror.get_command()
+        self.stages = []
+        for k,(label,function) in enumerate(zip(labels,functions)):
+            self.stages.append(PipelineStage(label,function,self.queues[k],self.queues[(k+1)%len(labels)]))
+        self.stages[0].wait = self.loop.scheduler.wait
+        self.t_statistics = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+        self.running = True
+
+    def stop(self):
+        # stop and wait for all of the stages, e.g. before a calibration
+        # uses the camera and mirror directly
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            stage.join()
+        self.running = False
+
+    def acquire(self,frame):
+        self.loop.scheduler.tick()
+        frame.raw_image[...] = self.sensor.cam.get_image()
+        frame.timestamp = time.perf_counter_ns()
+        frame.frame_number = self.frame_count
+        self.frame_count = self.frame_count + 1
+
+    def centroid(self,frame):
+        sensor = self.sensor
+        frame.image,frame.dark_image = sensor.subtract_dark(frame.raw_image,out=frame.dark_subtracted_image)
+        t0 = time.time()
+        sensor.centroid_image(frame.image,frame.dark_image)
+        sensor.centroiding_time = time.time()-t0
+        x_slopes,y_slopes,tilt,tip = sensor.compute_slopes(sensor.x_centroids,sensor.y_centroids,
+                                                           frame.x_slopes,frame.y_slopes)
+        frame.box_maxes[:] = sensor.box_maxes
+        frame.x_centroids[:] = sensor.x_centroids
+        frame.y_centroids[:] = sensor.y_centroids
+        sensor.tilt = tilt
+        sensor.tip = tip
+        sensor.frame_timer.tick()
+
+    def control(self,frame):
+        sensor = self.sensor
+        if sensor.reconstruct_wavefront:
+            zernikes,wavefront,error,x_slopes,y_slopes = sensor.reconstruct(frame.x_slopes,frame.y_slopes)
+            frame.zernikes[:] = zernikes
+            frame.wavefront[...] = wavefront
+            frame.error = error
+            try:
+                sensor.beeper.beep(error)
+            except Exception as e:
+                print(e)
+        # the lock keeps e.g. set_n_modes from changing the poke mid-frame
+        with self.loop.update_lock:
+            command = self.loop.control(frame.slopes,frame.box_maxes,self.command)
+            frame.active_lenslets[:] = self.loop.active_lenslets
+        frame.has_command = command is not None
+        if frame.has_command:
+            self.command[:] = command
+            frame.command[:] = command
+
+    def send(self,frame):
+        if frame.has_command:
+            self.mirror.set_command(frame.command)
+            self.mirror.update()
+        if self.latency_count<len(self.latency_ns):
+            self.latency_ns[self.latency_count] = time.perf_counter_ns()-frame.timestamp
+        self.latency_count = self.latency_count + 1
+        self.loop.n = self.loop.n + 1
+        if not self.loop.snapshot_pending or self.sensor.logging:
+            self.publish(frame)
+            if self.sensor.logging:
+                self.sensor.log(frame.x_centroids,frame.y_centroids)
+
+    def publish(self,frame):
+        # copy, rather than point, the sensor at the frame's buffers, which
+        # will be overwritten while the UI draws them, and pass a Snapshot
+        # of the frame on to the UI
+        sensor = self.sensor
+        sensor.image = frame.image.copy()
+        sensor.image_min,sensor.image_mean,sensor.image_max = sensor.centroider.image_statistics(
+            frame.image,dark_image=frame.dark_image,stride_p=sensor.image_statistics_stride)
+        sensor.slopes[:] = frame.slopes
+        if sensor.reconstruct_wavefront:
+            sensor.zernikes = frame.zernikes.copy()
+            sensor.wavefront = frame.wavefront.copy()
+            sensor.error = frame.error
+        self.loop.post_snapshot(frame)
+        if self.loop.profile_update_method:
+            t = time.perf_counter()
+            if t-self.t_statistics>1.0:
+                print('Loop pipeline: %s'%self.report())
+
+    def statistics(self):
+        # occupancy of each stage since the last call, and the number of
+        # frames waiting in each stage's input queue (for the camera, the
+        # number of free frames)
+        t = time.perf_counter()
+        dt = t-self.t_statistics
+        self.t_statistics = t
+        out = []
+        for stage in self.stages:
+            out.append({'stage':stage.label,
+                        'occupancy':stage.busy_time/dt,
+                        'frames':stage.count,
+                        'queue_depth':stage.input_queue.qsize(),
+                        'errors':stage.errors})
+            stage.busy_time = 0.0
+            stage.count = 0
+        return out
+
+    def report(self):
+        stats = self.statistics()
+        return ', '.join(['%s %0.0f%% (%d waiting)'%(s['stage'],100.0*s['occupancy'],s['queue_depth']) for s in stats])
@@ -1,71 +1,123 @@
 import ciao_config as ccfg
 import numpy as np
 import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+
+    def __init__(self,max_size):
+        """A dictionary of at most max_size items, which evicts the least
+        recently used item to make room for a new one, and counts hits,
+        misses, and evictions."""
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self,key):
+        # doesn't count as a use
+        return key in self.items
+
+    def get(self,key):
+        # the item stored under key, or None
+        try:
+            value = self.items[key]
+        except KeyError as ke:
+            self.misses+=1
+            return None
+        self.items.move_to_end(key)
+        self.hits+=1
+        return value
+
+    def put(self,key,value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items)>self.max_size:
+            self.items.popitem(last=False)
+            self.evictions+=1
+
+    def statistics(self):
+        return {'size':len(self.items),'hits':self.hits,'misses':self.misses,'evictions':self.evictions}
+
 
 class Poke:
     def __init__(self,poke_matrix):
         self.poke = poke_matrix
         poke_rows = poke_matrix.shape[1]
         self.n_modes = min(ccfg.loop_n_control_modes,poke_rows)
-        
-        self.n_ctrl_stored = 0
-        self.ctrl_dict = {}
-        self.ctrl_key_list = []
+
+        # control matrices, with their condition numbers, for each mask and
+        # number of modes, so that in poke_invert_on_demand mode a mask
+        # seen recently, e.g. a lenslet flickering about spots_threshold,
+        # costs a lookup rather than an inversion
+        self.ctrl_cache = LRUCache(ccfg.ctrl_dictionary_max_size)
+
+        # the SVD of the poke matrix, for each mask, is kept, so that
+        # changing n_modes rebuilds ctrl with one matrix product (see
+        # get_factors and set_n_modes); the unmasked SVD, from which the
+        # masked ones are downdated, is kept apart, so that it's never
+        # evicted
+        self.factors_cache = LRUCache(ccfg.ctrl_dictionary_max_size)
+        self.full_factors = {}
+
+        # the caches are shared with a Precomputer's thread
+        self.lock = threading.RLock()
+
+        # masked SVDs may be derived from the unmasked one (see
+        # downdate_factors)
+        try:
+            self.downdate = ccfg.poke_downdate
+        except Exception as e:
+            self.downdate = True
+        try:
+            self.downdate_tolerance = ccfg.poke_downdate_tolerance
+        except Exception as e:
+            self.downdate_tolerance = 1e-8
+        try:
+            self.downdate_verify = ccfg.poke_downdate_verify
+        except Exception as e:
+            self.downdate_verify = False
+        self.n_downdates = 0
+        self.n_downdate_failures = 0
+        self.downdate_error = 0.0
+        self.mask = None
+        self.subtract_mean = False
         self.invert()
 
-    def mask_to_key(self,mask):
+    def mask_digest(self,mask):
+        # a short digest of the mask's bits; no mask, or a mask with every
+        # lenslet active, is None
         if mask is None:
-            return 'None'
-        else:
-            return '_'.join(['%d'%idx for idx in np.where(mask==0)[0]])+'_%d'%self.n_modes
+            return None
+        bits = np.asarray(mask)!=0
+        if bits.all():
+            return None
+        return hashlib.sha1(np.packbits(bits).tobytes()).digest()
 
-    def get_stored_ctrl(self,mask):
-        key = self.mask_to_key(mask)
-        try:
-            out = self.ctrl_dict[key]
-        except KeyError as ke:
-            out = None
+    def mask_to_key(self,mask,subtract_mean=False):
+        return (self.mask_digest(mask),self.n_modes,subtract_mean)
 
-    def store_ctrl(self,mask,ctrl):
-        key = self.mask_to_key(mask)
-        if key in self.ctrl_dict.keys():
-            return
-        self.ctrl_dict[key] = ctrl
-        self.ctrl_key_list.append(key)
-        self.n_ctrl_stored+=1
-        #self.print_dict_info()
-        assert self.n_ctrl_stored==len(self.ctrl_dict.keys())
-        assert self.n_ctrl_stored==len(self.ctrl_key_list)
+    def get_stored_ctrl(self,mask,subtract_mean=False):
+        # (ctrl,cutoff_cond,full_cond) for mask and the current n_modes,
+        # or None
+        with self.lock:
+            return self.ctrl_cache.get(self.mask_to_key(mask,subtract_mean))
+
+    def store_ctrl(self,mask,subtract_mean=False):
+        with self.lock:
+            self.ctrl_cache.put(self.mask_to_key(mask,subtract_mean),(self.ctrl,self.cutoff_cond,self.full_cond))
 
     def print_dict_info(self):
-        print('N stored:',self.n_ctrl_stored)
-        print('Current dictionary:')
-        print(self.ctrl_dict.keys())
-        print('Current key list:')
-        print(self.ctrl_key_list)
-        print()
-
-    def trim_ctrl_dict(self):
-        if self.n_ctrl_stored<=ccfg.ctrl_dictionary_max_size:
-            return
-        else:
-            n_to_remove = self.n_ctrl_stored-ccfg.ctrl_dictionary_max_size
-            print('Removing %d'%n_to_remove)
-            for k in range(n_to_remove):
-                key = self.ctrl_key_list[k]
-                self.print_dict_info()
-                print('Key to remove: %s'%key)
-                del self.ctrl_dict[key]
-                self.n_ctrl_stored-=1
-                self.ctrl_key_list.remove(key)
-        
-    def invert(self,subtract_mean=False,mask=None):
-        self.ctrl = self.get_stored_ctrl(mask)
-        if self.ctrl is not None:
-            return
-        
-        t0 = time.time()
+        print('Control matrices: %s'%self.ctrl_cache.statistics())
+        print('SVDs: %s, %d downdated, %d failed'%(self.factors_cache.statistics(),self.n_downdates,self.n_downdate_failures))
 
+    def masked_poke(self,mask=None,subtract_mean=False):
         poke = self.poke.copy()
 
         #mask = np.round(np.random.rand(poke.shape[0]//2)).astype(np.int)
@@ -73,47 +125,256 @@ class Poke:
             double_mask = np.hstack((mask,mask))
             poke = poke[np.where(double_mask)[0],:]
 
-        double_n_lenslets,n_actuators = poke.shape
-
         if subtract_mean:
             # subtract mean influence across actuators from
             # each actuator's influence
             # transpose, broadcast, transpose back:
             m_poke = np.mean(poke,axis=1)
             poke = (poke.T - m_poke).T
+        return poke
+
+    def get_factors(self,mask=None,subtract_mean=False):
+        # the economy SVD U,s,Vt of the (masked) poke matrix, computed once
+        # per mask and kept for up to ccfg.ctrl_dictionary_max_size masks
+        key = (self.mask_digest(mask),subtract_mean)
+        if key[0] is None:
+            try:
+                return self.full_factors[subtract_mean]
+            except KeyError as ke:
+                factors = self.decompose(None,subtract_mean)
+                self.full_factors[subtract_mean] = factors
+                return factors
+
+        with self.lock:
+            factors = self.factors_cache.get(key)
+        if factors is None:
+            factors = self.decompose(mask,subtract_mean)
+            with self.lock:
+                self.factors_cache.put(key,factors)
+        return factors
 
-        U,s,V = np.linalg.svd(poke)
+    def decompose(self,mask,subtract_mean=False):
+        # the SVD of the masked poke matrix, by downdating if possible
+        factors = None
+        if self.downdate and self.mask_digest(mask) is not None:
+            factors = self.downdate_factors(mask,subtract_mean)
+        if factors is None:
+            # U is 2n_lenslets x n_actuators rather than square, which is
+            # all the pseudoinverse uses
+            factors = np.linalg.svd(self.masked_poke(mask,subtract_mean),full_matrices=False)
+        return factors
+
+    def precompute(self,mask,subtract_mean=False):
+        """Compute and store the control matrix for mask and the current
+        n_modes, unless it's already stored, without changing ctrl; for a
+        Precomputer, in its thread. The mask's SVD isn't kept. Return True
+        if a matrix was computed."""
+        key = self.mask_to_key(mask,subtract_mean)
+        with self.lock:
+            if key in self.ctrl_cache:
+                return False
+        factors = self.decompose(mask,subtract_mean)
+        ctrl,cutoff_cond = self.truncate(factors,key[1])
+        s = factors[1]
+        with self.lock:
+            self.ctrl_cache.put(key,(ctrl,cutoff_cond,(s[0]/s).max()))
+        return True
+
+    def downdate_factors(self,mask,subtract_mean=False):
+        """Derive the SVD of the masked poke matrix from the SVD U S Vt of
+        the whole one, which is computed once and cached, instead of
+        decomposing the tall masked matrix.
+
+        Removing rows U_r of U leaves rows U_m with Gram matrix
+        C = I - U_r.T U_r. With the Cholesky factorization C = R.T R,
+        U_m = W R, where W = U_m R^-1 has orthonormal columns, so the
+        masked matrix is W (R S) Vt, and the SVD X s Y.T of the
+        n_actuators square matrix in the middle gives its SVD,
+        (W X) s (Y.T Vt). This costs two small decompositions and one
+        product with U_m.
+
+        The result is checked by its relative residual against the masked
+        matrix, applied to random vectors; if that exceeds
+        poke_downdate_tolerance, or if removing the rows makes the matrix
+        rank deficient, or nearly so (C has an eigenvalue below
+        poke_downdate_tolerance), None is returned, and the SVD is computed directly. With
+        poke_downdate_verify, the control matrix is also compared with one
+        computed from a direct SVD, and the relative difference kept in
+        downdate_error."""
+        U,s,Vt = self.get_factors(None,subtract_mean)
+        double_mask = np.hstack((mask,mask))!=0
+        U_r = U[~double_mask,:]
+
+        # C's smallest eigenvalue is the squared smallest singular value of
+        # U_m, by which the downdate divides
+        C = np.eye(len(s))-np.dot(U_r.T,U_r)
+        if np.linalg.eigvalsh(C).min()<=self.downdate_tolerance:
+            self.n_downdate_failures+=1
+            return None
+        R = np.linalg.cholesky(C).T
+        X,s_m,Yt = np.linalg.svd(R*s[None,:])
+        U_m = np.dot(U[double_mask,:],np.linalg.solve(R,X))
+        Vt_m = np.dot(Yt,Vt)
+        factors = (U_m,s_m,Vt_m)
+
+        # the residual on a few random vectors, which costs much less than
+        # multiplying the factors out
+        probes = np.random.randn(len(s),3)
+        expected = np.dot(self.poke,probes)[double_mask,:]
+        if subtract_mean:
+            expected = expected-np.mean(self.poke[double_mask,:],axis=1)[:,None]*np.sum(probes,axis=0)[None,:]
+        residual = np.linalg.norm(np.dot(U_m,s_m[:,None]*np.dot(Vt_m,probes))-expected)/np.linalg.norm(expected)
+        if not residual<self.downdate_tolerance:
+            print('SVD downdate residual %0.1e; computing the SVD directly.'%residual)
+            self.n_downdate_failures+=1
+            return None
+        self.n_downdates+=1
+
+        if self.downdate_verify:
+            direct = np.linalg.svd(self.masked_poke(mask,subtract_mean),full_matrices=False)
+            ctrl = self.truncate(direct,self.n_modes)[0]
+            self.downdate_error = np.linalg.norm(self.truncate(factors,self.n_modes)[0]-ctrl)/np.linalg.norm(ctrl)
+            print('SVD downdate: residual %0.1e, control matrix error %0.1e'%(residual,self.downdate_error))
+        return factors
+
+    def truncate(self,factors,n_modes):
+        # the control matrix and condition number using the first n_modes
+        # modes, i.e. the pseudoinverse of the poke matrix with the higher
+        # modes zeroed: V[:,:n] diag(1/s[:n]) U[:,:n].T, as one product;
+        # as with pinv, singular values that are zero to within rounding
+        # error are left out
+        U,s,Vt = factors
+        tolerance = s[0]*max(U.shape[0],Vt.shape[1])*np.finfo(float).eps
+        n = min(n_modes,np.sum(s>tolerance))
+        ctrl = np.dot(Vt[:n,:].T/s[:n],U[:,:n].T)
+        cutoff_cond = s[0]/s[n_modes-1]
+        return ctrl,cutoff_cond
+
+    def set_n_modes(self,n_modes):
+        # re-truncate the current mask's cached SVD
+        self.n_modes = min(n_modes,self.poke.shape[1])
+        self.invert(self.subtract_mean,self.mask)
+        print('%d modes %0.4e'%(self.n_modes,self.cutoff_cond))
+
+    def invert(self,subtract_mean=False,mask=None):
+        self.mask = mask
+        self.subtract_mean = subtract_mean
+        stored = self.get_stored_ctrl(mask,subtract_mean)
+        if stored is not None:
+            self.ctrl,self.cutoff_cond,self.full_cond = stored
+            return
+
+        t0 = time.time()
+
+        factors = self.get_factors(mask,subtract_mean)
+        s = factors[1]
         self.full_cond = (s[0]/s).max()
-        self.cutoff_cond = s[0]/s[self.n_modes-1]
-        
-        # zero upper modes
-        if self.n_modes<n_actuators:
-            s[self.n_modes:] = 0
-
-        term1 = V.T
-        term2 = np.zeros([n_actuators,double_n_lenslets])
-        term2[:n_actuators,:n_actuators] = np.linalg.pinv(np.diag(s))
-        term3 = U.T
-        ctrlmat = np.dot(np.dot(term1,term2),term3)
+        self.ctrl,self.cutoff_cond = self.truncate(factors,self.n_modes)
         dt = time.time()-t0
 
-
-        sanity_check = False
-        if sanity_check:
-            # double check the explicit Moore-Penrose pseudoinverse
-            # above with LAPACK implementation (pinv)
-            cutoff_cond = s[n_modes]/s[0]
-            test = np.linalg.pinv(poke,cutoff_cond)
-            if np.allclose(test,ctrlmat):
-                print('Pseudoinverse is correct.')
-                sys.exit()
-            else:
-                print('Pseudoinverse is incorrect.')
-                sys.exit()
-            
-        self.ctrl = ctrlmat
-        print('SVD %d modes %0.4e'%(self.n_modes,self.cutoff_cond))
-        self.store_ctrl(mask,self.ctrl)
-        self.trim_ctrl_dict()
+        print('SVD %d modes %0.4e (%0.1f ms)'%(self.n_modes,self.cutoff_cond,dt*1000))
+        self.store_ctrl(mask,subtract_mean)
         self.print_dict_info()
-        print()
+
+
+def likely_masks(x,y,pitch,n_rings=2,n_sectors=8):
+    """Masks of the lenslets centered at x,y, pitch apart, that are likely
+    to be lost together when imaging the eye: the outer 1 to n_rings rings
+    of lenslets, as the pupil shrinks or is vignetted at its edge, and each
+    of n_sectors sectors of the outer n_rings rings, as an eyelid or
+    eyelashes cover one side. The rings are peeled off the lenslet array,
+    since its edge is ragged: a lenslet with fewer than four neighbors is
+    in the outer ring."""
+    distances = np.sqrt((x[:,None]-x[None,:])**2+(y[:,None]-y[None,:])**2)
+    neighbors = (distances>0.5*pitch)&(distances<1.25*pitch)
+    ring = np.zeros(len(x),dtype=int)
+    remaining = np.ones(len(x),dtype=bool)
+    for k in range(1,n_rings+1):
+        edge = remaining&(np.sum(neighbors[:,remaining],axis=1)<4)
+        ring[edge] = k
+        remaining = remaining&~edge
+
+    dx = x-x.mean()
+    dy = y-y.mean()
+    sector = np.floor((np.arctan2(dy,dx)+np.pi)/(2*np.pi)*n_sectors).astype(int)%n_sectors
+    outer = ring>0
+    candidates = [(ring==0)|(ring>k) for k in range(1,n_rings+1)]
+    candidates = candidates+[~(outer&(sector==k)) for k in range(n_sectors)]
+    masks = []
+    for mask in candidates:
+        if mask.all() or not mask.any():
+            continue
+        if any([np.array_equal(mask,m) for m in masks]):
+            continue
+        masks.append(mask.astype(int))
+    return masks
+
+
+class Precomputer(threading.Thread):
+
+    def __init__(self,loop,masks,n_recent=10,interval_s=0.01):
+        """A Precomputer computes in the background the control matrices for
+        pupil masks the loop is likely to need, so that when lenslets drop
+        out with poke_invert_on_demand on, Poke.invert finds the matrix
+        already stored instead of computing it in the loop.
+
+        It keeps the matrices stored for masks, e.g. from likely_masks, and
+        for the n_recent masks the loop has switched to most recently (see
+        observe), recent ones first. Since the matrices are stored per poke
+        matrix and number of modes, they are computed again when either
+        changes. The loop's poke's cache is enlarged to hold them. After
+        each matrix it sleeps interval_s, to leave the processor to the
+        loop; the SVDs themselves release the GIL."""
+        super(Precomputer,self).__init__()
+        self.daemon = True
+        self.loop = loop
+        self.masks = masks
+        self.n_recent = n_recent
+        self.interval_s = interval_s
+        self.recent = OrderedDict()
+        self.condition = threading.Condition()
+        self.pending = True
+        self.running = True
+        self.n_computed = 0
+
+    def observe(self,mask):
+        # called by the loop with each new mask
+        mask = np.array(mask)
+        key = hashlib.sha1(np.packbits(mask!=0).tobytes()).digest()
+        with self.condition:
+            self.recent[key] = mask
+            self.recent.move_to_end(key)
+            while len(self.recent)>self.n_recent:
+                self.recent.popitem(last=False)
+            self.pending = True
+            self.condition.notify()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(0.5)
+                self.pending = False
+                masks = list(self.recent.values())[::-1]
+            poke = self.loop.poke
+            if poke is None:
+                continue
+            with poke.lock:
+                poke.ctrl_cache.max_size = max(poke.ctrl_cache.max_size,
+                                               ccfg.ctrl_dictionary_max_size+self.n_recent+len(self.masks))
+            for mask in masks+self.masks:
+                if not self.running:
+                    break
+                try:
+                    computed = poke.precompute(mask)
+                except Exception as e:
+                    print('Precomputer: %s'%e)
+                    computed = False
+                if computed:
+                    self.n_computed+=1
+                    time.sleep(self.interval_s)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -1,6 +1,13 @@
+# This module imports nothing from the package, nor ciao_config, so that
+# an Archiver can run it as a script in a new process (see save_poke_files).
 import numpy as np
 from matplotlib import pyplot as plt
 import os
+import sys
+import subprocess
+import threading
+import queue
+import tempfile
 
 font_size = 5
 plt.rcParams.update({'font.size': font_size})
@@ -50,3 +57,103 @@ def save_modes_chart(outfn,poke,currents,mask):
         plt.savefig(outfn,dpi=300)
     except Exception as e:
         plt.savefig(outfn)
+
+
+def write_atomically(filename,write):
+    # as tools.write_atomically: call write with a file open in filename's
+    # directory, then rename the file to filename
+    directory,name = os.path.split(os.path.abspath(filename))
+    fd,temporary = tempfile.mkstemp(prefix='.%s.'%name,suffix='.tmp',dir=directory)
+    try:
+        with os.fdopen(fd,'wb') as fid:
+            write(fid)
+            fid.flush()
+            os.fsync(fid.fileno())
+        os.replace(temporary,filename)
+    except Exception as e:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def save_poke_array(filename,array,text_copies=True):
+    # as tools.save_array: the text file, if wanted, then its .npy copy
+    if text_copies:
+        write_atomically(filename,lambda fid: np.savetxt(fid,array))
+    write_atomically(os.path.splitext(filename)[0]+'.npy',lambda fid: np.save(fid,array))
+
+def save_poke_files(job_filename):
+    """Write the files for a new poke matrix, as stored by
+    Archiver.save_poke in job_filename, an .npz file with the matrix, the
+    commands, the mirror mask, the absolute filenames--the poke file, the
+    archive copies of the matrix and commands, and the chart--and whether
+    to write text copies; then delete it. Each file is written
+    atomically. Run by an Archiver, in its own process."""
+    plt.switch_backend('Agg')
+    job = np.load(job_filename)
+    poke_fn,archive_poke_fn,archive_command_fn,archive_chart_fn = [str(f) for f in job['filenames']]
+    text_copies = bool(job['text_copies'])
+    poke = job['poke']
+    commands = job['commands']
+    save_poke_array(poke_fn,poke,text_copies)
+    save_poke_array(archive_poke_fn,poke,text_copies)
+    save_poke_array(archive_command_fn,commands,text_copies)
+    head,extension = os.path.splitext(archive_chart_fn)
+    temporary_chart_fn = head+'.tmp'+extension
+    save_modes_chart(temporary_chart_fn,poke,commands,job['mask'])
+    os.replace(temporary_chart_fn,archive_chart_fn)
+    job.close()
+    os.remove(job_filename)
+
+
+class Archiver(threading.Thread):
+
+    def __init__(self):
+        """An Archiver saves poke matrices, one at a time and in order,
+        each in a new Python process running this file as a script, so
+        that neither writing the files nor drawing the chart of the modes,
+        which takes seconds and would hold the GIL in a thread, holds up
+        the loop. The script imports only numpy and matplotlib, and takes
+        everything it needs from the job file. A new interpreter is used
+        rather than multiprocessing, which on Windows would run the
+        session's script again in the child."""
+        super(Archiver,self).__init__()
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.script = os.path.abspath(__file__)
+        self.start()
+
+    def save_poke(self,poke,commands,mask,filenames,text_copies=True,label=''):
+        # store the data for save_poke_files next to the archive files, and
+        # queue the job; filenames are the poke file, the archive copies of
+        # poke and commands, and the chart
+        filenames = [os.path.abspath(f) for f in filenames]
+        directory = os.path.dirname(filenames[1])
+        fd,job_filename = tempfile.mkstemp(prefix='.%s_'%label,suffix='.npz',dir=directory)
+        with os.fdopen(fd,'wb') as fid:
+            np.savez(fid,poke=poke,commands=commands,mask=mask,
+                     filenames=np.array(filenames),text_copies=text_copies)
+        self.jobs.put((job_filename,label))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job_filename,label = job
+            try:
+                result = subprocess.run([sys.executable,self.script,job_filename])
+                if result.returncode==0:
+                    print('Poke matrix %s saved'%label)
+                else:
+                    print('Could not save poke matrix %s; its data are in %s'%(label,job_filename))
+            except Exception as e:
+                print('Could not save poke matrix %s: %s'%(label,e))
+
+    def stop(self):
+        # wait for the saves already submitted
+        self.jobs.put(None)
+        self.join()
+
+
+if __name__=='__main__':
+    save_poke_files(sys.argv[1])
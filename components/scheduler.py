@@ -0,0 +1,152 @@
+import numpy as np
+import time
+import os
+
+class LoopScheduler:
+
+    def __init__(self,mode='fixed',rate=500.0,trigger=None,frames_dropped=None,
+                 bin_ns=10000,n_bins=4000,spin_ns=1000000):
+        """A LoopScheduler paces the loop and keeps statistics of how well
+        it keeps pace, timed with time.perf_counter_ns.
+
+        Call wait before each iteration and tick at its start. In 'fixed'
+        mode, wait returns at the next multiple of 1/rate from the first
+        iteration; it sleeps until spin_ns before the deadline, since sleep
+        may overshoot by a millisecond or more, then spins, yielding with
+        sleep(0) on each pass, so that the GIL and the core are left to the
+        acquisition or pipeline threads meanwhile. An iteration
+        that runs past its deadline is an overrun, and the loop resumes at
+        the next deadline, keeping its phase. In 'free' mode, wait returns
+        at once, so the loop runs as fast as sensing and the mirror allow.
+        In 'camera' mode, wait calls trigger, e.g. a ThreadedCamera's
+        wait_for_frame, so that each iteration starts when a frame
+        arrives; an overrun is then a frame the loop missed, as counted by
+        frames_dropped. Without a trigger, 'camera' mode falls back to
+        'free', with a warning, and the loop is paced by the camera's
+        get_image alone.
+
+        The periods between iterations, and their jitter--the difference
+        from 1/rate in 'fixed' mode, or from a running mean period
+        otherwise--are kept in histograms of n_bins bins of bin_ns, the
+        last bin (or first and last, for jitter) collecting anything
+        beyond them."""
+
+        if mode=='camera' and trigger is None:
+            print('LoopScheduler: camera has no frame trigger (is acquisition_thread set?); using free mode.')
+            mode = 'free'
+        self.mode = mode
+        self.rate = rate
+        self.period_ns = int(round(1e9/rate))
+        self.trigger = trigger
+        self.frames_dropped = frames_dropped
+        self.bin_ns = bin_ns
+        self.n_bins = n_bins
+        self.spin_ns = spin_ns
+        self.period_histogram = np.zeros(n_bins,dtype=np.int64)
+        self.jitter_histogram = np.zeros(n_bins,dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.period_histogram[:] = 0
+        self.jitter_histogram[:] = 0
+        self.iterations = 0
+        self.overruns = 0
+        self.period_sum = 0
+        self.period_sum_sq = 0
+        self.jitter_sum_sq = 0
+        self.period_max = 0
+        self.t_last = None
+        self.deadline = None
+        self.mean_period_ns = float(self.period_ns)
+        if self.frames_dropped is not None:
+            self.frames_dropped_last = self.frames_dropped()
+
+    def resume(self):
+        # after a pause, so that the pause isn't counted as one long period
+        # or as overruns; called from another thread, so wait and tick
+        # read these once
+        self.t_last = None
+        self.deadline = None
+
+    def wait(self):
+        if self.mode=='fixed':
+            now = time.perf_counter_ns()
+            deadline = self.deadline
+            if deadline is None:
+                deadline = now
+            if now>deadline:
+                # overran; count the deadlines missed and wait for the next
+                missed = (now-deadline)//self.period_ns+1
+                self.overruns = self.overruns+missed
+                deadline = deadline+missed*self.period_ns
+            remaining = deadline-now
+            if remaining>self.spin_ns:
+                time.sleep((remaining-self.spin_ns)*1e-9)
+            while time.perf_counter_ns()<deadline:
+                time.sleep(0)
+            self.deadline = deadline+self.period_ns
+        elif self.mode=='camera':
+            self.trigger()
+
+    def tick(self):
+        now = time.perf_counter_ns()
+        if self.frames_dropped is not None and self.mode=='camera':
+            dropped = self.frames_dropped()
+            self.overruns = self.overruns+dropped-self.frames_dropped_last
+            self.frames_dropped_last = dropped
+        t_last = self.t_last
+        self.t_last = now
+        if t_last is not None:
+            period = now-t_last
+            if self.mode=='fixed':
+                reference = self.period_ns
+            else:
+                reference = self.mean_period_ns
+                self.mean_period_ns = 0.99*self.mean_period_ns+0.01*period
+            jitter = period-reference
+            self.period_histogram[min(period//self.bin_ns,self.n_bins-1)] += 1
+            jitter_bin = int(jitter//self.bin_ns)+self.n_bins//2
+            self.jitter_histogram[min(max(jitter_bin,0),self.n_bins-1)] += 1
+            self.iterations = self.iterations+1
+            self.period_sum = self.period_sum+period
+            self.period_sum_sq = self.period_sum_sq+period*period
+            self.jitter_sum_sq = self.jitter_sum_sq+jitter*jitter
+            self.period_max = max(self.period_max,period)
+
+    def percentile(self,histogram,p):
+        # percentile p of a histogram, in seconds, at the upper edge of
+        # its bin, or inf if it falls in the last bin, which is unbounded
+        total = histogram.sum()
+        if total==0:
+            return 0.0
+        k = np.searchsorted(np.cumsum(histogram),p/100.0*total)
+        if k>=self.n_bins-1:
+            return np.inf
+        return (k+1)*self.bin_ns*1e-9
+
+    def statistics(self):
+        n = self.iterations
+        out = {'mode':self.mode,'iterations':n,'overruns':self.overruns}
+        if n==0:
+            return out
+        mean = self.period_sum/float(n)
+        out['mean_period_s'] = mean*1e-9
+        out['rate_hz'] = 1e9/mean
+        out['period_std_s'] = np.sqrt(max(0.0,self.period_sum_sq/float(n)-mean**2))*1e-9
+        out['jitter_rms_s'] = np.sqrt(self.jitter_sum_sq/float(n))*1e-9
+        out['max_period_s'] = self.period_max*1e-9
+        for p in [50,99,99.9]:
+            out['period_p%g_s'%p] = min(self.percentile(self.period_histogram,p),out['max_period_s'])
+        return out
+
+    def log(self,directory,t_string):
+        # the histograms, with their bins' lower edges in seconds
+        period_edges = np.arange(self.n_bins)*self.bin_ns*1e-9
+        jitter_edges = (np.arange(self.n_bins)-self.n_bins//2)*self.bin_ns*1e-9
+        np.savetxt(os.path.join(directory,'loop_period_histogram_%s.txt'%t_string),
+                   np.array([period_edges,self.period_histogram]).T,fmt=['%0.6e','%d'])
+        np.savetxt(os.path.join(directory,'loop_jitter_histogram_%s.txt'%t_string),
+                   np.array([jitter_edges,self.jitter_histogram]).T,fmt=['%0.6e','%d'])
+        with open(os.path.join(directory,'loop_schedule_%s.txt'%t_string),'w') as fid:
+            for k,v in self.statistics().items():
+                fid.write('%s: %s\n'%(k,v))
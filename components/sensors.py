@@ -1,25 +1,20 @@
 import numpy as np
 import time
-from . import centroid
+try:
+    from . import centroid
+except ImportError as ie:
+    centroid = None
+from .label_centroids import LabelCentroider
+from .correlation_centroids import CorrelationCentroider
+from .acquisition import ThreadedCamera
 import sys
-from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
-                          QMutex, QObject, pyqtSlot)
-
-from PyQt5.QtWidgets import (QApplication, QPushButton, QWidget,
-                             QHBoxLayout, QVBoxLayout, QGraphicsScene,
-                             QLabel,QGridLayout, QCheckBox, QFrame, QGroupBox,
-                             QSpinBox,QDoubleSpinBox,QSizePolicy,QFileDialog,
-                             QErrorMessage, QSlider)
-from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, qRgb, QPen, QBitmap, QPalette, QIcon
 import os
-from matplotlib import pyplot as plt
 import datetime
-from .tools import error_message, now_string, prepend, colortable, get_ram, get_process
+from .tools import error_message, now_string, prepend, colortable, get_ram, get_process, load_array, save_array
 import copy
 from .zernike import Reconstructor
 import cProfile
 import scipy.io as sio
-from .poke_analysis import save_modes_chart
 from ctypes import CDLL,c_void_p
 from .search_boxes import SearchBoxes
 import ciao_config as ccfg
@@ -63,13 +58,13 @@ class Sensor:
         self.centroiding_half_width = int(np.floor(total_size_px/2.0))*2
         
         try:
-            xy = np.loadtxt(ccfg.reference_coordinates_filename)
+            xy = load_array(ccfg.reference_coordinates_filename)
         except Exception as e:
-            xy = np.loadtxt(ccfg.reference_coordinates_bootstrap_filename)
+            xy = load_array(ccfg.reference_coordinates_bootstrap_filename)
             print('Bootstrapping with %s'%ccfg.reference_coordinates_bootstrap_filename)
             
         self.search_boxes = SearchBoxes(xy[:,0],xy[:,1],ccfg.search_box_half_width)
-        self.sensor_mask = np.loadtxt(ccfg.reference_mask_filename)
+        self.sensor_mask = load_array(ccfg.reference_mask_filename)
         
         self.x0 = np.zeros(self.search_boxes.x.shape)
         self.y0 = np.zeros(self.search_boxes.y.shape)
@@ -80,8 +75,11 @@ class Sensor:
         self.n_lenslets = self.search_boxes.n
         n_lenslets = self.n_lenslets
         self.image = np.zeros((ccfg.image_height_px,ccfg.image_width_px))
-        self.x_slopes = np.zeros(n_lenslets)
-        self.y_slopes = np.zeros(n_lenslets)
+        # x_slopes and y_slopes are views of slopes, which the loop's
+        # control law takes whole; sense writes them in place
+        self.slopes = np.zeros(2*n_lenslets)
+        self.x_slopes = self.slopes[:n_lenslets]
+        self.y_slopes = self.slopes[n_lenslets:]
         self.x_centroids = np.zeros(n_lenslets)
         self.y_centroids = np.zeros(n_lenslets)
         self.box_maxes = np.zeros(n_lenslets)
@@ -93,6 +91,50 @@ class Sensor:
             self.fast_centroiding = ccfg.fast_centroiding
         except Exception as e:
             self.fast_centroiding = False
+        try:
+            self.centroiding_num_threads = ccfg.centroiding_num_threads
+        except Exception as e:
+            self.centroiding_num_threads = 1
+        try:
+            self.fused_dark_subtraction = ccfg.fused_dark_subtraction
+        except Exception as e:
+            self.fused_dark_subtraction = False
+        try:
+            self.image_statistics_stride = ccfg.image_statistics_stride
+        except Exception as e:
+            self.image_statistics_stride = 1
+        try:
+            self.fast_centroiding_tracking_half_width = ccfg.fast_centroiding_tracking_half_width
+        except Exception as e:
+            self.fast_centroiding_tracking_half_width = 0
+        try:
+            self.correlation_centroiding = ccfg.correlation_centroiding
+        except Exception as e:
+            self.correlation_centroiding = False
+        try:
+            template_sigma_px = ccfg.correlation_template_sigma_px
+        except Exception as e:
+            # the template is the diffraction-limited spot, approximated
+            # by a gaussian of the same full width at half maximum
+            template_sigma_px = lenslet_dlss_px/1.22/2.355
+        self.correlation_centroider = CorrelationCentroider(template_sigma_px)
+        try:
+            self.summed_area_tables = ccfg.centroiding_summed_area_tables
+        except Exception as e:
+            self.summed_area_tables = False
+        self.sat_buffer = None
+        self.dark_subtracted_image = None
+        try:
+            self.centroiding_backend = ccfg.centroiding_backend
+        except Exception as e:
+            self.centroiding_backend = 'cython'
+        if self.centroiding_backend=='cython' and centroid is None:
+            print('Compiled centroid module not found; using numpy centroiding backend.')
+            self.centroiding_backend = 'numpy'
+        if self.centroiding_backend=='numpy':
+            self.centroider = LabelCentroider()
+        else:
+            self.centroider = centroid
         self.box_backgrounds = np.zeros(n_lenslets)
         self.error = 0.0
         self.tip = 0.0
@@ -104,10 +146,26 @@ class Sensor:
         self.image_min = -1
         self.image_mean = -1
         
+        try:
+            self.acquisition_thread = ccfg.acquisition_thread
+        except Exception as e:
+            self.acquisition_thread = False
+        if self.acquisition_thread:
+            try:
+                n_buffers = ccfg.acquisition_ring_size
+            except Exception as e:
+                n_buffers = 4
+            try:
+                mode = ccfg.acquisition_mode
+            except Exception as e:
+                mode = 'newest'
+            camera = ThreadedCamera(camera,n_buffers=n_buffers,mode=mode)
         self.cam = camera
         self.frame_timer = FrameTimer('Sensor',verbose=False)
         self.reconstructor = Reconstructor(self.search_boxes.x,
                                            self.search_boxes.y,self.sensor_mask)
+        self.z_filt = np.zeros(self.reconstructor.slope_matrix.shape[1])
+        self.filtered_slopes = np.zeros(self.reconstructor.slope_matrix.shape[0])
 
         self.n_zernike_orders_corrected=self.reconstructor.N_orders
         self.centroiding_time = -1.0
@@ -161,7 +219,7 @@ class Sensor:
         self.pause()
         temp = np.zeros(self.dark_image.shape)
         for k in range(self.n_dark):
-            temp = temp + self.cam.get_image()
+            temp = temp + self.get_fresh_image()
         temp = np.round(temp/float(self.n_dark)).astype(np.int16)
         self.dark_image[...] = temp[...]
         self.unpause()
@@ -191,7 +249,12 @@ class Sensor:
         #d['spots_image'] = self.image
         sio.savemat(outfn,d)
 
-    def log(self):
+    def log(self,x_centroids=None,y_centroids=None):
+        # the pipelined loop passes the logged frame's centroids, since the
+        # sensor's belong to a later frame
+        if x_centroids is None:
+            x_centroids = self.x_centroids
+            y_centroids = self.y_centroids
         t_string = now_string(True)
 
         #seconds = float(datetime.datetime.strptime(t_string,'%Y%m%d%H%M%S.%f').strftime('%s.%f'))
@@ -199,8 +262,8 @@ class Sensor:
         #d['time_seconds'] = np.array([seconds])
         d['x_slopes'] = self.x_slopes
         d['y_slopes'] = self.y_slopes
-        d['x_centroids'] = self.x_centroids
-        d['y_centroids'] = self.y_centroids
+        d['x_centroids'] = x_centroids
+        d['y_centroids'] = y_centroids
         d['search_box_x1'] = self.search_boxes.x1
         d['search_box_x2'] = self.search_boxes.x2
         d['search_box_y1'] = self.search_boxes.y1
@@ -287,106 +350,29 @@ class Sensor:
         if self.profile_update_method:
             self.sense_timer.tick('cam.get_image')
         
-        if self.dark_subtract:
-            self.image = self.image - self.dark_image
+        self.image,dark_image = self.subtract_dark(self.image)
 
-        self.image_min = self.image.min()
-        self.image_mean = self.image.mean()
-        self.image_max = self.image.max()
+        self.image_min,self.image_mean,self.image_max = self.centroider.image_statistics(
+            self.image,dark_image=dark_image,stride_p=self.image_statistics_stride)
         
         if self.profile_update_method:
             self.sense_timer.tick('image stats')
             
         
         t0 = time.time()
-        if not self.fast_centroiding:
-            if self.estimate_background:
-                centroid.estimate_backgrounds(spots_image=self.image,
-                                              sb_x_vec = self.search_boxes.x,
-                                              sb_y_vec = self.search_boxes.y,
-                                              sb_bg_vec = self.box_backgrounds,
-                                              sb_half_width_p = self.search_boxes.half_width)
-                self.box_backgrounds = self.box_backgrounds + self.background_correction
-                
-            if self.profile_update_method:
-                self.sense_timer.tick('estimate background')
-            centroid.compute_centroids(spots_image=self.image,
-                                       sb_x_vec = self.search_boxes.x,
-                                       sb_y_vec = self.search_boxes.y,
-                                       sb_bg_vec = self.box_backgrounds,
-                                       sb_half_width_p = self.search_boxes.half_width,
-                                       iterations_p = self.centroiding_iterations,
-                                       iteration_step_px_p = self.iterative_centroiding_step,
-                                       x_out = self.x_centroids,
-                                       y_out = self.y_centroids,
-                                       mean_intensity = self.box_means,
-                                       maximum_intensity = self.box_maxes,
-                                       minimum_intensity = self.box_mins,
-                                       num_threads_p = 1)
-            if self.profile_update_method:
-                self.sense_timer.tick('centroid')
-        else:
-            centroid.fast_centroids(spots_image=self.image,
-                                    sb_x_vec = self.search_boxes.x,
-                                    sb_y_vec = self.search_boxes.y,
-                                    sb_half_width_p = self.search_boxes.half_width,
-                                    centroiding_half_width_p = self.centroiding_half_width,
-                                    x_out = self.x_centroids,
-                                    y_out = self.y_centroids,
-                                    sb_max_vec = self.box_maxes,
-                                    valid_vec = self.valid_centroids,
-                                    verbose_p = 0,
-                                    num_threads_p = 1)
+        self.centroid_image(self.image,dark_image)
         self.centroiding_time = time.time()-t0
-        self.x_slopes = (self.x_centroids-self.search_boxes.x)*self.pixel_size_m/self.lenslet_focal_length_m
-        self.y_slopes = (self.y_centroids-self.search_boxes.y)*self.pixel_size_m/self.lenslet_focal_length_m
-        
-        self.tilt = np.mean(self.x_slopes)
-        self.tip = np.mean(self.y_slopes)
-        
-        if self.remove_tip_tilt:
-            self.x_slopes-=self.tilt
-            self.y_slopes-=self.tip
+        if self.profile_update_method:
+            self.sense_timer.tick('centroid')
+
+        self.x_slopes,self.y_slopes,self.tilt,self.tip = self.compute_slopes(self.x_centroids,self.y_centroids,
+                                                                             self.x_slopes,self.y_slopes)
+
         if self.reconstruct_wavefront:
-            self.zernikes,self.wavefront,self.error = self.reconstructor.get_wavefront(self.x_slopes,self.y_slopes)
+            self.zernikes,self.wavefront,self.error,self.x_slopes,self.y_slopes = self.reconstruct(self.x_slopes,self.y_slopes)
             if self.profile_update_method:
                 self.sense_timer.tick('reconstruct wavefront')
             
-            
-            self.filter_slopes = self.n_zernike_orders_corrected<self.reconstructor.N_orders
-            
-            if self.filter_slopes:
-
-                # Outline of approach: the basic idea is to filter the residual error
-                # slopes by Zernike mode before multiplying by the mirror command
-                # matrix.
-                # 1. multiply the slopes by a wavefront reconstructor matrix
-                #    to get Zernike coefficients; these are already output by
-                #    the call to self.reconstructor.get_wavefront above
-                # 2. zero the desired modes
-                # 3. multiply the modes by the inverse of that matrix, which is stored
-                #    in the Reconstructor object as reconstructor.slope_matrix
-
-                # convert the order into a number of terms:
-                n_terms = self.reconstructor.Z.nm2j(self.n_zernike_orders_corrected,self.n_zernike_orders_corrected)
-
-                # get the slope matrix (inverse of zernike matrix, which maps slopes onto zernikes)
-                slope_matrix = self.reconstructor.slope_matrix
-
-                # create a filtered set of zernike terms
-                # not sure if we should zero piston here
-                z_filt = np.zeros(len(self.zernikes))
-                z_filt[:n_terms+1] = self.zernikes[:n_terms+1]
-                
-                zero_piston = True
-                if zero_piston:
-                    z_filt[0] = 0.0
-                
-                # filter the slopes, and assign them to this sensor object:
-                filtered_slopes = np.dot(slope_matrix,z_filt)
-                self.x_slopes = filtered_slopes[:self.n_lenslets]
-                self.y_slopes = filtered_slopes[self.n_lenslets:]
-            
         if self.profile_update_method:
             self.sense_timer.tick('end sense')
             self.sense_timer.tock()
@@ -397,22 +383,243 @@ class Sensor:
             print(e)
             print(self.error)
             sys.exit()
+
+    # The steps of sense are split out below so that the pipelined loop
+    # (pipeline.py) can run them in separate threads on its own buffers.
+    # They write into the buffers they are given, so that, once the first
+    # frame has sized them, an iteration of the loop allocates no arrays.
+        
+    def subtract_dark(self,image,out=None):
+        # with fused dark subtraction, the dark image is returned, to be
+        # handed to the centroiding kernels, which subtract it only inside
+        # the search boxes; the image then remains the raw camera frame;
+        # otherwise the difference goes into out, or a buffer of the sensor's
+        dark_image = None
+        if self.dark_subtract:
+            if self.fused_dark_subtraction:
+                dark_image = self.dark_image
+            else:
+                if out is None:
+                    if self.dark_subtracted_image is None or not self.dark_subtracted_image.shape==image.shape:
+                        self.dark_subtracted_image = np.zeros(image.shape,dtype=np.int16)
+                    out = self.dark_subtracted_image
+                # cameras may deliver uint8 or uint16 frames; keep the
+                # difference in int16, which the kernels accept
+                image = np.subtract(image,self.dark_image,out=out,dtype=np.int16)
+        return image,dark_image
+
+    def centroid_image(self,image,dark_image=None):
+        # centroid image in the current search boxes, with the estimator
+        # selected in the config, into self.x_centroids, self.y_centroids,
+        # and the box statistics
+        if self.correlation_centroiding:
+            self.correlation_centroider.correlation_centroids(spots_image=image,
+                                                              sb_x_vec = self.search_boxes.x,
+                                                              sb_y_vec = self.search_boxes.y,
+                                                              sb_half_width_p = self.search_boxes.half_width,
+                                                              x_out = self.x_centroids,
+                                                              y_out = self.y_centroids,
+                                                              sb_max_vec = self.box_maxes,
+                                                              valid_vec = self.valid_centroids,
+                                                              dark_image = dark_image,
+                                                              num_threads_p = self.centroiding_num_threads)
+        elif not self.fast_centroiding and self.summed_area_tables:
+            sat_shape = (3,image.shape[0]+1,image.shape[1]+1)
+            if self.sat_buffer is None or not self.sat_buffer.shape==sat_shape:
+                self.sat_buffer = np.empty(sat_shape)
+            self.centroider.compute_centroids_sat(spots_image=image,
+                                                  sb_x_vec = self.search_boxes.x,
+                                                  sb_y_vec = self.search_boxes.y,
+                                                  sb_bg_vec = self.box_backgrounds,
+                                                  sb_half_width_p = self.search_boxes.half_width,
+                                                  background_correction_p = self.background_correction,
+                                                  iterations_p = self.centroiding_iterations,
+                                                  iteration_step_px_p = self.iterative_centroiding_step,
+                                                  x_out = self.x_centroids,
+                                                  y_out = self.y_centroids,
+                                                  mean_intensity = self.box_means,
+                                                  maximum_intensity = self.box_maxes,
+                                                  minimum_intensity = self.box_mins,
+                                                  estimate_background_p = self.estimate_background,
+                                                  num_threads_p = self.centroiding_num_threads,
+                                                  dark_image = dark_image,
+                                                  sat_buffer = self.sat_buffer)
+        elif not self.fast_centroiding:
+            # background estimation and centroiding are done together, so
+            # that each search box is read from memory once
+            self.centroider.compute_centroids_with_backgrounds(spots_image=image,
+                                                               sb_x_vec = self.search_boxes.x,
+                                                               sb_y_vec = self.search_boxes.y,
+                                                               sb_bg_vec = self.box_backgrounds,
+                                                               sb_half_width_p = self.search_boxes.half_width,
+                                                               background_correction_p = self.background_correction,
+                                                               iterations_p = self.centroiding_iterations,
+                                                               iteration_step_px_p = self.iterative_centroiding_step,
+                                                               x_out = self.x_centroids,
+                                                               y_out = self.y_centroids,
+                                                               mean_intensity = self.box_means,
+                                                               maximum_intensity = self.box_maxes,
+                                                               minimum_intensity = self.box_mins,
+                                                               estimate_background_p = self.estimate_background,
+                                                               num_threads_p = self.centroiding_num_threads,
+                                                               dark_image = dark_image)
+        else:
+            self.centroider.fast_centroids(spots_image=image,
+                                           sb_x_vec = self.search_boxes.x,
+                                           sb_y_vec = self.search_boxes.y,
+                                           sb_half_width_p = self.search_boxes.half_width,
+                                           centroiding_half_width_p = self.centroiding_half_width,
+                                           x_out = self.x_centroids,
+                                           y_out = self.y_centroids,
+                                           sb_max_vec = self.box_maxes,
+                                           valid_vec = self.valid_centroids,
+                                           verbose_p = 0,
+                                           num_threads_p = self.centroiding_num_threads,
+                                           dark_image = dark_image,
+                                           tracking_half_width_p = self.fast_centroiding_tracking_half_width)
+
+    def compute_slopes(self,x_centroids,y_centroids,x_out=None,y_out=None):
+        # the slopes go into x_out and y_out, if given
+        scale = self.pixel_size_m/self.lenslet_focal_length_m
+        x_slopes = np.subtract(x_centroids,self.search_boxes.x,out=x_out)
+        y_slopes = np.subtract(y_centroids,self.search_boxes.y,out=y_out)
+        np.multiply(x_slopes,scale,out=x_slopes)
+        np.multiply(y_slopes,scale,out=y_slopes)
+        
+        tilt = np.mean(x_slopes)
+        tip = np.mean(y_slopes)
+        
+        if self.remove_tip_tilt:
+            x_slopes-=tilt
+            y_slopes-=tip
+        return x_slopes,y_slopes,tilt,tip
+
+    def reconstruct(self,x_slopes,y_slopes):
+        # filtered slopes are written back into x_slopes and y_slopes
+        zernikes,wavefront,error = self.reconstructor.get_wavefront(x_slopes,y_slopes)
+            
+        self.filter_slopes = self.n_zernike_orders_corrected<self.reconstructor.N_orders
+            
+        if self.filter_slopes:
+
+            # Outline of approach: the basic idea is to filter the residual error
+            # slopes by Zernike mode before multiplying by the mirror command
+            # matrix.
+            # 1. multiply the slopes by a wavefront reconstructor matrix
+            #    to get Zernike coefficients; these are already output by
+            #    the call to self.reconstructor.get_wavefront above
+            # 2. zero the desired modes
+            # 3. multiply the modes by the inverse of that matrix, which is stored
+            #    in the Reconstructor object as reconstructor.slope_matrix
+
+            # convert the order into a number of terms:
+            n_terms = self.reconstructor.Z.nm2j(self.n_zernike_orders_corrected,self.n_zernike_orders_corrected)
+
+            # get the slope matrix (inverse of zernike matrix, which maps slopes onto zernikes)
+            slope_matrix = self.reconstructor.slope_matrix
+
+            # create a filtered set of zernike terms
+            # not sure if we should zero piston here
+            z_filt = self.z_filt
+            z_filt.fill(0.0)
+            z_filt[:n_terms+1] = zernikes[:n_terms+1]
+                
+            zero_piston = True
+            if zero_piston:
+                z_filt[0] = 0.0
+                
+            # filter the slopes:
+            filtered_slopes = np.dot(slope_matrix,z_filt,out=self.filtered_slopes)
+            x_slopes[:] = filtered_slopes[:self.n_lenslets]
+            y_slopes[:] = filtered_slopes[self.n_lenslets:2*self.n_lenslets]
+        return zernikes,wavefront,error,x_slopes,y_slopes
+        
+    def get_fresh_image(self):
+        # a frame exposed after this call, for calibrations that change
+        # the mirror or light between frames; with an acquisition thread,
+        # get_image may return a frame that was already waiting in the ring
+        if self.acquisition_thread:
+            return self.cam.get_fresh_image()
+        else:
+            return self.cam.get_image()
+
+    def grab_stack(self,n_frames):
+        # grab n_frames frames into one preallocated stack, for
+        # centroid_stack; self.image is kept current for the UI
+        stack = None
+        for k in range(n_frames):
+            self.image = self.get_fresh_image()
+            if stack is None:
+                stack = np.zeros((n_frames,)+self.image.shape,dtype=self.image.dtype)
+            stack[k,:,:] = self.image
+        return stack
+
+    def centroid_stack(self,stack):
+        """Centroid every frame of an n_frames x height x width stack in
+        the current search boxes, with the estimator the loop uses, and
+        return the n_frames x n_lenslets x and y centroid arrays. With the
+        default center of mass estimator the whole stack goes to the
+        centroiding backend in one call, and the dark image, if enabled,
+        is subtracted inside the kernel; with fast, correlation, or
+        summed-area-table centroiding, each frame is centroided as sense
+        centroids it, so that references and poke matrices are measured
+        with the same estimator as the slopes they're used with."""
+        n_frames = stack.shape[0]
+        x_out = np.zeros((n_frames,self.n_lenslets))
+        y_out = np.zeros((n_frames,self.n_lenslets))
+        if self.correlation_centroiding or self.fast_centroiding or self.summed_area_tables:
+            for k in range(n_frames):
+                image,dark_image = self.subtract_dark(stack[k])
+                self.centroid_image(image,dark_image)
+                x_out[k,:] = self.x_centroids
+                y_out[k,:] = self.y_centroids
+            return x_out,y_out
+        means = np.zeros((n_frames,self.n_lenslets))
+        maxes = np.zeros((n_frames,self.n_lenslets))
+        mins = np.zeros((n_frames,self.n_lenslets))
+        backgrounds = np.zeros((n_frames,self.n_lenslets))
+        backgrounds[:,:] = self.box_backgrounds[None,:]
+        
+        dark_image = None
+        if self.dark_subtract:
+            dark_image = self.dark_image
+            
+        self.centroider.compute_centroids_stack(spots_stack = stack,
+                                                sb_x_vec = self.search_boxes.x,
+                                                sb_y_vec = self.search_boxes.y,
+                                                sb_bg_out = backgrounds,
+                                                sb_half_width_p = self.search_boxes.half_width,
+                                                background_correction_p = self.background_correction,
+                                                iterations_p = self.centroiding_iterations,
+                                                iteration_step_px_p = self.iterative_centroiding_step,
+                                                x_out = x_out,
+                                                y_out = y_out,
+                                                mean_intensity = means,
+                                                maximum_intensity = maxes,
+                                                minimum_intensity = mins,
+                                                estimate_background_p = self.estimate_background,
+                                                num_threads_p = self.centroiding_num_threads,
+                                                dark_image = dark_image)
+        return x_out,y_out
+
+    def stack_slopes(self,x_out,y_out):
+        # slopes of each frame of centroid_stack's output, with tip and
+        # tilt removed as in sense
+        x_slopes = (x_out-self.search_boxes.x[None,:])*self.pixel_size_m/self.lenslet_focal_length_m
+        y_slopes = (y_out-self.search_boxes.y[None,:])*self.pixel_size_m/self.lenslet_focal_length_m
+        if self.remove_tip_tilt:
+            x_slopes = x_slopes-x_slopes.mean(axis=1)[:,None]
+            y_slopes = y_slopes-y_slopes.mean(axis=1)[:,None]
+        return x_slopes,y_slopes
         
     def record_reference(self):
         print('recording reference')
         self.pause()
-        xcent = []
-        ycent = []
-        for k in range(ccfg.reference_n_measurements):
-            print('measurement %d of %d'%(k+1,ccfg.reference_n_measurements),)
-            self.sense()
-            print('...done')
-            xcent.append(self.x_centroids)
-            ycent.append(self.y_centroids)
-
-        xcent = np.array(xcent)
-        ycent = np.array(ycent)
-        
+        print('grabbing %d frames'%ccfg.reference_n_measurements)
+        stack = self.grab_stack(ccfg.reference_n_measurements)
+        xcent,ycent = self.centroid_stack(stack)
+        print('...done')
+
         x_ref = xcent.mean(0)
         y_ref = ycent.mean(0)
 
@@ -430,8 +637,8 @@ class Sensor:
         # track of the history.
         archive_fn = os.path.join(ccfg.reference_directory,prepend('reference.txt',now_string()))
         
-        np.savetxt(archive_fn,refxy,fmt='%0.3f')
-        np.savetxt(ccfg.reference_coordinates_filename,refxy,fmt='%0.3f')
+        save_array(archive_fn,refxy,fmt='%0.3f')
+        save_array(ccfg.reference_coordinates_filename,refxy,fmt='%0.3f')
         
         self.unpause()
         time.sleep(1)
@@ -2,19 +2,9 @@ import numpy as np
 import time
 import ciao_config as ccfg
 import sys
-from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
-                          QMutex, QObject, pyqtSlot)
-
-from PyQt5.QtWidgets import (QApplication, QPushButton, QWidget,
-                             QHBoxLayout, QVBoxLayout, QGraphicsScene,
-                             QLabel,QGridLayout, QCheckBox, QFrame, QGroupBox,
-                             QSpinBox,QDoubleSpinBox,QSizePolicy,QFileDialog,
-                             QErrorMessage, QSlider)
-from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, qRgb, QPen, QBitmap, QPalette, QIcon
 import os
-from matplotlib import pyplot as plt
 import datetime
-from .tools import error_message, now_string, prepend, colortable, get_ram, get_process
+from .tools import error_message, now_string, prepend, colortable, get_ram, get_process, load_array
 from .zernike import Zernike
 from .search_boxes import SearchBoxes
 from .frame_timer import FrameTimer
@@ -110,7 +100,7 @@ class Simulator:
         #plt.plot(self.x_lenslet_coords,self.y_lenslet_coords,'ks')
         #plt.show()
 
-        self.mirror_mask = np.loadtxt(ccfg.mirror_mask_filename)
+        self.mirror_mask = load_array(ccfg.mirror_mask_filename)
         self.n_actuators = int(np.sum(self.mirror_mask))
 
         self.command = np.zeros(self.n_actuators)
@@ -124,8 +114,8 @@ class Simulator:
         ay = ay-ay.mean()
         ax = ax-ax.mean()
 
-        self.flat = np.loadtxt(ccfg.mirror_flat_filename)
-        self.flat0 = np.loadtxt(ccfg.mirror_flat_filename)
+        self.flat = load_array(ccfg.mirror_flat_filename)
+        self.flat0 = self.flat.copy()
         
         self.n_zernike_terms = ccfg.n_zernike_terms
         #actuator_sigma = actuator_spacing*0.75
@@ -146,6 +136,7 @@ class Simulator:
             self.actuator_basis = np.load(cfn)
             print('Loading cached actuator basis set...')
         except Exception as e:
+            from matplotlib import pyplot as plt
             actuator_basis = []
             print('Building actuator basis set...')
             for x,y in zip(ax,ay):
@@ -234,6 +225,10 @@ class Simulator:
     def set_actuator(self,index,value):
         self.command[index]=value
         self.update()
+
+    def send(self):
+        # as Mirror.send, e.g. after set_command during a calibration
+        self.update()
         
     def set_exposure(self,exposure_us):
         self.exposure_us = long(exposure_us)
@@ -251,6 +246,7 @@ class Simulator:
         return np.reshape(np.dot(coefs,self.zernike_basis),(self.sy,self.sx))
 
     def defocus_animation(self):
+        from matplotlib import pyplot as plt
         err = np.zeros(self.n_zernike_terms)
         for k in np.arange(0.0,100.0):
             err[4] = np.random.randn()
@@ -261,6 +257,7 @@ class Simulator:
             plt.pause(.1)
     
     def plot_actuators(self):
+        from matplotlib import pyplot as plt
         edge = self.XX.min()
         wid = self.XX.max()-edge
         plt.imshow(self.mask,extent=[edge,edge+wid,edge,edge+wid])
@@ -350,6 +347,7 @@ class Simulator:
         pass
 
     def show_zernikes(self):
+        from matplotlib import pyplot as plt
         for k in range(self.n_zernike_terms):
             b = np.reshape(self.zernike_basis[k,:],(self.sy,self.sx))
             plt.clf()
@@ -361,6 +359,7 @@ class Simulator:
         print('Closing simulator.')
         
 if __name__=='__main__':
+    from matplotlib import pyplot as plt
 
     sim = Simulator()
     for k in range(100):
@@ -1,13 +1,11 @@
 import sys, os
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QErrorMessage
-from matplotlib import pyplot as plt
 import datetime
 import psutil
 import numpy as np
-from PyQt5.QtGui import qRgb
 import time
+import tempfile
 import scipy.signal as sps
+import ciao_config as ccfg
 
 def get_process():
     return psutil.Process(os.getpid())
@@ -15,7 +13,12 @@ def get_process():
 def get_ram():
     return (get_process().memory_info().rss)//1024//1024
 
+# Qt and pyplot are imported only by the functions that need them, so that
+# the sensor, mirror, and simulator can be used without them
+
 def error_message(message):
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QErrorMessage
     error_dialog = QErrorMessage()
     error_dialog.setWindowModality(Qt.WindowModal)
     error_dialog.showMessage(message)
@@ -33,7 +36,60 @@ def prepend(full_path_fn,prefix):
     p,f = os.path.split(full_path_fn)
     return os.path.join(p,'%s_%s'%(prefix,f))
 
+def binary_filename(filename):
+    # the .npy copy kept alongside a text file, e.g. poke.npy for poke.txt
+    return os.path.splitext(filename)[0]+'.npy'
+
+def load_array(filename,mmap_mode=None):
+    """Load an array saved with np.savetxt to filename, from its binary
+    copy (see binary_filename) if that is at least as new as the text
+    file; otherwise, parse the text file and write the binary copy, so
+    that the next load doesn't. With mmap_mode, e.g. 'r', the binary copy
+    is memory-mapped rather than read."""
+    binary = binary_filename(filename)
+    if os.path.exists(binary) and (not os.path.exists(filename) or
+                                   os.path.getmtime(binary)>=os.path.getmtime(filename)):
+        return np.load(binary,mmap_mode=mmap_mode)
+    array = np.loadtxt(filename)
+    try:
+        write_atomically(binary,lambda fid: np.save(fid,array))
+        print('Converted %s to %s'%(filename,binary))
+    except Exception as e:
+        print('Could not write %s: %s'%(binary,e))
+    return array
+
+def save_array(filename,array,fmt='%.18e'):
+    """Save array to filename's binary copy and, if ccfg.save_text_copies
+    is set, to filename itself, with np.savetxt and fmt. Each is written
+    atomically, so that a reader, or a crash, never finds a partial file,
+    and the text file first, so that the binary copy is never older."""
+    try:
+        text = ccfg.save_text_copies
+    except Exception as e:
+        text = True
+    if text:
+        write_atomically(filename,lambda fid: np.savetxt(fid,array,fmt=fmt))
+    write_atomically(binary_filename(filename),lambda fid: np.save(fid,array))
+
+def write_atomically(filename,write):
+    # call write with a file open in filename's directory, then rename
+    # the file to filename, replacing it in one step
+    directory,name = os.path.split(os.path.abspath(filename))
+    fd,temporary = tempfile.mkstemp(prefix='.%s.'%name,suffix='.tmp',dir=directory)
+    try:
+        with os.fdopen(fd,'wb') as fid:
+            write(fid)
+            fid.flush()
+            os.fsync(fid.fileno())
+        os.replace(temporary,filename)
+    except Exception as e:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
 def colortable(colormap_name):
+    from matplotlib import pyplot as plt
+    from PyQt5.QtGui import qRgb
     if colormap_name=='mirror':
         colorcode_saturated = True
         colormap_name = 'gray'
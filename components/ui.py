@@ -1,6 +1,5 @@
 import numpy as np
 import time
-import centroid
 import sys
 from PyQt5.QtCore import (QThread, QTimer, pyqtSignal, Qt, QPoint, QLine,
                           QMutex, QObject, pyqtSlot)
@@ -15,7 +14,7 @@ from PyQt5.QtGui import QColor, QImage, QPainter, QPixmap, qRgb, QPen, QBitmap,
 import os
 from matplotlib import pyplot as plt
 import datetime
-from .tools import error_message, now_string, prepend, colortable, get_ram, get_process
+from .tools import error_message, now_string, prepend, colortable, get_ram, get_process, save_array
 import copy
 from .zernike import Reconstructor
 import cProfile
@@ -27,6 +26,7 @@ from .reference_generator import ReferenceGenerator
 import ciao_config as ccfg
 from .frame_timer import FrameTimer,BlockTimer
 from .poke import Poke
+from .loops import Snapshot
 import os
 
 # machine epsilon
@@ -453,11 +453,18 @@ class UI(QWidget):
         self.sensor_mutex = QMutex()#loop.sensor_mutex
         self.mirror_mutex = QMutex()#loop.mirror_mutex
         self.loop = loop
+        # the loop may run in another thread, so the UI draws Snapshots,
+        # delivered through a queued connection, rather than reading the
+        # sensor and mirror directly
+        self.snapshot_n = -1
         try:
-            pass
-            self.loop.finished.connect(self.update)
+            self.loop.snapshot.connect(self.show_snapshot,Qt.QueuedConnection)
         except Exception as e:
             pass
+        try:
+            self.loop_schedule_fmt = ccfg.loop_schedule_fmt
+        except Exception as e:
+            self.loop_schedule_fmt = '%0.2f Hz (Loop), %0.0f us jitter, %d overruns'
         self.draw_boxes = ccfg.show_search_boxes
         self.draw_lines = ccfg.show_slope_lines
         self.init_UI()
@@ -480,13 +487,13 @@ class UI(QWidget):
         
     def keyPressEvent(self,event):
         if event.key()==Qt.Key_W:
-            self.loop.sensor.search_boxes.up()
+            self.loop.move_search_boxes('up')
         if event.key()==Qt.Key_Z:
-            self.loop.sensor.search_boxes.down()
+            self.loop.move_search_boxes('down')
         if event.key()==Qt.Key_A:
-            self.loop.sensor.search_boxes.left()
+            self.loop.move_search_boxes('left')
         if event.key()==Qt.Key_S:
-            self.loop.sensor.search_boxes.right()
+            self.loop.move_search_boxes('right')
         self.update_box_coords()
         
     def update_box_coords(self):
@@ -576,11 +583,14 @@ class UI(QWidget):
         self.cb_logging.setChecked(False)
         self.cb_logging.stateChanged.connect(self.loop.sensor.set_logging)
         self.cb_logging.stateChanged.connect(self.loop.mirror.set_logging)
+        self.cb_logging.stateChanged.connect(self.loop.set_logging)
         
         self.pb_poke = QPushButton('Measure poke matrix')
         self.pb_poke.clicked.connect(self.loop.run_poke)
+        self.pb_modulate = QPushButton('Measure poke matrix in closed loop')
+        self.pb_modulate.clicked.connect(lambda: self.loop.start_modulation())
         self.pb_record_reference = QPushButton('Record reference')
-        self.pb_record_reference.clicked.connect(self.loop.sensor.record_reference)
+        self.pb_record_reference.clicked.connect(self.loop.record_reference)
         
         
         self.pb_flatten = QPushButton('&Flatten')
@@ -628,7 +638,7 @@ class UI(QWidget):
         dark_layout = QHBoxLayout()
         self.cb_dark_subtraction = QCheckBox('Subtract dark')
         self.cb_dark_subtraction.setChecked(self.loop.sensor.dark_subtract)
-        self.cb_dark_subtraction.stateChanged.connect(self.loop.sensor.set_dark_subtraction)
+        self.cb_dark_subtraction.stateChanged.connect(self.loop.set_dark_subtraction)
         dark_layout.addWidget(self.cb_dark_subtraction)
         
         dark_layout.addWidget(QLabel('Dark subtract N:'))
@@ -640,7 +650,7 @@ class UI(QWidget):
         dark_layout.addWidget(self.n_dark_spinbox)
         
         self.pb_set_dark = QPushButton('Set dark')
-        self.pb_set_dark.clicked.connect(self.loop.sensor.set_dark)
+        self.pb_set_dark.clicked.connect(self.loop.set_dark)
         dark_layout.addWidget(self.pb_set_dark)
 
         
@@ -678,7 +688,7 @@ class UI(QWidget):
         self.f_spinbox.setSingleStep(0.01)
         self.f_spinbox.setMaximum(10.0)
         self.f_spinbox.setMinimum(-10.0)
-        self.f_spinbox.valueChanged.connect(self.loop.sensor.set_defocus)
+        self.f_spinbox.valueChanged.connect(self.loop.set_defocus)
         aberration_layout.addWidget(self.f_spinbox)
         
         aberration_layout.addWidget(QLabel('Astig 0:'))
@@ -687,7 +697,7 @@ class UI(QWidget):
         self.a0_spinbox.setSingleStep(0.01)
         self.a0_spinbox.setMaximum(10.0)
         self.a0_spinbox.setMinimum(-10.0)
-        self.a0_spinbox.valueChanged.connect(self.loop.sensor.set_astig0)
+        self.a0_spinbox.valueChanged.connect(self.loop.set_astig0)
         aberration_layout.addWidget(self.a0_spinbox)
 
         aberration_layout.addWidget(QLabel('Astig 45:'))
@@ -696,7 +706,7 @@ class UI(QWidget):
         self.a1_spinbox.setSingleStep(0.01)
         self.a1_spinbox.setMaximum(10.0)
         self.a1_spinbox.setMinimum(-10.0)
-        self.a1_spinbox.valueChanged.connect(self.loop.sensor.set_astig1)
+        self.a1_spinbox.valueChanged.connect(self.loop.set_astig1)
         aberration_layout.addWidget(self.a1_spinbox)
 
         self.pb_aberration_reset = QPushButton('Reset')
@@ -704,7 +714,7 @@ class UI(QWidget):
             self.f_spinbox.setValue(0.0)
             self.a0_spinbox.setValue(0.0)
             self.a1_spinbox.setValue(0.0)
-            self.loop.sensor.aberration_reset()
+            self.loop.aberration_reset()
         self.pb_aberration_reset.clicked.connect(reset)
         aberration_layout.addWidget(self.pb_aberration_reset)
 
@@ -756,6 +766,9 @@ class UI(QWidget):
         
         self.lbl_ui_fps = QLabel()
         self.lbl_ui_fps.setAlignment(Qt.AlignRight)
+
+        self.lbl_loop_schedule = QLabel()
+        self.lbl_loop_schedule.setAlignment(Qt.AlignRight)
         
         flatten_layout = QHBoxLayout()
         flatten_layout.addWidget(self.pb_flatten)
@@ -796,10 +809,12 @@ class UI(QWidget):
         column_2.addWidget(self.lbl_sensor_fps)
         column_2.addWidget(self.lbl_mirror_fps)
         column_2.addWidget(self.lbl_ui_fps)
+        column_2.addWidget(self.lbl_loop_schedule)
         
         
         
         column_2.addWidget(self.pb_poke)
+        column_2.addWidget(self.pb_modulate)
         column_2.addWidget(self.pb_record_reference)
         
         column_2.addWidget(self.cb_logging)
@@ -809,6 +824,7 @@ class UI(QWidget):
         self.setLayout(layout)
         
     def quit(self):
+        self.loop.stop()
         self.loop.sensor.cam.close()
         sys.exit()
         
@@ -828,20 +844,29 @@ class UI(QWidget):
         self.pb_set_flat.setChecked(True)
         self.pb_restore_flat.setEnabled(True)
         
-    @pyqtSlot()
-    def update(self):
+    @pyqtSlot(object)
+    def show_snapshot(self,snapshot):
+        # skip any snapshot older than one already drawn, and let the loop
+        # know that the UI is ready for the next
+        if snapshot.n>=self.snapshot_n:
+            self.snapshot_n = snapshot.n
+            self.update(snapshot)
+        self.loop.snapshot_done()
+        
+    def update(self,snapshot=None):
 
         if self.profile_update_method:
             self.update_timer.tick('start')
             
         #self.mirror_mutex.lock()
         #self.sensor_mutex.lock()
-        sensor = self.loop.sensor
+        if snapshot is None:
+            snapshot = Snapshot(self.loop)
         mirror = self.loop.mirror
 
         temp = [(x,xerr,y,yerr) for x,xerr,y,yerr in
-                zip(sensor.search_boxes.x,sensor.x_centroids,
-                    sensor.search_boxes.y,sensor.y_centroids)]
+                zip(snapshot.search_box_x,snapshot.x_centroids,
+                    snapshot.search_box_y,snapshot.y_centroids)]
 
         self.overlay_slopes.coords = []
         for x,xerr,y,yerr in temp:
@@ -854,37 +879,42 @@ class UI(QWidget):
         if self.profile_update_method:
             self.update_timer.tick('create slope lines overlay')
 
-        self.id_spots.show(sensor.image,self.loop.active_lenslets)
+        self.id_spots.show(snapshot.image,snapshot.active_lenslets)
         
         if self.profile_update_method:
             self.update_timer.tick('show spots')
 
 
         mirror_map = np.zeros(mirror.mirror_mask.shape)
-        mirror_map[np.where(mirror.mirror_mask)] = mirror.get_command()[:]
+        mirror_map[np.where(mirror.mirror_mask)] = snapshot.mirror_command[:]
         self.id_mirror.show(mirror_map)
-        self.id_wavefront.show(sensor.wavefront)
+        self.id_wavefront.show(snapshot.wavefront)
 
         self.id_zoomed_spots.show(self.id_spots.zoomed())
         
-        #self.lbl_error.setText(ccfg.wavefront_error_fmt%(sensor.error*1e9))
-        self.stripchart_error.setValue(sensor.error)
-        self.stripchart_defocus.setValue(sensor.zernikes[4]*ccfg.beam_diameter_m)
+        #self.lbl_error.setText(ccfg.wavefront_error_fmt%(snapshot.error*1e9))
+        self.stripchart_error.setValue(snapshot.error)
+        self.stripchart_defocus.setValue(snapshot.zernikes[4]*ccfg.beam_diameter_m)
         
-        self.lbl_tip.setText(ccfg.tip_fmt%(sensor.tip*1000000))
-        self.lbl_tilt.setText(ccfg.tilt_fmt%(sensor.tilt*1000000))
-        self.lbl_cond.setText(ccfg.cond_fmt%(self.loop.get_condition_number()))
+        self.lbl_tip.setText(ccfg.tip_fmt%(snapshot.tip*1000000))
+        self.lbl_tilt.setText(ccfg.tilt_fmt%(snapshot.tilt*1000000))
+        self.lbl_cond.setText(ccfg.cond_fmt%(snapshot.condition_number))
 
-        self.ind_image_max.setValue(sensor.image_max)
-        self.ind_image_mean.setValue(sensor.image_mean)
-        self.ind_image_min.setValue(sensor.image_min)
-        self.ind_mean_box_background.setValue(sensor.get_average_background())
+        self.ind_image_max.setValue(snapshot.image_max)
+        self.ind_image_mean.setValue(snapshot.image_mean)
+        self.ind_image_min.setValue(snapshot.image_min)
+        self.ind_mean_box_background.setValue(snapshot.mean_box_background)
         
-        self.ind_centroiding_time.setValue(sensor.centroiding_time)
+        self.ind_centroiding_time.setValue(snapshot.centroiding_time)
         
-        self.lbl_sensor_fps.setText(ccfg.sensor_fps_fmt%sensor.frame_timer.fps)
-        self.lbl_mirror_fps.setText(ccfg.mirror_fps_fmt%mirror.frame_timer.fps)
+        self.lbl_sensor_fps.setText(ccfg.sensor_fps_fmt%snapshot.sensor_fps)
+        self.lbl_mirror_fps.setText(ccfg.mirror_fps_fmt%snapshot.mirror_fps)
         self.lbl_ui_fps.setText(ccfg.ui_fps_fmt%self.frame_timer.fps)
+        schedule = snapshot.schedule
+        if schedule['iterations']:
+            self.lbl_loop_schedule.setText(self.loop_schedule_fmt%(schedule['rate_hz'],
+                                                                   schedule['jitter_rms_s']*1e6,
+                                                                   schedule['overruns']))
 
         if self.loop.close_ok:
             self.cb_closed.setEnabled(True)
@@ -1001,4 +1031,4 @@ class MirrorUI(QWidget):
 
     def save(self):
         out = self.mirror.get_command()
-        np.savetxt('manual_flat.txt',out)
+        save_array('manual_flat.txt',out)
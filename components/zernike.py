@@ -10,7 +10,6 @@ Revision: 3.0 / 14 March 2019
 """
 
 import numpy as np
-from matplotlib import pyplot as plt
 import sys,os
 import ciao_config as ccfg
 
@@ -400,19 +399,28 @@ class Reconstructor:
         
         self.wavefront_matrix = np.array(hmat).T
         self.wavefront = np.zeros(self.mask.shape)
+
+        # get_wavefront runs every loop iteration, so it works in these
+        # buffers rather than allocating; the slopes' last element stays 0
+        # when regularizing, and coefs is returned, so it is overwritten by
+        # the next call
+        self.slopes = np.zeros(A.shape[0])
+        self.coefs = np.zeros(self.N)
+        self.wavefront_vec = np.zeros(self.wavefront_matrix.shape[0])
+        self.mask_index = np.flatnonzero(self.mask)
         
     def get_wavefront(self,xslopes,yslopes):
-        
-        if self.regularize:
-            newSlopeRow = np.zeros([1])
-            slopes = np.hstack((xslopes,yslopes,newSlopeRow))
-        else:
-            slopes = np.hstack((xslopes,yslopes))
-
-        coefs = np.dot(self.zernike_matrix,slopes)
-        wavefront_vec = np.dot(self.wavefront_matrix,coefs)*(self.pupil_size/2.0)
-        error = wavefront_vec.std()
-        self.wavefront[np.where(self.mask)] = wavefront_vec
+        n = len(xslopes)
+        self.slopes[:n] = xslopes
+        self.slopes[n:2*n] = yslopes
+
+        coefs = np.dot(self.zernike_matrix,self.slopes,out=self.coefs)
+        wavefront_vec = np.dot(self.wavefront_matrix,coefs,out=self.wavefront_vec)
+        np.multiply(wavefront_vec,self.pupil_size/2.0,out=wavefront_vec)
+        # the standard deviation, without std's temporary array
+        mean = wavefront_vec.mean()
+        error = np.sqrt(max(0.0,np.dot(wavefront_vec,wavefront_vec)/len(wavefront_vec)-mean**2))
+        np.put(self.wavefront,self.mask_index,wavefront_vec)
         return coefs,self.wavefront,error
 
 
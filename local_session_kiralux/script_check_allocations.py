@@ -0,0 +1,99 @@
+import sys,os
+sys.path.append(os.path.join(os.getcwd(), "..",".."))
+import uWFS
+import ciao_config as ccfg
+import numpy as np
+import argparse
+import tracemalloc
+
+# Check that, once warmed up, an iteration of the loop--sensing,
+# reconstruction, the control law, and sending the command--allocates no
+# arrays, e.g.:
+#   python script_check_allocations.py -n 200 --masked 10
+# Each iteration is traced with tracemalloc, and the largest amount of
+# memory allocated during any one iteration must be under a fixed limit,
+# 4096 bytes by default (see --limit). It isn't zero, since Python
+# objects--scalars, views, and the memoryviews and buffers Cython makes
+# of the kernels' arguments--take up to about 2.5 KB at a time with the
+# compiled centroiding backend, however many lenslets there are. Since
+# the peak is what's measured, a short-lived array smaller than about
+# 3 KB, e.g. the slopes of fewer than 350 lenslets, may go unnoticed;
+# lower --limit to check a small sensor more closely. The NumPy backend
+# allocates arrays on every frame, and fails. The camera is replaced by
+# one that returns a single frame over and over, and the simulator, in
+# simulation, by a virtual mirror, since their drivers are not the
+# loop's own code. Every iteration checked must run the control law
+# through to the correction; otherwise the check fails. Safe mode is
+# turned off, so that spots dimmer than spots_threshold don't mask their
+# lenslets and stop the loop from correcting. With --masked, that many
+# search boxes are blanked, and safe mode and poke_invert_on_demand are
+# turned on, so that the masked control matrix and the packed index of
+# active lenslets are used.
+
+parser = argparse.ArgumentParser(description='Check that the loop allocates no arrays per iteration.')
+parser.add_argument('-n','--iterations',type=int,default=200,help='number of iterations to check')
+parser.add_argument('-w','--warmup',type=int,default=10,help='number of iterations before checking')
+parser.add_argument('--masked',type=int,default=0,help='number of search boxes to blank')
+parser.add_argument('--limit',type=int,default=4096,help='bytes allowed per iteration')
+args = parser.parse_args()
+
+class StillCamera:
+
+    def __init__(self,frame):
+        self.frame = frame
+
+    def get_image(self):
+        return self.frame
+
+    def close(self):
+        pass
+
+if ccfg.simulate:
+    sim = uWFS.simulator.Simulator()
+    frame = sim.get_image()
+    mirror = uWFS.mirrors.Mirror()
+else:
+    cam = uWFS.cameras.get_camera()
+    frame = cam.get_image()
+    cam.close()
+    mirror = uWFS.mirrors.Mirror()
+
+frame = frame.copy()
+sensor = uWFS.sensors.Sensor(StillCamera(frame))
+sb = sensor.search_boxes
+for k in range(args.masked):
+    frame[sb.y1[k]:sb.y2[k]+1,sb.x1[k]:sb.x2[k]+1] = 0
+
+if args.masked:
+    ccfg.poke_invert_on_demand = True
+engine = uWFS.engine.LoopEngine(sensor,mirror)
+engine.closed = True
+engine.safe = args.masked>0
+# a small gain, so that the virtual mirror's command stays bounded
+engine.gain = 0.01
+
+for k in range(args.warmup):
+    engine.update()
+
+limit = args.limit
+tracemalloc.start()
+allocated = []
+corrected = []
+for k in range(args.iterations):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    engine.update()
+    allocated.append(tracemalloc.get_traced_memory()[1]-before)
+    corrected.append(engine.ready_to_correct)
+tracemalloc.stop()
+
+allocated = np.array(allocated)
+print('%d active lenslets of %d'%(np.sum(engine.active_lenslets),sensor.n_lenslets))
+print('bytes allocated per iteration: median %d, max %d (limit %d)'%(np.median(allocated),allocated.max(),limit))
+print('%d of %d iterations corrected'%(np.sum(corrected),len(corrected)))
+mirror.flatten()
+if allocated.max()<limit and all(corrected):
+    print('PASS')
+else:
+    print('FAIL')
+    sys.exit(1)
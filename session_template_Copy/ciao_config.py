@@ -38,6 +38,13 @@ reference_coordinates_filename = reference_directory + 'reference.txt'
 reference_mask_filename = reference_directory + 'reference_mask.txt'
 poke_filename = poke_directory + 'poke.txt'
 
+# the poke matrix, reference coordinates, flat, and masks are loaded from
+# a binary .npy copy kept alongside each text file above, e.g. poke.npy,
+# which is written from the text file the first time it's loaded, and
+# again whenever the text file is newer; calibrations write the .npy
+# files and, with save_text_copies, the text files too
+save_text_copies = True
+
 # sensor settings:
 reference_n_measurements = 10
 lenslet_pitch_m = 500e-6
@@ -52,6 +59,16 @@ pixel_size_m = 40e-6
 # background estimation
 use_dark_subtraction = True
 
+# fused_dark_subtraction passes the dark image to the centroiding kernels,
+# which subtract it only inside the search boxes, instead of subtracting it
+# from the whole frame. It saves a full-frame allocation per frame, but the
+# spots image shown in the UI and logged is then the raw camera frame.
+fused_dark_subtraction = False
+
+# The image min/mean/max shown in the UI are computed on every
+# image_statistics_stride-th pixel in each dimension. 1 uses every pixel.
+image_statistics_stride = 1
+
 # estimate_background determines whether CIAO tries to estimate the background
 # of each box on the fly, by computing the average signal at the edge of each box.
 # This approach was developed when we noticed that the background light (maybe
@@ -89,9 +106,48 @@ sensor_update_rate = 1.0 # deprecated in current version
 sensor_filter_lenslets = False
 sensor_reconstruct_wavefront = True
 sensor_remove_tip_tilt = True
+# Number of threads among which the centroiding kernels divide the spots;
+# requires centroid.pyx to have been compiled with OpenMP (see setup.py).
 centroiding_num_threads = 1
+# centroiding_backend selects the centroiding implementation: 'cython'
+# uses the compiled centroid module; 'numpy' uses the vectorized NumPy
+# centroider in components/label_centroids.py, which needs no compiler but
+# is several times slower. 'cython' falls back to 'numpy' if the compiled
+# module can't be imported.
+centroiding_backend = 'cython'
+# With fast_centroiding, spots found on the previous frame are searched
+# for only within fast_centroiding_tracking_half_width of their previous
+# centroids, falling back to the whole search box if they are lost. This
+# saves most of the pixel reads when search_box_half_width is large.
+# 0 searches the whole box on every frame.
+fast_centroiding_tracking_half_width = 0
+# centroiding_summed_area_tables computes the search box sums from
+# integral images of the frame, built once per frame, instead of summing
+# each box on each iteration. It is faster only with large search boxes
+# and several centroiding_iterations. The background is subtracted from
+# the box sums without clamping negative pixels at zero, so
+# background_correction should be near 0 when it is used.
+centroiding_summed_area_tables = False
+# correlation_centroiding locates each spot by cross-correlating its
+# search box with a template spot (see components/correlation_centroids.py),
+# which is more accurate than a center of mass for dim spots, but slower.
+# It takes precedence over fast_centroiding. The template is a gaussian
+# with standard deviation correlation_template_sigma_px; if that is not
+# set, it is matched to the diffraction-limited spot size.
+correlation_centroiding = False
+#correlation_template_sigma_px = 1.5
 camera_exposure_us = 10000
 
+# acquisition_thread runs the camera in its own thread, which fills a ring
+# of acquisition_ring_size frame buffers, so that the next frame's readout
+# overlaps with the processing of the current one. acquisition_mode
+# 'newest' processes the newest frame, skipping any that arrived while
+# the last one was processed; 'next' processes every frame in order,
+# as long as processing keeps up with the ring.
+acquisition_thread = False
+acquisition_ring_size = 4
+acquisition_mode = 'newest'
+
 profile_ui_update_method = False
 profile_sensor_update_method = False
 profile_loop_update_method = False
@@ -109,8 +165,69 @@ poke_command_min = -0.3
 poke_n_command_steps = 5
 poke_invert_on_demand = False
 
+# how the poke matrix is measured: 'sequential' steps each actuator in
+# turn through poke_n_command_steps commands; 'hadamard' (or 'random')
+# moves every actuator at once by +/-poke_multiplex_amplitude from the
+# flat, in 2*128 patterns for up to 127 actuators, repeated
+# poke_multiplex_repeats times, and solves for the poke matrix in one
+# step (see calibration.py); lower the amplitude if spots leave their
+# search boxes
+poke_mode = 'sequential'
+poke_multiplex_amplitude = 0.05
+poke_multiplex_repeats = 1
+
+# the poke matrix may also be measured without opening the loop, by
+# adding to the commands a sinusoid of poke_modulation_amplitude for each
+# actuator, or each of the mirror's modes ('modes'), at its own frequency
+# for poke_modulation_n_frames frames, and demodulating the slopes
+# measured loop_latency_frames later (see calibration.py);
+# n_frames must be at least 2.7 times the number of actuators
+poke_modulation_basis = 'actuators'
+poke_modulation_amplitude = 0.02
+poke_modulation_n_frames = 1024
+
+# with poke_refine, refine the poke matrix in a background thread from the
+# changes in the commands and slopes between consecutive closed-loop
+# iterations, using a random dither of +/-poke_refine_amplitude added to
+# every command to tell the mirror's effect from the loop's reaction to
+# noise; each frame is weighted poke_refine_forgetting times the next, and
+# the fit is regularized toward the poke matrix in use by
+# poke_refine_regularization; every poke_refine_interval_s seconds, if the
+# refined matrix fits the recent frames better and its condition number is
+# within loop_condition_llim and loop_condition_ulim, the loop switches to
+# it; it isn't saved (see calibration.Refiner)
+poke_refine = False
+poke_refine_amplitude = 0.005
+poke_refine_forgetting = 0.999
+poke_refine_regularization = 0.1
+poke_refine_interval_s = 10.0
+
+# the number of pupil masks for which control matrices, and the SVDs
+# of the poke matrix they are computed from, are kept; the least
+# recently used are dropped first (see poke.py)
 ctrl_dictionary_max_size = 10
 
+# with poke_invert_on_demand, derive each masked control matrix from the
+# cached SVD of the whole poke matrix (see Poke.downdate_factors), rather
+# than computing the SVD of the masked one; a downdate whose relative
+# residual exceeds poke_downdate_tolerance falls back to the full SVD, and
+# with poke_downdate_verify every downdate is also compared with the full
+# SVD, which is slow, and the difference printed
+poke_downdate = True
+poke_downdate_tolerance = 1e-8
+poke_downdate_verify = False
+
+# with poke_invert_on_demand, compute control matrices in a background
+# thread for the masks the loop is likely to need--the outer
+# poke_precompute_rings rings of lenslets removed, and each of
+# poke_precompute_sectors sectors of those rings removed--and keep those
+# for the poke_precompute_recent masks used most recently (see
+# poke.Precomputer)
+poke_precompute = False
+poke_precompute_rings = 2
+poke_precompute_sectors = 8
+poke_precompute_recent = 10
+
 loop_n_control_modes = 94
 loop_gain = 0.3
 loop_loss = 0.01
@@ -118,6 +235,35 @@ loop_update_rate = 500.0
 loop_condition_ulim = 1000.
 loop_condition_llim = 1.0
 
+# the number of iterations between sending a command and sensing the
+# slopes it causes: 1 for the serial loop, more when pipelined; used by
+# the calibrations that run with the loop closed
+loop_latency_frames = 1
+
+# Run the loop as a pipeline, with acquisition, centroiding, reconstruction
+# plus control, and mirror updates each in its own thread, passing
+# loop_pipeline_buffers preallocated frames between them. Throughput is then
+# set by the slowest stage, at the cost of some latency; loop_update_rate
+# then sets only the UI refresh rate. With profile_loop_update_method, each
+# stage's occupancy and queue depth are printed once a second.
+loop_pipelined = False
+loop_pipeline_buffers = 3
+
+# Run the loop's update in its own thread, rather than on a timer in the
+# UI's thread, so that slow drawing doesn't slow the loop. The UI then
+# draws copies of the loop's state whenever it is ready for one, skipping
+# frames as needed. The pipelined loop always runs outside the UI's thread.
+loop_thread = False
+
+# How the loop is paced, when it runs in its own thread or as a pipeline:
+# 'fixed' starts an iteration every 1/loop_update_rate seconds, counting an
+# overrun for each start missed; 'free' runs as fast as the camera and
+# mirror allow; 'camera' starts an iteration whenever a frame arrives
+# (with acquisition_thread set; without it, 'free' is used), counting an
+# overrun for each frame skipped. Histograms of the loop period and jitter are written to the
+# logging directory at the end of each logging session.
+loop_schedule = 'fixed'
+
 n_zernike_terms = 66
 zernike_dioptric_equivalent = 1.5
 
@@ -185,6 +331,7 @@ contrast_button_width = 40
 ui_fps_fmt = '%0.2f Hz (UI)'
 sensor_fps_fmt = '%0.2f Hz (Sensor)'
 mirror_fps_fmt = '%0.2f Hz (Mirror)'
+loop_schedule_fmt = '%0.2f Hz (Loop), %0.0f us jitter, %d overruns'
 wavefront_error_fmt = '%0.1f nm RMS (Error)'
 tip_fmt = '%0.4f mrad (Tip)'
 tilt_fmt = '%0.4f mrad (Tilt)'
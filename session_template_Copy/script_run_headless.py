@@ -0,0 +1,50 @@
+import sys,os
+sys.path.append(os.path.split(__file__)[0])
+import ciao
+import ciao_config as ccfg
+import numpy as np
+import argparse
+
+# Run the loop without the UI, for benchmarks and automated measurements,
+# e.g.:
+#   python script_run_headless.py -t 30 --closed --schedule free
+# and print the throughput and latency percentiles. This needs neither Qt
+# nor a display.
+
+parser = argparse.ArgumentParser(description='Run the loop headless and report throughput and latency.')
+parser.add_argument('-n','--iterations',type=int,default=None,help='number of iterations')
+parser.add_argument('-t','--seconds',type=float,default=None,help='duration in seconds (default 10, if -n is not given)')
+parser.add_argument('--closed',action='store_true',help='close the loop')
+parser.add_argument('--pipelined',action='store_true',help='run the loop as a pipeline (see loop_pipelined)')
+parser.add_argument('--schedule',choices=['fixed','free','camera'],default=None,help='override loop_schedule')
+args = parser.parse_args()
+
+if args.iterations is None and args.seconds is None:
+    args.seconds = 10.0
+
+if ccfg.simulate:
+    sim = ciao.simulator.Simulator()
+    sensor = ciao.sensors.Sensor(sim)
+    mirror = sim
+else:
+    cam = ciao.cameras.get_camera()
+    mirror = ciao.mirrors.Mirror()
+    sensor = ciao.sensors.Sensor(cam)
+
+engine = ciao.engine.LoopEngine(sensor,mirror)
+if args.schedule is not None:
+    engine.scheduler.mode = args.schedule
+engine.closed = args.closed
+
+latencies,elapsed = engine.run(args.iterations,args.seconds,pipelined=args.pipelined)
+stats = ciao.engine.summarize(latencies,elapsed)
+schedule = engine.scheduler.statistics()
+
+print('%d iterations in %0.2f s: %0.1f Hz'%(stats['iterations'],stats['elapsed_s'],stats['throughput_hz']))
+if stats['iterations']:
+    print('latency (ms): p50 %0.3f, p90 %0.3f, p99 %0.3f, p99.9 %0.3f, max %0.3f'%
+          tuple([stats[k]*1e3 for k in ['latency_p50_s','latency_p90_s','latency_p99_s','latency_p99.9_s','latency_max_s']]))
+print('schedule (%s): %d overruns'%(schedule['mode'],schedule['overruns']))
+
+mirror.flatten()
+sensor.cam.close()